@@ -9,13 +9,15 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 
+from seal.util import util
 from seal.plot import putil
 from seal.roc import rocutil
 
 
 def import_CE_ROC_results(ulists, tasks, CE_feat_pars, nrate, tstep, n_perm,
-                          offsets, min_len, pth, vth_hi, vth_lo, aroc_res_dir):
-    """Import CE ROC results."""
+                          offsets, min_len, pth, vth_hi, vth_lo, aroc_res_dir,
+                          table_fmt='csv'):
+    """Import CE ROC results (from tables of given format)."""
 
     eff_pars = [('high', 'S > D'), ('low', 'D > S')]
     prefix, btw_str, t1, t2 = CE_feat_pars
@@ -25,8 +27,8 @@ def import_CE_ROC_results(ulists, tasks, CE_feat_pars, nrate, tstep, n_perm,
         task = tasks[nlist]
         ftable = rocutil.aroc_table_fname(ares_dir, task, nrate, tstep, n_perm,
                                           offsets, 'S2', min_len, pth, vth_hi,
-                                          vth_lo)
-        d_eff_t_res[nlist] = pd.read_excel(ftable)
+                                          vth_lo, table_fmt)
+        d_eff_t_res[nlist] = util.import_table(ftable)
     eff_t_res = pd.concat(d_eff_t_res)
 
     return eff_pars, eff_t_res
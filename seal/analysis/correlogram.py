@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to calculate spike time autocorrelograms and cross-correlograms
+of units, on sorted arrays of spike times.
+
+@author: David Samu
+"""
+
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from seal.util import util, constants
+
+
+# Constants.
+cg_bins = np.arange(-50.5, 51)  # bin edges of correlograms (ms)
+chunk_size = 100000             # number of spikes to sweep at once
+zero_lag_wndw = 1.0             # half width of zero lag window (ms)
+min_shoulder_lag = 20.0         # min. lag of correlogram shoulders (ms)
+min_zero_lag_ratio = 5.0        # min. zero lag peak ratio of double counting
+
+# Spike times shared with worker processes (set by init_shared_spikes).
+_shared = {}
+
+
+# %% Core functions.
+
+def lag_pairs(t1, t2, max_lag):
+    """
+    Return indices (i, j) and lags (t2[j] - t1[i]) of all pairs of spikes of
+    two sorted spike time arrays within maximum lag. The window of spikes of
+    t2 around each spike of t1 is found by sweeping both arrays at once
+    (searchsorted merge, the vectorized form of a two-pointer sweep).
+    """
+
+    # First and last (exclusive) spike of t2 within window of each spike.
+    jfirst = np.searchsorted(t2, t1 - max_lag, side='left')
+    jlast = np.searchsorted(t2, t1 + max_lag, side='right')
+    npairs = jlast - jfirst
+
+    # Expand windows into pairs.
+    i = np.repeat(np.arange(len(t1)), npairs)
+    j = (np.arange(npairs.sum()) - np.repeat(np.cumsum(npairs) - npairs,
+                                             npairs)
+         + np.repeat(jfirst, npairs))
+    lags = t2[j] - t1[i]
+
+    return i, j, lags
+
+
+def max_lag_of_bins(bins):
+    """Return maximum lag covered by bins."""
+
+    max_lag = max(abs(bins[0]), abs(bins[-1]))
+    return max_lag
+
+
+def ccg(t1, t2, bins=cg_bins, exclude_self=False, csize=chunk_size):
+    """
+    Return cross-correlogram (number of spike pairs in each lag bin) of two
+    sorted spike time arrays (in ms). Set exclude_self to True to exclude
+    pairs of spikes with themselves (autocorrelogram of t1 = t2).
+    """
+
+    max_lag = max_lag_of_bins(bins)
+    counts = np.zeros(len(bins)-1, dtype=int)
+    for i0 in range(0, len(t1), csize):
+        i, j, lags = lag_pairs(t1[i0:i0+csize], t2, max_lag)
+        if exclude_self:
+            lags = lags[i + i0 != j]
+        counts += util.segment_histograms(lags, np.zeros(len(lags), int), 1,
+                                          bins)[0]
+
+    return counts
+
+
+def autocorrelograms(spk_times, offsets, bins=cg_bins, csize=chunk_size):
+    """
+    Return autocorrelogram of each unit (units x bins) from sorted spike
+    times of units (in ms) concatenated into single array, with index of
+    first spike of each unit (and end of last one) in offsets.
+    """
+
+    nseg = len(offsets) - 1
+    if not len(spk_times):
+        return np.zeros((nseg, len(bins)-1), dtype=int)
+
+    # Shift units apart in time, so that all units can be swept at once
+    # without pairing spikes of different units.
+    max_lag = max_lag_of_bins(bins)
+    iseg = util.segment_idxs(offsets)
+    stride = spk_times.max() - spk_times.min() + 2 * max_lag + 1
+    tshift = spk_times + iseg * stride
+
+    acgs = np.zeros((nseg, len(bins)-1), dtype=int)
+    for i0 in range(0, len(tshift), csize):
+        i, j, lags = lag_pairs(tshift[i0:i0+csize], tshift, max_lag)
+        not_self = i + i0 != j
+        acgs += util.segment_histograms(lags[not_self], iseg[j[not_self]],
+                                        nseg, bins)
+
+    return acgs
+
+
+# %% Cross-correlograms of unit pairs.
+
+def init_shared_spikes(spk_times_list, bins):
+    """Set spike times of units and bins for worker processes."""
+
+    _shared['spk_times_list'] = spk_times_list
+    _shared['bins'] = bins
+
+
+def ccg_pairs(pairs):
+    """Return cross-correlograms of unit pairs (of shared spike times)."""
+
+    spk_times_list, bins = _shared['spk_times_list'], _shared['bins']
+    ccgs = [ccg(spk_times_list[i1], spk_times_list[i2], bins)
+            for i1, i2 in pairs]
+
+    return ccgs
+
+
+def cross_correlograms(spk_times_list, pairs, bins=cg_bins, nCPU=1,
+                       npairs_chunk=100):
+    """
+    Return cross-correlogram of each pair of units (list of index pairs into
+    list of sorted spike time arrays in ms) as pairs x bins array,
+    optionally calculating chunks of pairs in parallel (nCPU > 1).
+    """
+
+    params = [(pairs[i:i+npairs_chunk],)
+              for i in range(0, len(pairs), npairs_chunk)]
+    res = util.run_in_pool(ccg_pairs, params, nCPU,
+                           initializer=init_shared_spikes,
+                           initargs=(spk_times_list, bins))
+    _shared.clear()
+
+    ccgs = np.array([c for chunk in res for c in chunk], dtype=int)
+    ccgs = ccgs.reshape(len(pairs), len(bins)-1)
+
+    return ccgs
+
+
+def zero_lag_ratio(cgs, bins=cg_bins, wndw=zero_lag_wndw,
+                   min_lag=min_shoulder_lag):
+    """
+    Return ratio of mean count of correlograms (pairs x bins) around zero lag
+    to mean count at shoulders (lags of at least min_lag).
+    """
+
+    lags = np.abs((bins[:-1] + bins[1:]) / 2)
+    cgs = np.asarray(cgs, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (cgs[:, lags <= wndw].mean(1) /
+                 cgs[:, lags >= min_lag].mean(1))
+
+    return ratio
+
+
+# %% Correlograms of recording.
+
+def rec_correlograms(UA, task, rec, bins=cg_bins, excl=False, nCPU=1):
+    """
+    Calculate autocorrelograms of all units of recording during task, and
+    cross-correlograms of all pairs of them. Units recorded on the same
+    channel that have been sorted from the same spikes (double counted units)
+    are detected by a peak of their cross-correlogram around zero lag.
+    """
+
+    # Init spike times of units.
+    utids = UA.utids([task], [rec], excl=excl)
+    ulist = [UA.get_unit_by_utid(utid) for utid in utids]
+    spk_times_list = [1000 * np.array(u.SpikeParams['time'], dtype=float)
+                      for u in ulist]
+    spk_times, offsets = util.concat_segments(spk_times_list)
+
+    # Autocorrelograms.
+    lags = (bins[:-1] + bins[1:]) / 2
+    acgs = autocorrelograms(spk_times, offsets, bins)
+    acgs = pd.DataFrame(acgs, index=utids, columns=lags)
+
+    # Cross-correlograms of all unit pairs.
+    pairs = list(combinations(range(len(ulist)), 2))
+    ccgs = cross_correlograms(spk_times_list, pairs, bins, nCPU)
+    pair_names = ([name + '1' for name in constants.utid_names] +
+                  [name + '2' for name in constants.utid_names])
+    pair_idx = pd.MultiIndex.from_tuples([utids[i1] + utids[i2]
+                                          for i1, i2 in pairs],
+                                         names=pair_names)
+    ccgs = pd.DataFrame(ccgs, index=pair_idx, columns=lags)
+
+    # Zero lag peaks of pairs on same channel.
+    ich = constants.utid_names.index('ch')
+    same_ch = np.array([utids[i1][:ich+1] == utids[i2][:ich+1]
+                        for i1, i2 in pairs], dtype=bool)
+    ratio = zero_lag_ratio(ccgs, bins) if len(pairs) else np.zeros(0)
+    is_double = same_ch & (ratio >= min_zero_lag_ratio)
+    pair_stats = pd.DataFrame({'same_ch': same_ch, 'zero_lag_ratio': ratio,
+                               'double_counted': is_double}, index=pair_idx,
+                              columns=['same_ch', 'zero_lag_ratio',
+                                       'double_counted'])
+
+    return acgs, ccgs, pair_stats
@@ -134,52 +134,130 @@ def tuned_DS(dirs, resp, dir0=0*deg, **kwargs):
 
 # %% Functions to calculate population level preferred directions.
 
-def calc_PPD(DSInfo):
+def calc_PPD_arrays(PD, DSI, is_unit):
     """
-    Calculate population preferred direction (PPD) and
-    population direction selectivity (PDSI).
+    Calculate population preferred direction (PPD) and population direction
+    selectivity (PDSI) of multiple groups of units (e.g. recordings) at once,
+    vectorized across groups and rotations of directions.
+
+    PD, DSI: (groups x units) arrays of PD (in deg) and DSI of units.
+    is_unit: (groups x units) boolean array, False for padding values.
+
+    Return arrays of PDSI, PPD, PPDc and PADc per group.
     """
 
-    res_idx = ['PDSI', 'PPD', 'PPDc', 'PADc']
-    if DSInfo.empty:
-        return pd.Series([np.nan, np.nan, np.nan, np.nan], index=res_idx)
+    dirs = np.array(constants.all_dirs.rescale(deg))
+    ngrps = PD.shape[0]
+    nunits = is_unit.sum(1)
+
+    # Currently first need to rotate PDs before flipping
+    # (groups x rotations x units).
+    rPD = np.mod(PD[:, None, :] + dirs[None, :, None], 360)
+
+    # Flip all directions to 0-180 half to prevent
+    # cancellation of opposite directions.
+    PDflip = np.mod(rPD, 180)
+
+    # Calculate population DSI and population PD by weighted mean of unit
+    # vectors (in complex form), ignoring NaN weights.
+    has_w = is_unit & ~np.isnan(DSI)
+    w = np.where(has_w, DSI, 0)[:, None, :]
+    zsum = np.where(has_w[:, None, :], w * np.exp(1j * deg2rad(PDflip)),
+                    0).sum(-1)
+    wsum = w.sum(-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = zsum / wsum
+        no_w = (wsum == 0) | ~has_w.any(1)[:, None]
+        PDSI = np.where(no_w, 0, np.abs(z))
+        PPD = np.where(no_w, np.nan, np.mod(rad2deg(np.angle(z)), 360))
 
-    PD = util.dim_series_to_array(DSInfo.PD)
-    DSI = np.array(DSInfo.DSI)
-    dres = {}
-    for rot in constants.all_dirs:
+        # Scale PDSI by population average DSI.
+        mDSI = np.where(is_unit, DSI, 0).sum(1) / nunits
+        PDSI = mDSI[:, None] * PDSI
+
+    # Determine direction of PPD (may have to flip around).
+    nflip = (is_unit[:, None, :] & (rPD >= 180)).sum(-1)
+    to_flip = nflip > nunits[:, None] / 2
+    PPD[to_flip] = np.mod(PPD[to_flip] + 180, 360)
+
+    # Rotate back PPD to original space.
+    PPD = np.mod(PPD - dirs[None, :], 360)
+
+    # Coarse PPD and get anti-pref dir.
+    ddiff = np.abs(PPD[:, :, None] - dirs[None, None, :])
+    ddiff = np.where(ddiff < 180, ddiff, 360 - ddiff)
+    PPDc = dirs[np.argmin(np.where(np.isnan(ddiff), np.inf, ddiff), -1)]
+    PPDc[np.isnan(PPD)] = np.nan
+    PADc = np.mod(PPDc + 180, 360)
+
+    # Find rotation with highest PDSI. Ties (up to numerical precision) are
+    # resolved to first rotation.
+    has_PDSI = ~np.isnan(PDSI).all(1)
+    with np.errstate(invalid='ignore'):
+        maxPDSI = np.nanmax(np.where(np.isnan(PDSI), -np.inf, PDSI), 1)
+    irot = np.argmax(np.isclose(PDSI, maxPDSI[:, None], rtol=1e-9), 1)
+    igrp = np.arange(ngrps)
+    res = [v[igrp, irot] for v in (PDSI, PPD, PPDc, PADc)]
+    for v in res:
+        v[~has_PDSI | (nunits == 0)] = np.nan
 
-        # Currently first need to rotate PDs before flipping.
-        rPD = deg_mod(PD + rot, 360*deg)
+    return res
 
-        # Flip all directions to 0-180 half to prevent
-        # cancellation of opposite directions.
-        PDflip = deg_mod(rPD, 180*deg)
 
-        # Calculate population DSI and population PD.
-        PDSI, PPD = polar_wmean(PDflip, DSI)
+def calc_group_PPD(DSInfo, grp_levels, inc_col=None):
+    """
+    Calculate population preferred direction (PPD) and population direction
+    selectivity (PDSI) of each group of units in DSInfo table.
 
-        # Scale PDSI by population average DSI.
-        PDSI = DSI.mean() * PDSI
+    grp_levels: Index levels to group units by (e.g. recording and task).
+    inc_col: Boolean column of units to include, if not None.
+    """
 
-        # Determine direction of PPD (may have to flip around).
-        if sum(rPD >= 180) > len(rPD)/2:
-            PPD = anti_dir(PPD)
+    res_idx = ['PDSI', 'PPD', 'PPDc', 'PADc']
+    grps = DSInfo.groupby(level=grp_levels, sort=False)
 
-        # Rotate back PPD to original space.
-        PPD = deg_mod(PPD - rot, 360*deg)
+    # Collect PDs and DSIs of groups into padded arrays.
+    ngrps, nmax = len(grps), max(grps.size().max(), 1)
+    PD, DSI = [np.full((ngrps, nmax), np.nan) for i in range(2)]
+    is_unit = np.zeros((ngrps, nmax), dtype=bool)
+    for i, (grp, gDSInfo) in enumerate(grps):
+        if inc_col is not None:
+            gDSInfo = gDSInfo.loc[gDSInfo[inc_col].astype(bool)]
+        n = len(gDSInfo)
+        if not n:
+            continue
+        PD[i, :n] = util.dim_series_to_array(gDSInfo.PD).rescale(deg)
+        DSI[i, :n] = gDSInfo.DSI
+        is_unit[i, :n] = True
 
-        # Coarse PPD and get anti-pref dir.
-        PPDc = coarse_dir(PPD, constants.all_dirs)
-        PADc = anti_dir(PPDc)
+    # Calculate PPD and PDSI of all groups.
+    PDSI, PPD, PPDc, PADc = calc_PPD_arrays(PD, DSI, is_unit)
 
-        # Collect results.
-        dres[float(rot)] = {'PDSI': PDSI, 'PPD': PPD,
-                            'PPDc': PPDc, 'PADc': PADc}
-    PPDres = pd.DataFrame(dres, ).T
+    # Format results.
+    dres = [PDSI] + [[v*deg for v in vals] for vals in (PPD, PPDc, PADc)]
+    PPDres = pd.DataFrame(dict(zip(res_idx, dres)), columns=res_idx,
+                          index=pd.Index(list(grps.groups.keys())))
 
-    # Find highest PDSI. Ties should give the same result.
-    res = PPDres.loc[PPDres.PDSI.idxmax(), res_idx]
+    return PPDres
+
+
+def calc_PPD(DSInfo):
+    """
+    Calculate population preferred direction (PPD) and
+    population direction selectivity (PDSI).
+    """
+
+    res_idx = ['PDSI', 'PPD', 'PPDc', 'PADc']
+    if DSInfo.empty:
+        return pd.Series([np.nan, np.nan, np.nan, np.nan], index=res_idx)
+
+    PD = np.array(util.dim_series_to_array(DSInfo.PD).rescale(deg))
+    DSI = np.array(DSInfo.DSI, dtype=float)
+    is_unit = np.ones(len(PD), dtype=bool)
+    PDSI, PPD, PPDc, PADc = [v[0] for v in calc_PPD_arrays(PD[None, :],
+                                                           DSI[None, :],
+                                                           is_unit[None, :])]
+    res = pd.Series([PDSI, PPD*deg, PPDc*deg, PADc*deg], index=res_idx)
 
     return res
 
@@ -247,6 +325,17 @@ def deg_diff(d1, d2):
     return d
 
 
+def deg_diff_arr(d1, d2):
+    """
+    Return difference between two arrays of angles (in degrees, without
+    dimension), element-wise.
+    """
+
+    d = np.abs(np.mod(d1, 360) - np.mod(d2, 360))
+    d = np.where(d < 180, d, 360 - d)
+    return d
+
+
 def coarse_dir(origd, dirs):
     """Return direction from list that is closest to provided one."""
 
@@ -11,6 +11,8 @@ import numpy as np
 import scipy as sp
 import pandas as pd
 
+from seal.util import util
+
 
 # Constants.
 min_sample_size = 10
@@ -102,6 +104,108 @@ def mann_whithney_u_test(x, y, use_continuity=True, alternative='two-sided'):
     return stat, pval
 
 
+# %% Vectorized rank statistics.
+
+def tie_bounds(Xs):
+    """
+    Return first and last position of run of tied values at each position of
+    already sorted values along first axis of array.
+    """
+
+    n = Xs.shape[0]
+    idx = np.arange(n).reshape((n,) + (Xs.ndim-1) * (1,))
+
+    is_first = np.ones(Xs.shape, dtype=bool)
+    is_first[1:] = Xs[1:] != Xs[:-1]
+    is_last = np.ones(Xs.shape, dtype=bool)
+    is_last[:-1] = is_first[1:]
+    ifirst = np.maximum.accumulate(np.where(is_first, idx, 0), axis=0)
+    ilast = np.minimum.accumulate(np.where(is_last, idx, n)[::-1],
+                                  axis=0)[::-1]
+
+    return ifirst, ilast
+
+
+def sorted_ranks(Xs):
+    """
+    Return ranks (starting from 1) of already sorted values along first axis
+    of array, with tied values getting their average rank.
+    """
+
+    # Average rank of run of tied values.
+    ifirst, ilast = tie_bounds(Xs)
+    ranks = (ifirst + ilast) / 2 + 1
+
+    return ranks
+
+
+def tied_ranks(X):
+    """
+    Return ranks (starting from 1) of values within each column of 2D array,
+    with tied values getting their average rank (like scipy's rankdata).
+    """
+
+    X = np.asarray(X)
+
+    # Sort each column, rank and put ranks back into original order.
+    isort = np.argsort(X, axis=0, kind='mergesort')
+    Xs = np.take_along_axis(X, isort, 0)
+    ranks = np.empty(X.shape)
+    np.put_along_axis(ranks, isort, sorted_ranks(Xs), 0)
+
+    return ranks
+
+
+def mann_whitney_u_tests(X, Y, use_continuity=True):
+    """
+    Run two-sided Mann-Whitney U tests between each column of two 2D arrays
+    at once, ignoring NaN values (e.g. padding samples of different size).
+    Uses normal approximation with tie correction, and returns NaN in case
+    of insufficient sample size or all values being equal (as
+    mann_whithney_u_test).
+
+    Returns U statistic of X and p-value of each column.
+    """
+
+    X, Y = [np.array(v, dtype=float, ndmin=2) for v in (X, Y)]
+    n1, n2 = [(~np.isnan(v)).sum(0) for v in (X, Y)]
+    n = n1 + n2
+
+    # Rank values within each column of samples combined, NaNs last.
+    Z = np.concatenate([X, Y])
+    is_x = np.zeros(Z.shape, dtype=bool)
+    is_x[:len(X)] = True
+    isort = np.argsort(Z, axis=0, kind='mergesort')
+    Zs = np.take_along_axis(Z, isort, 0)
+    is_x = np.take_along_axis(is_x, isort, 0)
+    is_valid = ~np.isnan(Zs)
+    ifirst, ilast = tie_bounds(Zs)
+    ranks = (ifirst + ilast) / 2 + 1
+
+    # U statistics and tie correction term (sum of t^3 - t over runs of t
+    # tied values).
+    R1 = np.where(is_x & is_valid, ranks, 0).sum(0)
+    U1 = R1 - n1 * (n1+1) / 2
+    bigu = np.maximum(U1, n1 * n2 - U1)
+    tlen = ilast - ifirst + 1
+    tie_term = np.where(is_valid, tlen**2 - 1, 0).sum(0)
+
+    # P-value by normal approximation.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = n1 * n2 / 2
+        sd = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n-1))))
+        z = (bigu - use_continuity * 0.5 - mu) / sd
+    pval = 2 * sp.stats.norm.sf(np.abs(z))
+
+    # Insufficient sample size, or no item differing from rest.
+    to_skip = ((np.minimum(n1, n2) < min_sample_size) |
+               (tie_term == n**3 - n))
+    U1[to_skip] = np.nan
+    pval[to_skip] = np.nan
+
+    return U1, pval
+
+
 # %% Meta-functions testing statistical differences on time series.
 
 def sign_diff(ts1, ts2, p, test, **kwargs):
@@ -139,19 +243,9 @@ def periods(t_on_ser, min_len=None):
     if not len(t_on_ser.index):
         return []
 
-    # Init data.
+    # Find (start, end) pairs of periods.
     tvec = np.array(t_on_ser.index)
-    t_on = np.array(t_on_ser)
-
-    # Starts of periods.
-    tstarts = np.insert(t_on, 0, False)
-    istarts = np.logical_and(tstarts[:-1] == False, tstarts[1:] == True)
-
-    # Ends of periods.
-    tends = np.append(t_on, False)
-    iends = np.logical_and(tends[:-1] == True, tends[1:] == False)
-
-    # Zip (start, end) pairs of periods.
+    irow, istarts, iends = util.run_bounds(t_on_ser)
     pers = [(t1, t2) for t1, t2 in zip(tvec[istarts], tvec[iends])]
 
     # Drop periods shorter than minimum length.
@@ -204,13 +298,108 @@ def prd_in_window(t, tmin, tmax, tlen, tdim=None):
     return TW
 
 
+def prds_in_windows(ts, tmins, tmaxs, tlen):
+    """
+    Return limits of time periods of given length centered around each t
+    within window (vectorized version of prd_in_window, without dimensions).
+    """
+
+    half_len = tlen / 2
+
+    # Extend of overflow of specified time window on each side.
+    left_overflow = np.maximum(tmins - (ts - half_len), 0)
+    right_overflow = np.maximum((ts + half_len) - tmaxs, 0)
+
+    # End points.
+    tstarts = np.maximum(ts - half_len - right_overflow, tmins)
+    tends = np.minimum(ts + half_len + left_overflow, tmaxs)
+
+    return tstarts, tends
+
+
 def perm_pval(score, perm_scores):
     """
     Calculate p-value of original score agains a vector of permuted scores.
+    Permutations are along first axis, if scores are given at multiple
+    points (e.g. time).
 
     Based on Def 1 of Ojala and Garriga. Permutation Tests for Studying
     Classifier Performance. The Journal of Machine Learning Research (2010)
     """
 
-    pval = (np.sum(perm_scores >= score)+1) / (len(perm_scores)+1)
+    pval = (np.sum(perm_scores >= score, axis=0)+1) / (len(perm_scores)+1)
     return pval
+
+
+def cluster_perm_test(score, perm_scores, pth=0.05):
+    """
+    Cluster-mass permutation test of score time courses (units x time, or
+    single time vector) against time courses of permuted scores (permutation
+    x units x time, or permutation x time), with larger scores meaning larger
+    effect (e.g. |AUC - 0.5|). Each permutation has to be the same
+    relabelling at all time points.
+
+    Clusters are runs of time points with pointwise permutation p-value
+    (see perm_pval) below pth, cluster mass is the sum of scores within
+    cluster. P-value of cluster is the fraction of permutations with maximum
+    cluster mass (of same unit) at least as large as the mass of the cluster.
+
+    Based on Maris and Oostenveld. Nonparametric statistical testing of
+    EEG- and MEG-data. Journal of Neuroscience Methods (2007)
+
+    Returns cluster p-value at each time point (1 outside of clusters) and
+    table of clusters (unit, index of first and last time point, mass and
+    p-value).
+    """
+
+    # Init data, NaN scores never being part of a cluster.
+    score = np.array(score, dtype=float)
+    is_vec = score.ndim == 1
+    score = score.reshape((-1, score.shape[-1]))
+    perm_scores = np.array(perm_scores, dtype=float)
+    perm_scores = perm_scores.reshape((len(perm_scores),) + score.shape)
+    n_perm, nunits, ntimes = perm_scores.shape
+    score, perm_scores = [np.where(np.isnan(x), -np.inf, x)
+                          for x in (score, perm_scores)]
+
+    # Pointwise p-values of scores and of each permutation against all
+    # permutations.
+    pval = perm_pval(score, perm_scores)
+    isort = np.argsort(perm_scores, axis=0, kind='mergesort')
+    ifirst = tie_bounds(np.take_along_axis(perm_scores, isort, 0))[0]
+    perm_pv = np.empty(perm_scores.shape)
+    np.put_along_axis(perm_pv, isort, (n_perm-ifirst+1) / (n_perm+1), 0)
+
+    # Mass of each cluster (run of significant time points).
+    def cluster_mass(X, is_sign):
+        irow, istart, iend = util.run_bounds(is_sign)
+        csum = np.zeros((X.shape[0], X.shape[1]+1))
+        csum[:, 1:] = np.cumsum(np.where(is_sign, X, 0), axis=1)
+        mass = csum[irow, iend+1] - csum[irow, istart]
+        return irow, istart, iend, mass
+
+    # Maximum cluster mass of each permutation and unit.
+    perm_scores = perm_scores.reshape((-1, ntimes))
+    perm_pv = perm_pv.reshape((-1, ntimes))
+    irow, istart, iend, mass = cluster_mass(perm_scores, perm_pv < pth)
+    max_mass = np.zeros(n_perm * nunits)
+    np.maximum.at(max_mass, irow, mass)
+    max_mass = max_mass.reshape((n_perm, nunits))
+
+    # Clusters of scores and their p-values.
+    iunit, istart, iend, mass = cluster_mass(score, pval < pth)
+    cl_pval = perm_pval(mass, max_mass[:, iunit])
+    clusters = pd.DataFrame({'unit': iunit, 'istart': istart, 'iend': iend,
+                             'mass': mass, 'pval': cl_pval},
+                            columns=['unit', 'istart', 'iend', 'mass', 'pval'])
+
+    # Cluster p-value at each time point.
+    cpval = np.ones(score.shape)
+    lens = iend - istart + 1
+    ioffs = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    cpval[np.repeat(iunit, lens),
+          np.repeat(istart, lens) + ioffs] = np.repeat(cl_pval, lens)
+    if is_vec:
+        cpval = cpval[0]
+
+    return cpval, clusters
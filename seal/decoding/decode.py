@@ -27,6 +27,11 @@ seed = 8257  # just a random number
 
 verbose = True
 
+nCPU = None  # number of cores to decode time points in parallel (1: serial)
+
+# Pointwise p-value threshold of cluster-mass correction of permutation test.
+clust_pth = 0.05
+
 
 # %% Core decoding functions.
 
@@ -75,7 +80,8 @@ def run_logreg(X, y, n_perm=0, n_pshfl=0, cv_obj=None, ncv=5, Cs=None,
     res = [('score', np.nan * np.zeros(ncv)), ('class_names', class_names),
            ('coef', np.nan * np.zeros((nclasspars, nfeatures))), ('C', np.nan),
            ('perm', pd.Series(np.nan, index=['mean', 'std', 'pval'])),
-           ('psdo', pd.Series(np.nan, index=['mean', 'std', 'pval']))]
+           ('psdo', pd.Series(np.nan, index=['mean', 'std', 'pval'])),
+           ('perm_scores', np.nan * np.zeros(n_perm))]
     res = util.series_from_tuple_list(res)
 
     # Check that there's at least two classes.
@@ -126,6 +132,7 @@ def run_logreg(X, y, n_perm=0, n_pshfl=0, cv_obj=None, ncv=5, Cs=None,
         res['perm']['mean'] = perm_scores.mean()
         res['perm']['std'] = perm_scores.std()
         res['perm']['pval'] = perm_p
+        res['perm_scores'] = perm_scores
 
     # Run decoding on rate matrix with trials shuffled within units.
     if n_pshfl > 0:
@@ -167,12 +174,8 @@ def pop_shfl(X, y):
 def zscore_by_cond(X, vzscore_by):
     """Z-score rate values by condition levels within each unit."""
 
-    Xc = X.copy()
-    for v, idxs in X.index.groupby(vzscore_by).items():
-        vX = Xc.loc[idxs, :]
-        mean = vX.mean()
-        std = vX.std(ddof=0)
-        Xc.loc[idxs, :] = (vX - mean)/std
+    Z = util.zscore_by_group(X.values, vzscore_by[X.index], axis=0)
+    Xc = pd.DataFrame(Z, index=X.index, columns=X.columns)
 
     return Xc
 
@@ -187,9 +190,14 @@ def separate_by_cond(X, vcond):
 
 # %% Wrappers to run decoding over time and different stimulus periods.
 
-def run_logreg_across_time(rates, vfeat, vzscore_by=None, n_perm=0,
+def run_logreg_across_time(rates, axes, vfeat, vzscore_by=None, n_perm=0,
                            n_pshfl=0, corr_trs=None, ncv=5, Cs=None):
-    """Run logistic regression analysis across trial time."""
+    """
+    Run logistic regression analysis across trial time.
+
+    rates: units x trials x time array, with axis labels in axes
+           (see ua_query.get_rate_tensor).
+    """
 
     # Correct and error trials and targets.
     if corr_trs is None:
@@ -204,14 +212,18 @@ def run_logreg_across_time(rates, vfeat, vzscore_by=None, n_perm=0,
             warnings.warn('Not enough trials to do decoding with CV')
         return
 
+    # Z-score rates by condition level, at all time points at once.
+    if vzscore_by is not None:
+        rates = util.zscore_by_group(rates, vzscore_by[axes['trials']], axis=1)
+
     # Prepare data for running analysis in pool.
     LRparams = []
     t_uids = []
-    for t, rt in rates.items():
+    for it, t in enumerate(axes['times']):
 
-        rtmat = rt.unstack().T  # get rates and format to (trial x unit) matrix
-        if vzscore_by is not None:  # z-score by condition level
-            rtmat = zscore_by_cond(rtmat, vzscore_by)
+        # Get rates in (trial x unit) matrix.
+        rtmat = pd.DataFrame(rates[:, :, it].T, index=axes['trials'],
+                             columns=axes['units'])
 
         corr_rates, err_rates = [rtmat.loc[trs]
                                  for trs in [corr_trs, err_trs]]
@@ -220,11 +232,11 @@ def run_logreg_across_time(rates, vfeat, vzscore_by=None, n_perm=0,
         t_uids.append(rtmat.columns)
 
     # Run logistic regression at each time point.
-    res = zip(*util.run_in_pool(run_logreg, LRparams))
-    lScores, lClasses, lCoefs, lC, lPerm, lPsdo = res
+    res = zip(*util.run_in_pool(run_logreg, LRparams, nCPU))
+    lScores, lClasses, lCoefs, lC, lPerm, lPsdo, lPermScores = res
 
     # Put results into series and dataframes.
-    tvec = rates.columns
+    tvec = axes['times']
     # Best regularisation parameter value.
     C = pd.Series(list(lC), index=tvec)
     # Prediction scores over time.
@@ -238,6 +250,17 @@ def run_logreg_across_time(rates, vfeat, vzscore_by=None, n_perm=0,
     Perm = pd.concat(lPerm, axis=1, keys=tvec)
     Psdo = pd.concat(lPsdo, axis=1, keys=tvec)
 
+    # Cluster-mass correction of permutation test across time, on scores
+    # relative to mean of permuted scores. Permuted labels are the same at
+    # all time points (same random seed).
+    Perm.loc['cpval'] = np.nan
+    if n_perm > 0:
+        perm_scores = np.array(lPermScores).T
+        perm_mean = perm_scores.mean(0)
+        cpval = stats.cluster_perm_test(Scores.mean() - perm_mean,
+                                        perm_scores - perm_mean, clust_pth)[0]
+        Perm.loc['cpval'] = np.where(Perm.loc['pval'].isnull(), np.nan, cpval)
+
     # Collect results.
     res = [('Scores', Scores), ('Coefs', Coefs), ('C', C),
            ('Perm', Perm), ('Psdo', Psdo)]
@@ -287,15 +310,15 @@ def run_prd_pop_dec(UA, rec, task, stim, uids, trs, feat, zscore_by,
     vzscore_by = (None if zscore_by in (None, np.nan) else
                   TrData.loc[trs].copy()[zscore_by].squeeze())
 
-    # Get FR matrix.
-    rates = ua_query.get_rate_matrix(UA, rec, task, uids, prd,
-                                     ref_ev, nrate, trs, tstep)
+    # Get FR tensor.
+    rates, axes = ua_query.get_rate_tensor(UA, rec, task, uids, prd,
+                                           ref_ev, nrate, trs, tstep)
 
     # Separate correct trials from error trials, if requested.
     corr_trs = TrData.correct[vfeat.index] if sep_err_trs else None
 
     # Run decoding.
-    dec_res = run_logreg_across_time(rates, vfeat, vzscore_by, n_perm,
+    dec_res = run_logreg_across_time(rates, axes, vfeat, vzscore_by, n_perm,
                                      n_pshfl, corr_trs, ncv, Cs)
 
     if dec_res is None:
@@ -304,8 +327,7 @@ def run_prd_pop_dec(UA, rec, task, stim, uids, trs, feat, zscore_by,
     # Add # units, trials and classes to results.
     nunits = len(dec_res['Coefs'].index.get_level_values(0).unique())
     ncls = len(dec_res['Coefs'].index.get_level_values(1).unique())
-    ntrs = (sum(corr_trs) if corr_trs is not None else
-            len(rates.index.get_level_values(1).unique()))
+    ntrs = sum(corr_trs) if corr_trs is not None else len(axes['trials'])
     if ncls == 1:  # binary case
         ncls = 2
     res = {'dec_res': dec_res, 'nunits': nunits, 'ntrs': ntrs, 'ncls': ncls}
@@ -317,13 +339,8 @@ def run_pop_dec(UA, rec, task, uids, trs, prd_pars, nrate, n_perm, n_pshfl,
                 sep_err_trs, ncv, Cs, tstep, PPDc, PADc):
     """Run population decoding on multiple periods across given trials."""
 
-    # Init.
-    r = {'Scores': [], 'Coefs': [], 'C': [], 'Perm': [], 'Psdo': []}
-    nunits, ntrs, ncls = pd.Series(), pd.Series(), pd.Series()
-
-    stims = prd_pars.index
-    tshifts, truncate_prds = [], []
-    for stim in stims:
+    stim_res = {}
+    for stim in prd_pars.index:
         print('    ' + stim)
 
         # Get params.
@@ -333,11 +350,27 @@ def run_pop_dec(UA, rec, task, uids, trs, prd_pars, nrate, n_perm, n_pshfl,
         prd, ref_ev, feat, sep_by, zscore_by, even_by, PDD_offset = pars
 
         # Run decoding.
-        res = run_prd_pop_dec(UA, rec, task, stim, uids, trs, feat, zscore_by,
-                              even_by, PDD_offset, PPDc, PADc, prd, ref_ev,
-                              nrate, n_perm, n_pshfl, sep_err_trs, ncv, Cs,
-                              tstep)
+        stim_res[stim] = run_prd_pop_dec(UA, rec, task, stim, uids, trs, feat,
+                                         zscore_by, even_by, PDD_offset, PPDc,
+                                         PADc, prd, ref_ev, nrate, n_perm,
+                                         n_pshfl, sep_err_trs, ncv, Cs, tstep)
+
+    res = concat_pop_dec_res(stim_res, prd_pars)
+
+    return res
+
+
+def concat_pop_dec_res(stim_res, prd_pars):
+    """Concatenate decoding results of multiple stimulus periods."""
+
+    # Init.
+    r = {'Scores': [], 'Coefs': [], 'C': [], 'Perm': [], 'Psdo': []}
+    nunits, ntrs, ncls = pd.Series(), pd.Series(), pd.Series()
+
+    tshifts, truncate_prds = [], []
+    for stim in prd_pars.index:
 
+        res = stim_res[stim] if stim in stim_res else None
         if res is None:
             continue
 
@@ -374,6 +407,47 @@ def run_pop_dec(UA, rec, task, uids, trs, prd_pars, nrate, n_perm, n_pshfl,
     return res
 
 
+def init_rec_task(UA, RecInfo, rec, task, sep_by, n_most_DS, PPDres):
+    """Init units, trials and population PD of recording and task."""
+
+    # Init units, trials and trial params.
+    rt = rec + (task,)
+    recinfo = RecInfo.loc[rt]
+    elec = recinfo.elec
+    uids = [rec + (elec, ic, iu) for ic, iu in recinfo.units]
+    inc_trs = recinfo.trials
+    PPDc, PADc = PPDres.loc[rt, ('PPDc', 'PADc')]
+
+    # Select n most DS units (or all if n_most_DS is 0).
+    utids = [uid + (task, ) for uid in uids]
+    n_most_DS_utids = ua_query.select_n_most_DS_units(UA, utids, n_most_DS)
+    uids = [utid[:-1] for utid in n_most_DS_utids]
+
+    # Split by value condition (optional).
+    TrData = ua_query.get_trial_params(UA, rec, task)
+    ltrs = (inc_trs.groupby(TrData[sep_by].loc[inc_trs])
+            if not util.is_null(sep_by) else {'all': inc_trs})
+    ltrs = pd.Series(ltrs)
+
+    return uids, ltrs, PPDc, PADc
+
+
+def to_decode(RecInfo, rec, task, feat):
+    """Is given feature decodable in recording and task?"""
+
+    rt = rec + (task,)
+
+    # Skip recordings that are missing or undecodable.
+    if (rt not in RecInfo.index) or (not RecInfo.loc[rt, 'nunits']):
+        return False
+
+    # Let's not decode saccade and correct/incorrect for passive task.
+    if ('Pas' in task) and (feat in ['saccade', 'correct']):
+        return False
+
+    return True
+
+
 def dec_recs_tasks(UA, RecInfo, recs, tasks, feat, stims, sep_by, zscore_by,
                    even_by, PDD_offset, res_dir, nrate, tstep, ncv, Cs,
                    n_perm, n_pshfl, sep_err_trs, n_most_DS, PPDres):
@@ -392,39 +466,14 @@ def dec_recs_tasks(UA, RecInfo, recs, tasks, feat, stims, sep_by, zscore_by,
     for rec in recs:
         print('\n' + ' '.join(rec))
         for task in tasks:
-            rt = rec + (task,)
-
-            # Skip recordings that are missing or undecodable.
-            if ((rt not in RecInfo.index) or
-                not RecInfo.loc[rt, 'nunits']):
-                continue
 
-            # Let's not decode saccade and correct/incorrect for passive task.
-            if ('Pas' in task) and (feat in ['saccade', 'correct']):
+            if not to_decode(RecInfo, rec, task, feat):
                 continue
 
             # Init.
             print('  ' + task)
-            rt_res[(rec, task)] = {}
-
-            # Init units, trials and trial params.
-            recinfo = RecInfo.loc[rt]
-            elec = recinfo.elec
-            uids = [rec + (elec, ic, iu) for ic, iu in recinfo.units]
-            inc_trs = recinfo.trials
-            PPDc, PADc = PPDres.loc[rt, ('PPDc', 'PADc')]
-
-            # Select n most DS units (or all if n_most_DS is 0).
-            utids = [uid + (task, ) for uid in uids]
-            n_most_DS_utids = ua_query.select_n_most_DS_units(UA, utids,
-                                                              n_most_DS)
-            uids = [utid[:-1] for utid in n_most_DS_utids]
-
-            # Split by value condition (optional).
-            TrData = ua_query.get_trial_params(UA, rec, task)
-            ltrs = (inc_trs.groupby(TrData[sep_by].loc[inc_trs])
-                    if not util.is_null(sep_by) else {'all': inc_trs})
-            ltrs = pd.Series(ltrs)
+            uids, ltrs, PPDc, PADc = init_rec_task(UA, RecInfo, rec, task,
+                                                   sep_by, n_most_DS, PPDres)
 
             # Decode feature in each period.
             tr_res = {}
@@ -44,6 +44,16 @@ def res_fname(res_dir, subdir, tasks, feat, nrate, ncv, Cs, n_perm, n_pshfl,
     return fres
 
 
+def job_fname(res_dir, rec, task, stim, **par_kws):
+    """Return full path to checkpoint of a single decoding sweep job."""
+
+    fres = res_fname(res_dir, 'jobs', **par_kws)
+    job_str = util.format_to_fname('_'.join(list(rec) + [task, stim]))
+    fjob = util.join([os.path.splitext(fres)[0], job_str + '.data'])
+
+    return fjob
+
+
 def fig_fname(res_dir, subdir, ext='pdf', **par_kws):
     """Return full path to decoding result with given parameters."""
 
@@ -20,6 +20,64 @@ from seal.analysis import direction
 
 # %% Unit and trial selection.
 
+# Number of set bits in each byte value.
+popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def greedy_unit_removal(IncTrsMat):
+    """
+    Iteratively remove unit yielding
+    (a) maximum trial coverage (# trials included by all remaining units),
+    (b) minimum number of trials, among those with maximum coverage.
+
+    Included trials of units are stored in packed bit matrix and number of
+    remaining units including each trial is updated incrementally. Removing
+    unit u uncovers trials included by all remaining units but u, therefore
+    coverage after removal is current coverage + popcount(almost & ~u).
+    """
+
+    uids = IncTrsMat.index
+    inc_mat = IncTrsMat.values.astype(bool)
+    n_units = len(uids)
+    n_trs = inc_mat.sum(1)
+
+    # Packed bits of included trials and per-trial counts of included units.
+    inc_bits = np.packbits(inc_mat, axis=1)
+    n_inc_u = inc_mat.sum(0)
+    uinc = np.arange(n_units)  # indices of included units
+
+    n_cov = int((n_inc_u == n_units).sum())
+    tr_covs = [('none', n_cov, n_units, n_units * n_cov)]
+    for iu in range(1, n_units):
+
+        # Number of covered trials after removing each unit.
+        almost = np.packbits(n_inc_u == len(uinc)-1)
+        n_uncov = popcount[almost & ~inc_bits[uinc]].sum(1, dtype=int)
+        ntrscov = n_cov + n_uncov
+
+        # Select and remove unit with (a) maximum trial coverage,
+        # (b) minimum number of trials.
+        maxtrscov = ntrscov.max()
+        worst_us = uinc[ntrscov == maxtrscov]  # (a)
+        iu_remove = worst_us[np.argmin(n_trs[worst_us])]  # (b)
+
+        # Update current subset of units and their trial counts.
+        uinc = uinc[uinc != iu_remove]
+        n_inc_u -= inc_mat[iu_remove]
+        n_cov = int(maxtrscov)
+        tr_covs.append((uids[iu_remove], n_cov, len(uinc),
+                        len(uinc) * n_cov))
+
+    # Add last unit.
+    if n_units:
+        tr_covs.append((uids[uinc[0]], 0, 0, 0))
+
+    columns = ['uid', 'ntrs_cov', 'n_rem_u', 'trial x units']
+    tr_covs = pd.DataFrame(tr_covs, columns=columns)
+
+    return tr_covs
+
+
 def select_units_trials(UA, utids=None, fres=None, ffig=None,
                         min_n_units=5, min_n_trs_per_unit=5):
     """
@@ -27,6 +85,7 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
 
     min_n_units: minimum number of units to keep (0: off)
     min_n_trs_per_unit: minimum number of trials per unit to keep (0: off)
+    ffig: figure file name, set to None to skip plotting.
     """
 
     print('Selecting optimal set of units and trials for decoding...')
@@ -71,10 +130,13 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
         putil.set_labels(ax, xlab, ylab, title, ytitle)
 
     # Init plotting.
-    ytitle = 1.40
-    putil.set_style('notebook', 'whitegrid')
-    fig, gsp, axs = putil.get_gs_subplots(nrow=len(rec_task), ncol=3,
-                                          subw=6, subh=4, create_axes=True)
+    to_plot = ffig is not None
+    if to_plot:
+        ytitle = 1.40
+        putil.set_style('notebook', 'whitegrid')
+        fig, gsp, axs = putil.get_gs_subplots(nrow=len(rec_task), ncol=3,
+                                              subw=6, subh=4,
+                                              create_axes=True)
 
     for i_rt, ((subj, date, task), rt_utids) in enumerate(u_rt_grpby):
         print('{} / {}: {} - {} {}'.format(i_rt+1, len(u_rt_grpby), subj,
@@ -90,10 +152,47 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
         # Create matrix of included trials of recording & task of units.
         ch_idxs = rt_utids.index.droplevel(-1).droplevel(2).droplevel(1).droplevel(0)
         n_alltrs = RecInfo.nalltrials[(subj, date, task)]
-        IncTrsMat = pd.DataFrame(np.zeros((len(ch_idxs), n_alltrs), dtype=int),
-                                 index=ch_idxs, columns=np.arange(n_alltrs)+1)
-        for ch_idx, utid in zip(ch_idxs, rt_utids):
-            IncTrsMat.loc[ch_idx].iloc[IncTrs[utid]] = 1
+        inc_mat = np.zeros((len(ch_idxs), n_alltrs), dtype=int)
+        for i, utid in enumerate(rt_utids):
+            inc_mat[i, IncTrs[utid]] = 1
+        IncTrsMat = pd.DataFrame(inc_mat, index=ch_idxs,
+                                 columns=np.arange(n_alltrs)+1)
+
+        # Calculate overlap of trials across units.
+        # How many trials will remain if we iteratively excluding units
+        # with the least overlap with the rest of the units?
+        tr_covs = greedy_unit_removal(IncTrsMat)
+        n_units = IncTrsMat.shape[0]
+
+        # Decide on which units to exclude.
+        min_n_trials = min_n_trs_per_unit * tr_covs['n_rem_u']
+        sub_tr_covs = tr_covs[(tr_covs['n_rem_u'] >= min_n_units) &
+                              (tr_covs['ntrs_cov'] >= min_n_trials)]
+
+        # If any subset of units passed above criteria.
+        rem_uids, exc_uids = pd.Series(), tr_covs.uid[1:]
+        n_tr_rem, n_tr_exc = 0, IncTrsMat.shape[1]
+        if len(sub_tr_covs.index):
+            hmax_idx = sub_tr_covs['trial x units'].idxmax()
+            rem_uids = tr_covs.uid[(hmax_idx+1):]
+            exc_uids = tr_covs.uid[1:hmax_idx+1]
+            n_tr_rem = tr_covs.ntrs_cov[hmax_idx]
+            n_tr_exc = IncTrsMat.shape[1] - n_tr_rem
+
+            # Add to UnitInfo dataframe
+            rt_utids = [(subj, date, elec, ch, ui, task)
+                        for ch, ui in rem_uids]
+            UInc[rt_utids] = True
+
+        # Add remaining units and trials to RecInfo.
+        rt = (subj, date, task)
+        RecInfo.loc[rt, ('units', 'nunits')] = list(rem_uids), len(rem_uids)
+        cov_trs = IncTrsMat.loc[list(rem_uids)].astype(bool).all()
+        inc_trs = pd.Int64Index(np.where(cov_trs)[0])
+        RecInfo.loc[rt, ('trials', 'ntrials')] = inc_trs, sum(cov_trs)
+
+        if not to_plot:
+            continue
 
         # Plot included/excluded trials after preprocessing.
         ax = axs[i_rt, 0]
@@ -102,50 +201,6 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
                  if i_rt == 0 else None)
         plot_inc_exc_trials(IncTrsMat, ax, title, ytitle, ylab=ylab)
 
-        # Calculate and plot overlap of trials across units.
-        # How many trials will remain if we iteratively excluding units
-        # with the least overlap with the rest of the units?
-        def n_cov_trs(df):  # return number of trials covered in df
-            return sum(df.all())
-
-        def calc_heuristic(df):
-            return df.shape[0] * n_cov_trs(df)
-
-        n_trs = IncTrsMat.sum(1)
-        n_units = IncTrsMat.shape[0]
-
-        # Init results DF.
-        columns = ('uid', 'ntrs_cov', 'n_rem_u', 'trial x units')
-        tr_covs = pd.DataFrame(columns=columns, index=range(n_units+1))
-        tr_covs.loc[0] = ('none', n_cov_trs(IncTrsMat), n_units,
-                          calc_heuristic(IncTrsMat))
-
-        # Subset of included units (to be updated in each iteration).
-        uinc = IncTrsMat.index.to_series()
-        for iu in range(1, len(uinc)):
-
-            # Number of covered trials after removing each unit.
-            sntrscov = pd.Series([n_cov_trs(IncTrsMat.loc[uinc.drop(uid)])
-                                  for uid in uinc], index=uinc.index)
-
-            #########################################
-            # Select and remove unit that           #
-            # (a) yields maximum trial coverage,    #
-            # (b) has minimum number of trials      #
-            #########################################
-            maxtrscov = sntrscov.max()
-            worst_us = sntrscov[sntrscov == maxtrscov].index  # (a)
-            utrs = n_trs.loc[worst_us]
-            uid_remove = utrs[(utrs == min(utrs))].index[0]   # (b)
-
-            # Update current subset of units and their trial DF.
-            uinc.drop(uid_remove, inplace=True)
-            tr_covs.loc[iu] = (uid_remove, maxtrscov, len(uinc),
-                               calc_heuristic(IncTrsMat.loc[uinc]))
-
-        # Add last unit.
-        tr_covs.iloc[-1] = (uinc[0], 0, 0, 0)
-
         # Plot covered trials against each units removed.
         ax_trc = axs[i_rt, 1]
         sns.tsplot(tr_covs['ntrs_cov'], marker='o', ms=4, color='b',
@@ -177,26 +232,6 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
         [tl.set_color('b') for tl in ax_trc.get_yticklabels()]
         ax_heur.grid(None)
 
-        # Decide on which units to exclude.
-        min_n_trials = min_n_trs_per_unit * tr_covs['n_rem_u']
-        sub_tr_covs = tr_covs[(tr_covs['n_rem_u'] >= min_n_units) &
-                              (tr_covs['ntrs_cov'] >= min_n_trials)]
-
-        # If any subset of units passed above criteria.
-        rem_uids, exc_uids = pd.Series(), tr_covs.uid[1:]
-        n_tr_rem, n_tr_exc = 0, IncTrsMat.shape[1]
-        if len(sub_tr_covs.index):
-            hmax_idx = sub_tr_covs['trial x units'].argmax()
-            rem_uids = tr_covs.uid[(hmax_idx+1):]
-            exc_uids = tr_covs.uid[1:hmax_idx+1]
-            n_tr_rem = tr_covs.ntrs_cov[hmax_idx]
-            n_tr_exc = IncTrsMat.shape[1] - n_tr_rem
-
-            # Add to UnitInfo dataframe
-            rt_utids = [(subj, date, elec, ch, ui, task)
-                        for ch, ui in rem_uids]
-            UInc[rt_utids] = True
-
         # Highlight selected point in middle plot.
         sel_seg = [('selection', exc_uids.shape[0]-0.4,
                     exc_uids.shape[0]+0.4)]
@@ -223,13 +258,6 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
                                                                  n_tr_exc))
         plot_inc_exc_trials(RemTrsMat, ax, title=title, ylab='')
 
-        # Add remaining units and trials to RecInfo.
-        rt = (subj, date, task)
-        RecInfo.loc[rt, ('units', 'nunits')] = list(rem_uids), len(rem_uids)
-        cov_trs = RemTrsMat.loc[list(rem_uids)].all()
-        inc_trs = pd.Int64Index(np.where(cov_trs)[0])
-        RecInfo.loc[rt, ('trials', 'ntrials')] = inc_trs, sum(cov_trs)
-
     RecInfo['% remaining units'] = 100 * RecInfo.nunits / RecInfo.nallunits
     RecInfo['% remaining trials'] = 100 * RecInfo.ntrials / RecInfo.nalltrials
 
@@ -239,56 +267,43 @@ def select_units_trials(UA, utids=None, fres=None, ffig=None,
         util.write_objects(results, fres)
 
     # Save plot.
-    title = 'Trial & unit selection prior decoding'
-    putil.save_fig(ffig, fig, title, w_pad=3, h_pad=3)
+    if to_plot:
+        title = 'Trial & unit selection prior decoding'
+        putil.save_fig(ffig, fig, title, w_pad=3, h_pad=3)
 
     return RecInfo, UInc
 
 
 # %% Direction selectivity analysis.
 
-def PD_across_units(UA, UInc, utids=None, fres=None, ffig=None):
+def calc_PD_across_units(UA, UInc, utids=None):
     """
-    Test consistency/spread of PD across units per recording.
-    What is the spread in the preferred directions across units?
-
-    Return population level preferred direction (and direction selectivity),
-    that can be used to determine dominant preferred direction to decode.
+    Calculate population level preferred direction (and direction
+    selectivity) of each recording and task, without plotting.
     """
 
     # Init.
     if utids is None:
         utids = UA.utids(as_series=True)
-    tasks = utids.index.get_level_values('task').unique()
-    recs = util.get_subj_date_pairs(utids)
 
     # Get DS info frame.
     DSInfo = ua_query.get_DSInfo_table(UA, utids)
     DSInfo['include'] = UInc
 
-    # Calculate population PD and DSI.
-    dPPDres = {}
-    for rec in recs:
-        for task in tasks:
-
-            # Init.
-            rt = rec + (task,)
-            rtDSInfo = DSInfo.xs(rt, level=[0, 1, -1])
-            if rtDSInfo.empty:
-                continue
+    # Calculate population PD and population DSI of all recordings and tasks
+    # at once.
+    PPDres = direction.calc_group_PPD(DSInfo, ['subj', 'date', 'task'],
+                                      'include')
 
-            # Calculate population PD and population DSI.
-            res = direction.calc_PPD(rtDSInfo.loc[rtDSInfo.include])
-            dPPDres[rt] = res
+    return DSInfo, PPDres
 
-    PPDres = pd.DataFrame(dPPDres).T
 
-    # Save results.
-    if fres is not None:
-        results = {'DSInfo': DSInfo, 'PPDres': PPDres}
-        util.write_objects(results, fres)
+def plot_PD_across_units(DSInfo, PPDres, ffig=None):
+    """Plot PD and DSI of units, and population PD of each recording."""
 
-    # Plot results.
+    # Init.
+    tasks = DSInfo.index.get_level_values('task').unique()
+    recs = util.get_subj_date_pairs(DSInfo)
 
     # Init plotting.
     putil.set_style('notebook', 'darkgrid')
@@ -340,6 +355,29 @@ def PD_across_units(UA, UInc, utids=None, fres=None, ffig=None):
     title = 'Population direction selectivity'
     putil.save_fig(ffig, fig, title, w_pad=12, h_pad=20)
 
+
+def PD_across_units(UA, UInc, utids=None, fres=None, ffig=None):
+    """
+    Test consistency/spread of PD across units per recording.
+    What is the spread in the preferred directions across units?
+
+    Return population level preferred direction (and direction selectivity),
+    that can be used to determine dominant preferred direction to decode.
+    Set ffig to None to skip plotting.
+    """
+
+    # Calculate population PD and DSI.
+    DSInfo, PPDres = calc_PD_across_units(UA, UInc, utids)
+
+    # Save results.
+    if fres is not None:
+        results = {'DSInfo': DSInfo, 'PPDres': PPDres}
+        util.write_objects(results, fres)
+
+    # Plot results.
+    if ffig is not None:
+        plot_PD_across_units(DSInfo, PPDres, ffig)
+
     return DSInfo, PPDres
 
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to schedule and run decoding analyses over a sweep of recordings,
+tasks, stimulus periods and decoding parameters.
+
+@author: David Samu
+"""
+
+import os
+import itertools
+
+import pandas as pd
+
+from seal.decoding import decode, decutil
+from seal.util import util, constants
+
+
+# Decoding parameters identifying a set of results (see decutil.res_fname).
+par_names = ['tasks', 'feat', 'nrate', 'ncv', 'Cs', 'n_perm', 'n_pshfl',
+             'sep_err_trs', 'sep_by', 'zscore_by', 'even_by', 'PDD_offset',
+             'n_most_DS', 'tstep']
+
+# Data shared by all jobs of a worker process (set by init_worker).
+_shared = {}
+
+
+# %% Functions to set up sweep.
+
+def init_sweep_pars(dec_pars, par_grid=None):
+    """
+    Return list of decoding parameter sets from fixed parameters (dec_pars)
+    and grid of parameter values to sweep over (par_grid, name: value list).
+    """
+
+    if par_grid is None:
+        par_grid = {}
+
+    grid_names = list(par_grid.keys())
+    sweep_pars = []
+    for vals in itertools.product(*[par_grid[nm] for nm in grid_names]):
+        pars = dict(dec_pars)
+        pars.update(zip(grid_names, vals))
+        sweep_pars.append({nm: pars[nm] for nm in par_names})
+
+    return sweep_pars
+
+
+def est_job_cost(RecInfo, rec, task, stim, pars):
+    """Return estimated cost (# trials x # units x # time points) of job."""
+
+    rt = rec + (task,)
+    ntrs, nunits = RecInfo.loc[rt, ['ntrials', 'nunits']]
+    if pars['n_most_DS'] != 0:
+        nunits = min(nunits, pars['n_most_DS'])
+
+    tstart, tstop = constants.fixed_tr_prds.loc[stim + ' half']
+    ntimes = float(tstop - tstart) / float(pars['tstep'])
+
+    cost = ntrs * nunits * ntimes
+
+    return cost
+
+
+def expand_sweep(RecInfo, recs, stims, res_dir, sweep_pars):
+    """
+    Expand sweep into table of (recording, task, stimulus, parameter set)
+    jobs, ordered by decreasing estimated cost.
+    """
+
+    jobs = []
+    for ipar, pars in enumerate(sweep_pars):
+        for rec in recs:
+            for task in pars['tasks']:
+
+                if not decode.to_decode(RecInfo, rec, task, pars['feat']):
+                    continue
+
+                for stim in stims:
+                    cost = est_job_cost(RecInfo, rec, task, stim, pars)
+                    fjob = decutil.job_fname(res_dir, rec, task, stim, **pars)
+                    jobs.append((ipar, rec, task, stim, cost, fjob))
+
+    cols = ['ipar', 'rec', 'task', 'stim', 'cost', 'fjob']
+    jobs = pd.DataFrame(jobs, columns=cols)
+
+    # Longest jobs first, for load balancing across workers.
+    jobs = jobs.sort_values('cost', ascending=False)
+
+    return jobs
+
+
+# %% Functions to run jobs.
+
+def init_worker(UA, RecInfo, PPDres):
+    """Init data shared by jobs run by a worker process."""
+
+    _shared['UA'] = UA
+    _shared['RecInfo'] = RecInfo
+    _shared['PPDres'] = PPDres
+
+    # Time points of jobs are decoded serially within workers.
+    decode.nCPU = 1
+
+
+def run_job(rec, task, stim, stims, pars, fjob):
+    """Run decoding job of a single stimulus period and save results."""
+
+    UA, RecInfo, PPDres = [_shared[nm] for nm in ('UA', 'RecInfo', 'PPDres')]
+
+    # Init decoding params.
+    prd_pars = util.init_stim_prds(stims, pars['feat'], pars['sep_by'],
+                                   pars['zscore_by'], pars['even_by'],
+                                   pars['PDD_offset'])
+    prd, ref_ev, feat, zscore_by, even_by, PDD_offset = prd_pars.loc[
+        stim, ['prd', 'ref_ev', 'feat', 'zscore_by', 'even_by', 'PDD_offset']]
+
+    # Init units and trials.
+    uids, ltrs, PPDc, PADc = decode.init_rec_task(UA, RecInfo, rec, task,
+                                                  pars['sep_by'],
+                                                  pars['n_most_DS'], PPDres)
+
+    # Decode feature in period for each set of trials.
+    tr_res = {}
+    for v, trs in ltrs.items():
+        tr_res[v] = decode.run_prd_pop_dec(UA, rec, task, stim, uids, trs,
+                                           feat, zscore_by, even_by,
+                                           PDD_offset, PPDc, PADc, prd,
+                                           ref_ev, pars['nrate'],
+                                           pars['n_perm'], pars['n_pshfl'],
+                                           pars['sep_err_trs'], pars['ncv'],
+                                           pars['Cs'], pars['tstep'])
+
+    # Save checkpoint.
+    util.write_objects({'tr_res': tr_res}, fjob)
+    print('  {} {} {} done'.format(' '.join(rec), task, stim))
+
+
+def collect_results(jobs, sweep_pars, stims, res_dir):
+    """Concatenate job results and save them per parameter set."""
+
+    for ipar, pjobs in jobs.groupby('ipar'):
+        pars = sweep_pars[ipar]
+        prd_pars = util.init_stim_prds(stims, pars['feat'], pars['sep_by'],
+                                       pars['zscore_by'], pars['even_by'],
+                                       pars['PDD_offset'])
+
+        rt_res = {}
+        for (rec, task), rtjobs in pjobs.groupby(['rec', 'task'], sort=False):
+
+            # Collect stimulus period results for each set of trials.
+            stim_tr_res = {stim: util.read_objects(fjob, 'tr_res')
+                           for stim, fjob in zip(rtjobs.stim, rtjobs.fjob)}
+            tr_vals = pd.unique([v for tr_res in stim_tr_res.values()
+                                 for v in tr_res.keys()])
+
+            tr_res = {}
+            for v in tr_vals:
+                stim_res = {stim: tr_res[v] for stim, tr_res
+                            in stim_tr_res.items() if v in tr_res}
+                res = decode.concat_pop_dec_res(stim_res, prd_pars)
+                if not util.is_null(res):
+                    tr_res[v] = res
+            rt_res[(rec, task)] = tr_res
+
+        fres = decutil.res_fname(res_dir, 'results', **pars)
+        util.write_objects({'rt_res': rt_res}, fres)
+
+
+def run_sweep(UA, RecInfo, PPDres, recs, stims, res_dir, dec_pars,
+              par_grid=None, nCPU=None):
+    """
+    Run decoding sweep across recordings, tasks, stimulus periods and grid of
+    decoding parameters on local process pool. Each finished job is saved, so
+    an interrupted sweep resumes with the remaining jobs when rerun.
+    """
+
+    # Init jobs.
+    sweep_pars = init_sweep_pars(dec_pars, par_grid)
+    jobs = expand_sweep(RecInfo, recs, stims, res_dir, sweep_pars)
+
+    # Skip jobs finished by an earlier run.
+    is_done = jobs.fjob.apply(os.path.isfile)
+    todo = jobs.loc[~is_done]
+    print('\nDecoding sweep: {} parameter sets, '.format(len(sweep_pars)) +
+          '{} jobs, {} already done'.format(len(jobs), is_done.sum()))
+
+    # Run remaining jobs, longest first.
+    params = [(rec, task, stim, stims, sweep_pars[ipar], fjob)
+              for ipar, rec, task, stim, fjob
+              in zip(todo.ipar, todo.rec, todo.task, todo.stim, todo.fjob)]
+    dec_nCPU = decode.nCPU  # init_worker changes it when running serially
+    util.run_in_pool(run_job, params, nCPU, chunksize=1,
+                     initializer=init_worker,
+                     initargs=(UA, RecInfo, PPDres))
+    decode.nCPU = dec_nCPU
+
+    # Concatenate and save results of each parameter set.
+    collect_results(jobs, sweep_pars, stims, res_dir)
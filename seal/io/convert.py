@@ -8,12 +8,17 @@ import os
 
 import pandas as pd
 
+from seal.io import spike_store
 from seal.util import util, constants
 from seal.object import unit, unitarray
 
 
-def task_TPL_to_Seal(f_tpl, f_seal, task, rec_info):
-    """Convert TPLCell data to Seal data of single task."""
+def task_TPL_to_Seal(f_tpl, f_seal, task, rec_info, store_dir=None):
+    """
+    Convert TPLCell data to Seal data of single task, optionally writing
+    spike times and waveforms of units into spike stores in store_dir
+    (instead of keeping waveforms in Seal data).
+    """
 
     # Load in Matlab structure (SimpleTPLCell).
     TPLCells = util.read_matlab_object(f_tpl, 'TPLStructs')
@@ -25,7 +30,7 @@ def task_TPL_to_Seal(f_tpl, f_seal, task, rec_info):
 
     # Create UnitArray (list of units) from TPLCell structures.
     kset = constants.kset
-    params = [(TPLCell, rec_info, kset) for TPLCell in TPLCells]
+    params = [(TPLCell, rec_info, kset, store_dir) for TPLCell in TPLCells]
     tUnits = util.run_in_pool(unit.Unit, params)
 
     # Add them to unit list of recording, combining all tasks.
@@ -36,8 +41,13 @@ def task_TPL_to_Seal(f_tpl, f_seal, task, rec_info):
     util.write_objects({'UnitArr': UA}, f_seal)
 
 
-def rec_TPL_to_Seal(tpl_dir, seal_dir, rec_info, excl_tasks=[]):
-    """Convert TPLCell data to Seal data in recording folder."""
+def rec_TPL_to_Seal(tpl_dir, seal_dir, rec_info, excl_tasks=[],
+                    store_dir=None):
+    """
+    Convert TPLCell data to Seal data in recording folder, with spike times
+    and waveforms of units written into spike stores in store_dir (default:
+    SpikeStore folder of recording, see spike_store.rec_store_dir).
+    """
 
     if not os.path.exists(tpl_dir):
         print('Error: Mssing TPLCell folder: ', tpl_dir)
@@ -70,8 +80,10 @@ def rec_TPL_to_Seal(tpl_dir, seal_dir, rec_info, excl_tasks=[]):
         return
 
     # Create units for each task.
+    if store_dir is None:
+        store_dir = spike_store.rec_store_dir(seal_dir)
     for task, f_tpl_cell in tasks.iteritems():
         print(' ', f_tpl_cell)
         f_tpl = tpl_dir + f_tpl_cell
         f_seal = seal_dir + f_tpl_cell[:-4] + '.data'
-        task_TPL_to_Seal(f_tpl, f_seal, task, rec_info)
+        task_TPL_to_Seal(f_tpl, f_seal, task, rec_info, store_dir)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Functions related to storing spike times and waveforms of units on disk
+(spike store), to be memory mapped instead of kept in memory.
+
+@author: David Samu
+"""
+
+import os
+
+import numpy as np
+
+from seal.util import util
+
+
+def rec_store_dir(seal_dir):
+    """
+    Return default folder of spike stores of recording (next to folder of
+    Seal data of recording).
+    """
+
+    store_dir = os.path.dirname(os.path.normpath(seal_dir)) + '/SpikeStore/'
+    return store_dir
+
+
+def spike_store_fnames(fbase):
+    """Return names of files of spike times, waveforms and waveform times."""
+
+    fnames = [fbase + '_' + name + '.npy'
+              for name in ('times', 'waveforms', 'wftimes')]
+    return fnames
+
+
+def write_spike_store(fbase, spk_times, waveforms, wf_times=None):
+    """
+    Write spike times (s), waveforms (spikes x samples) and waveform sample
+    times (us) into Numpy files, to be memory mapped by open_spike_store.
+    """
+
+    if wf_times is None:
+        wf_times = np.array(waveforms.columns)
+
+    ftimes, fwfs, fwftimes = spike_store_fnames(fbase)
+    util.create_dir(ftimes)
+    np.save(ftimes, np.array(spk_times, dtype=float))
+    np.save(fwfs, np.array(waveforms, dtype=np.float32))
+    np.save(fwftimes, np.array(wf_times))
+
+
+def has_spike_store(fbase):
+    """Check if all files of spike store exist."""
+
+    has_store = all([os.path.exists(f) for f in spike_store_fnames(fbase)])
+    return has_store
+
+
+def open_spike_store(fbase):
+    """Return memory mapped spike times, waveforms and waveform times."""
+
+    ftimes, fwfs, fwftimes = spike_store_fnames(fbase)
+    spk_times = np.load(ftimes, mmap_mode='r')
+    waveforms = np.load(fwfs, mmap_mode='r')
+    wf_times = np.load(fwftimes)
+
+    return spk_times, waveforms, wf_times
@@ -159,3 +159,71 @@ class Rate:
         rates = rates.loc[:, n_non_nan_trs >= min_non_nan_trs]
 
         return rates
+
+    # %% Methods to get rates of trials as Numpy arrays.
+
+    def get_sample_idxs(self, trs, t1s, t2s, ref_ts=None, tstep=None):
+        """
+        Return indices to sample rates of some trials within trial-specific
+        time windows, aligned to reference times, onto a common time vector.
+
+        Sampling indices only depend on the time vector of rates, therefore
+        they can be reused across units sharing trial events and rate kernel.
+
+        Returns sample indices (trials x samples, -1: no sample), their column
+        index in the common time vector and the common time vector (ms).
+        """
+
+        if tstep is None:
+            tstep = self.step
+        istep = int(tstep/self.step)
+        tv = np.array(self.tvec)
+
+        # Index of sample nearest to each time point.
+        def nearest_idx(ts):
+            ts = util.remove_dim_from_array(np.array(ts), float)
+            idx = np.clip(np.searchsorted(tv, ts), 1, len(tv)-1)
+            ileft = (ts - tv[idx-1]) <= (tv[idx] - ts)
+            idx[ileft] = idx[ileft] - 1
+            return idx
+
+        # Sampled time limits and reference times per trial.
+        i1s, i2s = [nearest_idx(ts[trs]) for ts in (t1s, t2s)]
+        irefs = nearest_idx(ref_ts[trs]) if ref_ts is not None else i1s
+
+        # Sample indices and their offsets to reference time.
+        nsmpl = (i2s - i1s) // istep + 1
+        ksmpl = istep * np.arange(max(nsmpl.max(), 0))
+        smpl_idxs = i1s[:, None] + ksmpl[None, :]
+        offsets = smpl_idxs - irefs[:, None]
+        is_smpl = ksmpl[None, :] < (istep * nsmpl[:, None])
+
+        # Common time vector and column index of each sample.
+        col_offsets = np.unique(offsets[is_smpl])
+        col_idxs = np.searchsorted(col_offsets, offsets)
+        smpl_idxs[~is_smpl] = -1
+        col_idxs[~is_smpl] = -1
+        tvec = col_offsets * float(self.step.rescale(ms))
+
+        return smpl_idxs, col_idxs, tvec
+
+    def get_rates_array(self, trs, smpl_idxs, col_idxs, ntimes,
+                        dtype=np.float32, out=None):
+        """
+        Return firing rates of some trials in trials x time array, sampled by
+        indices returned by get_sample_idxs. Unsampled values are NaN.
+        """
+
+        if out is None:
+            out = np.empty((len(trs), ntimes), dtype=dtype)
+        out[:] = np.nan
+
+        # Select rates of trials and copy samples into their time column.
+        itrs = self.rates.index.get_indexer(trs)
+        rates = self.rates.values
+        is_smpl = smpl_idxs >= 0
+        rows = np.broadcast_to(np.arange(len(trs))[:, None], smpl_idxs.shape)
+        out[rows[is_smpl], col_idxs[is_smpl]] = rates[itrs[rows[is_smpl]],
+                                                      smpl_idxs[is_smpl]]
+
+        return out
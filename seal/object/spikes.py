@@ -10,7 +10,6 @@ import numpy as np
 import pandas as pd
 from quantities import s, ms
 from neo import SpikeTrain
-from elephant import statistics
 
 from seal.util import util
 
@@ -99,6 +98,21 @@ class Spikes:
 
         return spk_trains
 
+    def get_csr(self, trs=None, dim=s):
+        """
+        Return spike times (in given dimension, without dimension) of given
+        trials concatenated into single array, and index of first spike of
+        each trial (and end of last trial) in it (compressed sparse rows).
+        """
+
+        trs = self.init_trials(trs)
+        spk_trs = [np.array(self.spk_trains[itr].rescale(dim), dtype=float)
+                   for itr in trs]
+
+        spk_times, offsets = util.concat_segments(spk_trs)
+
+        return spk_times, offsets
+
     # %% Methods for summary statistics over spikes.
 
     def n_spikes(self, trs=None, t1s=None, t2s=None):
@@ -134,9 +148,25 @@ class Spikes:
         return rates
 
     def isi(self, trs=None, t1s=None, t2s=None):
-        """Return interspike intervals per trial."""
+        """
+        Return interspike intervals (in ms, without dimension) within time
+        windows of given trials concatenated into single array, and index of
+        first interval of each trial (and end of last trial) in it.
+        """
+
+        trs = self.init_trials(trs)
+        t1s, t2s, _ = self.init_time_limits(t1s, t2s)
+        spk_times, offsets = self.get_csr(trs, ms)
+
+        # Select spikes within time windows.
+        t1s_ms, t2s_ms = [np.array(util.remove_dim_from_series(
+                                   util.rescale_series(ts[trs], ms)),
+                                   dtype=float) for ts in (t1s, t2s)]
+        iseg = util.segment_idxs(offsets)
+        in_wndw = (spk_times >= t1s_ms[iseg]) & (spk_times <= t2s_ms[iseg])
+        offsets[1:] = np.cumsum(np.bincount(iseg[in_wndw],
+                                            minlength=len(trs)))
 
-        spks = self.get_spikes(trs, t1s, t2s)
-        isi = [statistics.isi(spk) for spk in spks]
+        isi, isi_offsets = util.segment_diff(spk_times[in_wndw], offsets)
 
-        return isi
+        return isi, isi_offsets
@@ -11,6 +11,7 @@ import numpy as np
 import pandas as pd
 from quantities import s, ms, us, deg, Hz
 
+from seal.io import spike_store
 from seal.util import util, constants
 from seal.object.rate import Rate
 from seal.object.spikes import Spikes
@@ -21,8 +22,13 @@ class Unit:
     """Generic class to store data of a unit (neuron or group of neurons)."""
 
     # %% Constructor
-    def __init__(self, TPLCell=None, rec_info=None, kset=None):
-        """Create Unit instance from TPLCell data structure."""
+    def __init__(self, TPLCell=None, rec_info=None, kset=None,
+                 store_dir=None):
+        """
+        Create Unit instance from TPLCell data structure. If store_dir is
+        given, spike times and waveforms are written into spike store in
+        folder, and waveforms are not kept in memory (see get_waveforms).
+        """
 
         # Create empty instance.
         self.Name = ''
@@ -260,6 +266,11 @@ class Unit:
         for name, (kernel, step) in kset.iterrows():
             self.add_rate(name, kernel, step)
 
+        # %% Spike store.
+
+        if store_dir is not None:
+            self.save_spike_store(store_dir)
+
     # %% Utility methods.
 
     def is_empty(self):
@@ -468,6 +479,72 @@ class Unit:
 
         return sorted_vals
 
+    # %% Methods to access waveforms, in memory or in spike store.
+
+    def get_spike_store(self):
+        """Return base name of spike store files of unit (None if none)."""
+
+        fbase = self.SessParams.get('spike_store')
+        if fbase is None or not spike_store.has_spike_store(fbase):
+            return None
+
+        return fbase
+
+    def save_spike_store(self, store_dir):
+        """
+        Write spike times and waveforms of unit into spike store in folder,
+        and drop waveforms from memory.
+        """
+
+        fbase = store_dir + self.name_to_fname()
+        spk_times = np.array(self.SpikeParams['time'], dtype=float)
+        spike_store.write_spike_store(fbase, spk_times, self.Waveforms)
+        self.SessParams['spike_store'] = fbase
+        self.drop_waveforms()
+
+    def drop_waveforms(self):
+        """Drop waveforms from memory, if they are kept in spike store."""
+
+        if self.get_spike_store() is not None:
+            self.Waveforms = self.Waveforms.iloc[:0]
+
+    def waveforms_in_memory(self):
+        """Are waveforms of unit kept in memory?"""
+
+        in_mem = (self.get_spike_store() is None or
+                  len(self.Waveforms.index) > 0)
+        return in_mem
+
+    def waveform_array(self):
+        """
+        Return waveforms of unit (spikes x samples) as array, memory mapped
+        from spike store if not kept in memory.
+        """
+
+        if self.waveforms_in_memory():
+            return np.array(self.Waveforms)
+
+        waveforms = spike_store.open_spike_store(self.get_spike_store())[1]
+        return waveforms
+
+    def get_waveforms(self):
+        """
+        Return waveforms of unit, read from spike store if not kept in
+        memory.
+        """
+
+        if self.waveforms_in_memory():
+            return self.Waveforms
+
+        waveforms = pd.DataFrame(np.array(self.waveform_array(), dtype=float),
+                                 columns=self.Waveforms.columns)
+        return waveforms
+
+    def load_waveforms(self):
+        """Load waveforms of unit from spike store into memory."""
+
+        self.Waveforms = self.get_waveforms()
+
     # %% Methods to get times of trial events and periods.
 
     def ev_times(self, evname, trs=None, add_latency=False):
@@ -6,12 +6,14 @@ Functions to plot area under the curve (AUC) values over time.
 @author: David Samu
 """
 
+import warnings
+
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
-from seal.util import util
 from seal.plot import putil, pplot
+from seal.roc import rocutil
 
 
 def plot_auc_over_time(auc, tvec, prds=None, evts=None, xlim=None, ylim=None,
@@ -51,23 +53,61 @@ def plot_auc_over_time(auc, tvec, prds=None, evts=None, xlim=None, ylim=None,
     return ax
 
 
+def downsample_mat(mat, max_nrow, max_ncol):
+    """
+    Downsample matrix (DataFrame) by averaging blocks of rows and columns to
+    have at most max_nrow rows and max_ncol columns. Blocks are labelled by
+    their first row and column. Returns downsampled matrix and block sizes.
+    """
+
+    nrow, ncol = mat.shape
+    rfac, cfac = [max(int(np.ceil(n / nmax)), 1)
+                  for n, nmax in [(nrow, max_nrow), (ncol, max_ncol)]]
+    if rfac == 1 and cfac == 1:
+        return mat, rfac, cfac
+
+    # Pad matrix with NaNs to multiple of block sizes and average blocks.
+    nr, nc = -(-nrow // rfac), -(-ncol // cfac)
+    X = np.full((nr*rfac, nc*cfac), np.nan)
+    X[:nrow, :ncol] = mat.values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN blocks
+        X = np.nanmean(X.reshape((nr, rfac, nc, cfac)), axis=(1, 3))
+    dmat = pd.DataFrame(X, index=mat.index[::rfac],
+                        columns=mat.columns[::cfac])
+
+    return dmat, rfac, cfac
+
+
 def plot_auc_heatmap(aroc_mat, cmap='viridis', events=None, xlbl_freq=500,
                      ylbl_freq=10, xlab='time', ylab='unit index',
-                     title='AROC over time', ffig=None, fig=None):
-    """Plot ROC AUC of list of units on heatmap."""
+                     title='AROC over time', max_nrow=1000, max_ncol=1000,
+                     ffig=None, fig=None):
+    """
+    Plot ROC AUC of list of units on heatmap. Matrices larger than
+    max_nrow x max_ncol are downsampled (see downsample_mat) and rasterized.
+    """
 
     fig = putil.figure(fig)
 
+    # Downsample large matrix to about the resolution of figure.
+    tvec = aroc_mat.columns
+    aroc_mat = aroc_mat.copy()
+    aroc_mat.index = np.arange(len(aroc_mat.index)) + 1
+    aroc_mat, rfac, cfac = downsample_mat(aroc_mat, max_nrow, max_ncol)
+
     # Plot heatmap.
-    yticklabels = np.arange(len(aroc_mat.index)) + 1
     ax = pplot.heatmap(aroc_mat, vmin=0, vmax=1, cmap=cmap, xlab=xlab,
-                       ylab=ylab, title=title, yticklabels=yticklabels)
+                       ylab=ylab, title=title, yticklabels=aroc_mat.index,
+                       rasterized=(rfac > 1 or cfac > 1))
 
     # Format labels.
-    xlbls = pd.Series(aroc_mat.columns.map(str))
-    xlbls[aroc_mat.columns % xlbl_freq != 0] = ''
+    xlbls = pd.Series('', index=np.arange(len(aroc_mat.columns)))
+    is_lbl = np.array(tvec % xlbl_freq == 0)
+    xlbls.iloc[np.where(is_lbl)[0] // cfac] = tvec[is_lbl].map(str).values
     putil.set_xtick_labels(ax, lbls=xlbls)
     putil.rot_xtick_labels(ax, rot=0, ha='center')
+    ylbl_freq = max(ylbl_freq // rfac, 1)
     putil.sparsify_tick_labels(fig, ax, 'y', istart=ylbl_freq-1,
                                freq=ylbl_freq, reverse=True)
     putil.hide_tick_marks(ax)
@@ -75,6 +115,8 @@ def plot_auc_heatmap(aroc_mat, cmap='viridis', events=None, xlbl_freq=500,
 
     # Plot events.
     if events is not None:
+        events = events.copy()
+        events['time'] = events['time'] // cfac
         putil.plot_events(events, add_names=False, color='black', alpha=0.3,
                           ls='-', lw=1, ax=ax)
 
@@ -89,7 +131,7 @@ def plot_ROC_mean(d_faroc, t1=None, t2=None, ylim=None, colors=None,
     # Import results.
     d_aroc = {}
     for name, faroc in d_faroc.items():
-        aroc = util.read_objects(faroc, 'aroc')
+        aroc = rocutil.load_aroc_file(faroc)['aroc']
         d_aroc[name] = aroc.unstack().T
 
     # Format results.
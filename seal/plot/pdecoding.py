@@ -43,7 +43,7 @@ def plot_score_set(Scores, ax=None, time='time', value='score', unit='fold',
 
 
 def plot_mean_std_sdiff(x, ymean, ystd, pval, pth=0.01, color='b', lw=4,
-                        ax=None):
+                        two_tailed=True, ax=None):
     """Plot mean +- std and significant difference for permuted results."""
 
     # Plot mean +- std.
@@ -54,7 +54,9 @@ def plot_mean_std_sdiff(x, ymean, ystd, pval, pth=0.01, color='b', lw=4,
 
     # Add bars for significance periods.
     # Two tailed test: p >= 1-pth also counts as significant!
-    tsign = pd.concat([pval <= pth, pval >= 1-pth], axis=1).any(axis=1)
+    tsign = pval <= pth
+    if two_tailed:
+        tsign = pd.concat([tsign, pval >= 1-pth], axis=1).any(axis=1)
     sign_prds = stats.periods(tsign)
     putil.plot_signif_prds(sign_prds, color=color,
                            linewidth=lw, ax=ax)
@@ -65,8 +67,13 @@ def plot_mean_std_sdiff(x, ymean, ystd, pval, pth=0.01, color='b', lw=4,
 def plot_scores(ax, Scores, Perm=None, Psdo=None, nvals=None, prds=None,
                 col='b', perm_col='grey', psdo_col='g', xlim=None,
                 ylim=ylim_scr, xlab=tlab, ylab=ylab_scr, title='',
-                ytitle=1.04):
-    """Plot decoding accuracy results."""
+                ytitle=1.04, clust_corr=False):
+    """
+    Plot decoding accuracy results.
+
+    clust_corr: show significance of permutation test by cluster corrected
+                p-values (if available) instead of pointwise ones.
+    """
 
     lgn_patches = []
 
@@ -74,8 +81,11 @@ def plot_scores(ax, Scores, Perm=None, Psdo=None, nvals=None, prds=None,
     if not util.is_null(Perm) and not Perm.isnull().all().all():
         x, pval = Perm.columns, Perm.loc['pval']
         ymean, ystd = Perm.loc['mean'], Perm.loc['std']
+        use_cpval = clust_corr and 'cpval' in Perm.index
+        if use_cpval:
+            pval = Perm.loc['cpval']
         plot_mean_std_sdiff(x, ymean, ystd, pval, pth=0.01, lw=6,
-                            color=perm_col, ax=ax)
+                            color=perm_col, two_tailed=not use_cpval, ax=ax)
         lgn_patches.append(putil.get_artist('permuted', perm_col))
 
     # Plot population shuffled results (if exist).
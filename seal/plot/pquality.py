@@ -8,7 +8,7 @@ Functions to plot quality metrics of units  after spike sorting.
 import numpy as np
 import pandas as pd
 
-from quantities import us
+from quantities import us, ms
 
 from seal.plot import putil, pplot, pwaveform
 from seal.quality import test_sorting
@@ -18,12 +18,27 @@ from seal.util import util
 # %% Plot quality metrics.
 
 def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
-            add_lbls=False, ftempl=None, fig=None, sps=None):
-    """Plot quality metrics related figures."""
+            isi_hist=None, acg=None, wf_sample=None, add_lbls=False,
+            ftempl=None, fig=None, sps=None):
+    """
+    Plot quality metrics related figures.
+
+    isi_hist, acg: ISI histogram and autocorrelogram of included spikes
+                   (Series indexed by bin centers in ms, see
+                   test_sorting.isi_stats_units).
+    wf_sample: random sample of included waveforms (indexed by spike index),
+               to plot instead of all waveforms (see stream_qm.stream_qm).
+    """
 
     # Init values.
-    waveforms = np.array(u.Waveforms)
-    wavetime = u.Waveforms.columns * us
+    if wf_sample is None:
+        wfs = u.get_waveforms()
+        wf_idx = np.arange(len(wfs.index))
+    else:
+        wfs = wf_sample
+        wf_idx = np.array(wf_sample.index)
+    waveforms = np.array(wfs)
+    wavetime = wfs.columns * us
     spk_times = np.array(u.SpikeParams['time'], dtype=float)
     base_rate = u.QualityMetrics['baseline']
 
@@ -51,10 +66,11 @@ def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
     putil.set_labels(ax=info_ax, title=title, ytitle=0.80)
 
     # Create axes.
-    gsp = putil.embed_gsp(qm_sps, 3, 2, wspace=0.3, hspace=0.4)
+    gsp = putil.embed_gsp(qm_sps, 4, 2, wspace=0.3, hspace=0.4)
     ax_wf_inc, ax_wf_exc = [fig.add_subplot(gsp[0, i]) for i in (0, 1)]
     ax_wf_amp, ax_wf_dur = [fig.add_subplot(gsp[1, i]) for i in (0, 1)]
     ax_amp_dur, ax_rate = [fig.add_subplot(gsp[2, i]) for i in (0, 1)]
+    ax_isi, ax_acg = [fig.add_subplot(gsp[3, i]) for i in (0, 1)]
 
     # Trial markers.
     trial_starts, trial_stops = u.TrData.TrialStart, u.TrData.TrialStop
@@ -88,7 +104,12 @@ def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
 
     # Plot included and excluded waveforms on different axes.
     # Color included by occurance in session time to help detect drifts.
-    s_waveforms, s_spk_cols = waveforms[spk_order, :], spk_cols[spk_order]
+    # Only waveforms available (all, or sample) are plotted.
+    wf_pos = np.full(len(spk_times), -1)
+    wf_pos[wf_idx] = np.arange(len(wf_idx))
+    wf_order = spk_order[wf_pos[spk_order] >= 0]
+    s_waveforms = waveforms[wf_pos[wf_order], :]
+    s_spk_cols = spk_cols[wf_order]
     wf_t_lim, glim = [min(spk_t), max(spk_t)], [gmin, gmax]
     wf_t_lab, volt_lab = 'WF time ($\mu$s)', 'Voltage'
     for st in ('Included', 'Excluded'):
@@ -100,7 +121,7 @@ def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
         title = '{} WFs, {} spikes, {} trials'.format(st, nspsk, ntrs)
 
         # Select waveforms and colors.
-        rand_spk_idx = spk_idx[spk_order]
+        rand_spk_idx = spk_idx[wf_order]
         wfs = s_waveforms[rand_spk_idx, :]
         cols = s_spk_cols[rand_spk_idx]
 
@@ -193,6 +214,29 @@ def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
         excl_prds.append(('end', prd_tstop, tstop))
     putil.plot_periods(excl_prds, ymax=0.92, ax=ax_rate)
 
+    # %% ISI histogram and autocorrelogram.
+
+    if isi_hist is None or acg is None:
+        isi_res = test_sorting.isi_stats_units([spk_times[spk_inc]])
+        isi_hist, acg = isi_res[1].iloc[0], isi_res[2].iloc[0]
+
+    # ISI histogram, with ISI violation threshold.
+    isi_th = float(test_sorting.ISI_TH.rescale(ms))
+    width = isi_hist.index[1] - isi_hist.index[0]
+    xlab, ylab = ('ISI (ms)', 'n') if add_lbls else (None, None)
+    pplot.bars(isi_hist.index, isi_hist, width=width, color='grey',
+               xlim=[0, isi_hist.index.max()+width/2], title='ISI histogram',
+               xlab=xlab, ylab=ylab, ax=ax_isi)
+    ax_isi.axvline(isi_th, color='r', ls='--', lw=1)
+
+    # Autocorrelogram.
+    width = acg.index[1] - acg.index[0]
+    lag_lim = acg.index.max() + width/2
+    xlab, ylab = ('Lag (ms)', 'n') if add_lbls else (None, None)
+    pplot.bars(acg.index, acg, width=width, color='grey',
+               xlim=[-lag_lim, lag_lim], title='Autocorrelogram',
+               xlab=xlab, ylab=ylab, ax=ax_acg)
+
     # %% Post-formatting.
 
     # Maximize number of ticks on recording time axes to prevent covering.
@@ -205,4 +249,5 @@ def plot_qm(u, bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc,
         putil.save_fig(fname, fig, title, rect_height=0.92)
         putil.inline_on()
 
-    return [ax_wf_inc, ax_wf_exc], ax_wf_amp, ax_wf_dur, ax_amp_dur, ax_rate
+    return ([ax_wf_inc, ax_wf_exc], ax_wf_amp, ax_wf_dur, ax_amp_dur, ax_rate,
+            ax_isi, ax_acg)
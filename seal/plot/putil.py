@@ -915,3 +915,11 @@ def inline_on():
 def inline_off():
     """Turn off inline plotting."""
     plt.ioff()
+
+
+def use_agg_backend():
+    """
+    Switch to non-interactive Agg backend, e.g. in worker processes rendering
+    figures into files.
+    """
+    plt.switch_backend('Agg')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to calculate interspike interval (ISI) statistics, ISI histograms
+and autocorrelograms of many units at once, on spike times of all units
+concatenated into a single array (compressed sparse rows, CSR).
+
+@author: David Samu
+"""
+
+import numpy as np
+
+from seal.util import util
+from seal.analysis import correlogram
+
+
+# Constants.
+isi_bins = np.arange(0, 50.5, 0.5)  # bin edges of ISI histograms (ms)
+acg_bins = np.arange(-50.5, 51)     # bin edges of autocorrelograms (ms)
+
+
+# %% Spike store.
+
+def spike_csr(spk_times_list):
+    """
+    Return spike times of units (list of arrays, in s) concatenated into
+    single array (in ms), and index of first spike of each unit (and end of
+    last one) in it.
+    """
+
+    spk_times_list = [1000 * np.array(spk_times, dtype=float)
+                      for spk_times in spk_times_list]
+    spk_times, offsets = util.concat_segments(spk_times_list)
+
+    return spk_times, offsets
+
+
+# %% ISI statistics.
+
+def isi_counts(spk_times, offsets, isi_th):
+    """
+    Return number of spikes, number of ISIs shorter than threshold (ms) and
+    length of recording (between first and last spike, in ms) of each unit.
+    """
+
+    # ISIs of all units.
+    isi, isi_offsets = util.segment_diff(spk_times, offsets)
+    iseg = util.segment_idxs(isi_offsets)
+    nseg = len(offsets) - 1
+
+    nspikes = np.diff(offsets)
+    n_ISI_vr = np.bincount(iseg[isi < isi_th], minlength=nseg)
+
+    # Spike times are sorted within units.
+    T = np.zeros(nseg)
+    has_spk = nspikes > 0
+    T[has_spk] = (spk_times[offsets[1:][has_spk]-1] -
+                  spk_times[offsets[:-1][has_spk]])
+
+    return nspikes, n_ISI_vr, T
+
+
+# %% Histograms.
+
+def isi_histograms(spk_times, offsets, bins=isi_bins):
+    """Return ISI histogram of each unit (units x bins)."""
+
+    isi, isi_offsets = util.segment_diff(spk_times, offsets)
+    iseg = util.segment_idxs(isi_offsets)
+    hists = util.segment_histograms(isi, iseg, len(offsets)-1, bins)
+
+    return hists
+
+
+def autocorrelograms(spk_times, offsets, bins=acg_bins):
+    """Return autocorrelogram of each unit (units x bins)."""
+
+    acgs = correlogram.autocorrelograms(spk_times, offsets, bins)
+    return acgs
+
+
+def bin_centers(bins):
+    """Return centers of bins."""
+
+    return (bins[:-1] + bins[1:]) / 2
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to calculate quality metrics of units (SNR, ISIvr, etc) on spikes
+streamed chunk by chunk from disk, in bounded memory.
+
+During quality control (test_units.quality_test), waveforms of units with
+spike store (written at conversion, see Unit.save_spike_store) are streamed
+from it by stream_unit_qm, instead of being loaded into memory.
+
+@author: David Samu
+"""
+
+import numpy as np
+import pandas as pd
+from quantities import s, ms
+
+from seal.io import spike_store
+from seal.util import util
+from seal.quality import test_sorting
+
+
+# Constants.
+seed = 8257          # just a random number
+chunk_size = 100000  # number of spikes to process at once
+n_reservoir = 1000   # number of waveforms to sample for plotting
+
+
+# %% Streaming spikes from disk.
+
+def iter_chunks(spk_times, waveforms, csize=chunk_size):
+    """
+    Iterate through chunks of spikes (e.g. of memory mapped arrays),
+    yielding index of first spike, spike times and waveforms of each chunk.
+    """
+
+    for i in range(0, len(spk_times), csize):
+        times = np.array(spk_times[i:i+csize], dtype=float)
+        wfs = np.array(waveforms[i:i+csize], dtype=float)
+        yield i, times, wfs
+
+
+# %% Online estimators.
+
+def welford_init(nsmpl):
+    """Init running mean and sum of squared deviations of waveforms."""
+
+    state = {'n': 0, 'mean': np.zeros(nsmpl), 'M2': np.zeros(nsmpl)}
+    return state
+
+
+def welford_update(state, wfs):
+    """
+    Update running mean and sum of squared deviations of each sample with
+    chunk of waveforms (merging statistics of chunk by Chan et al.'s
+    parallel version of Welford's algorithm).
+    """
+
+    nb = len(wfs)
+    if not nb:
+        return
+
+    na, n = state['n'], state['n'] + nb
+    mean_b = wfs.mean(0)
+    M2_b = ((wfs - mean_b)**2).sum(0)
+    delta = mean_b - state['mean']
+
+    state['mean'] = state['mean'] + delta * nb / n
+    state['M2'] = state['M2'] + M2_b + delta**2 * na * nb / n
+    state['n'] = n
+
+
+def welford_snr(state):
+    """
+    Return SNR of waveforms from running statistics (same as
+    test_sorting.calc_snr): std of mean waveform divided by std of residual
+    waveforms (noise).
+    """
+
+    n, nsmpl = state['n'], len(state['mean'])
+    if n < 2:
+        return np.nan
+
+    # Residuals have zero mean at each sample.
+    res_std = np.sqrt(state['M2'].sum() / (n * nsmpl))
+    snr = state['mean'].std(ddof=1) / res_std
+
+    return snr
+
+
+def isi_counter_init():
+    """Init running count of spikes and ISI violations."""
+
+    state = {'n': 0, 'n_ISI_vr': 0, 'tfirst': np.nan, 'tlast': np.nan}
+    return state
+
+
+def isi_counter_update(state, spk_times):
+    """Update running ISI violation count with chunk of sorted spike times."""
+
+    if not len(spk_times):
+        return
+
+    # ISIs within chunk and to last spike of previous chunk.
+    isi_th = float(test_sorting.ISI_TH.rescale(ms)) / 1000
+    isi = np.diff(spk_times)
+    if state['n']:
+        isi = np.append(spk_times[0] - state['tlast'], isi)
+    else:
+        state['tfirst'] = spk_times[0]
+
+    state['n_ISI_vr'] += int((isi < isi_th).sum())
+    state['n'] += len(spk_times)
+    state['tlast'] = spk_times[-1]
+
+
+def isi_counter_stats(state):
+    """
+    Return percent of ISI violations and percent of spikes estimated to
+    originate from single unit from running count (see
+    test_sorting.isi_stats).
+    """
+
+    N = state['n']
+
+    # No spike: ISI v.r. and TrueSpikes no calculable.
+    if not N:
+        return np.nan, np.nan
+
+    # Only one spike: ISI v.r. is 0%, TrueSpikes is 100%.
+    if N == 1:
+        return 0, 100
+
+    percent_ISI_vr = 100 * state['n_ISI_vr'] / (N - 1)
+    T = 1000 * (state['tlast'] - state['tfirst'])
+    true_spikes = test_sorting.hill_true_spikes(state['n_ISI_vr'], N, T)
+
+    return percent_ISI_vr, true_spikes
+
+
+def reservoir_init(k, nsmpl):
+    """Init reservoir sample of k waveforms."""
+
+    state = {'n': 0, 'idx': np.zeros(k, dtype=int),
+             'wfs': np.zeros((k, nsmpl))}
+    return state
+
+
+def reservoir_update(state, wfs, spk_idxs, rng):
+    """
+    Update uniform random sample of waveforms (and their spike indices) with
+    chunk of waveforms (Algorithm R, vectorized within chunk).
+    """
+
+    k, n, nb = len(state['idx']), state['n'], len(wfs)
+
+    # Fill reservoir first.
+    nfill = min(max(k - n, 0), nb)
+    state['idx'][n:n+nfill] = spk_idxs[:nfill]
+    state['wfs'][n:n+nfill] = wfs[:nfill]
+
+    # Then each following spike replaces a random item with probability
+    # k/(i+1), keeping last replacement of each item within chunk.
+    ispk = np.arange(nfill, nb)
+    irepl = np.floor(rng.rand(len(ispk)) * (n + ispk + 1)).astype(int)
+    ispk, irepl = ispk[irepl < k], irepl[irepl < k]
+    irepl, ilast = np.unique(irepl[::-1], return_index=True)
+    ispk = ispk[::-1][ilast]
+    state['idx'][irepl] = spk_idxs[ispk]
+    state['wfs'][irepl] = wfs[ispk]
+
+    state['n'] = n + nb
+
+
+# %% Streaming quality metrics.
+
+def stream_qm(spk_times, waveforms, wf_times, tstart=None, tstop=None,
+              csize=chunk_size, k=n_reservoir, seed=seed, wf_stats=False):
+    """
+    Calculate quality metrics of unit on spikes (sorted spike times in s,
+    waveforms: spikes x samples, e.g. memory mapped by
+    spike_store.open_spike_store),
+    streamed chunk by chunk. SNR, ISI statistics and mean waveform duration
+    are calculated on spikes between tstart and tstop (included spikes, see
+    test_sorting.test_drift), waveform truncation on all spikes.
+
+    Returns quality metrics and random sample of included waveforms (for
+    plotting), and optionally (wf_stats) waveform statistics of each spike
+    (see test_sorting.calc_waveform_stats).
+    """
+
+    tstart = -np.inf if tstart is None else tstart
+    tstop = np.inf if tstop is None else tstop
+    nsmpl = len(wf_times)
+
+    # First pass: voltage range, SNR, ISI violations and waveform sample.
+    minV, maxV, nminV, nmaxV = np.inf, -np.inf, 0, 0
+    wf_state = welford_init(nsmpl)
+    isi_state = isi_counter_init()
+    res_state = reservoir_init(k, nsmpl)
+    rng = np.random.RandomState(seed)
+    for i, times, wfs in iter_chunks(spk_times, waveforms, csize):
+
+        # Running minimum and maximum voltage and their counts.
+        if wfs.min() < minV:
+            minV, nminV = wfs.min(), 0
+        if wfs.max() > maxV:
+            maxV, nmaxV = wfs.max(), 0
+        nminV += (wfs == minV).sum()
+        nmaxV += (wfs == maxV).sum()
+
+        # Statistics of included spikes.
+        is_inc = (times >= tstart) & (times <= tstop)
+        welford_update(wf_state, wfs[is_inc])
+        isi_counter_update(isi_state, times[is_inc])
+        reservoir_update(res_state, wfs[is_inc], i + np.where(is_inc)[0], rng)
+
+    # Second pass: mean waveform duration of included spikes (and waveform
+    # statistics of all spikes, if requested).
+    sum_dur, n_dur, stats_list = 0., 0, []
+    for i, times, wfs in iter_chunks(spk_times, waveforms, csize):
+        is_inc = (times >= tstart) & (times <= tstop)
+        if not wf_stats:
+            wfs = wfs[is_inc]
+        wfs = pd.DataFrame(wfs, columns=wf_times)
+        cstats = test_sorting.calc_waveform_stats(wfs, minV=minV,
+                                                  maxV=maxV)[0]
+        dur = cstats['duration'][is_inc] if wf_stats else cstats['duration']
+        sum_dur += dur.sum()
+        n_dur += dur.count()
+        if wf_stats:
+            cstats.index = i + np.arange(len(times))
+            stats_list.append(cstats)
+
+    # Collect results.
+    ISIvr, true_spikes = isi_counter_stats(isi_state)
+    qm = pd.Series([welford_snr(wf_state), sum_dur / n_dur if n_dur else
+                    np.nan, ISIvr, true_spikes, minV, maxV,
+                    nminV > 1 or nmaxV > 1],
+                   index=['SNR', 'mWfDur', 'ISIvr', 'TrueSpikes', 'minV',
+                          'maxV', 'truncated'])
+
+    nres = min(res_state['n'], k)
+    wf_sample = pd.DataFrame(res_state['wfs'][:nres], columns=wf_times,
+                             index=res_state['idx'][:nres])
+
+    if not wf_stats:
+        return qm, wf_sample
+
+    spk_stats = (pd.concat(stats_list) if len(stats_list) else
+                 test_sorting.calc_waveform_stats(pd.DataFrame(
+                     np.zeros((0, nsmpl)), columns=wf_times))[0])
+
+    return qm, wf_sample, spk_stats
+
+
+def stream_unit_qm(u, stab_prd_res, csize=chunk_size, k=n_reservoir):
+    """
+    Calculate waveform based quality metrics of unit on spikes streamed from
+    its spike store, with spikes included by drift test (stable period of
+    test_sorting.test_drift). Returns results as taken by test_sorting.test_qm
+    (wf_res).
+    """
+
+    fbase = u.get_spike_store()
+    spk_times, waveforms, wf_times = spike_store.open_spike_store(fbase)
+    tstart, tstop = util.float_vals(stab_prd_res[['tstart', 'tstop']], s)
+    qm, wf_sample, spk_stats = stream_qm(spk_times, waveforms, wf_times,
+                                         tstart, tstop, csize, k,
+                                         wf_stats=True)
+
+    wf_res = {'wf_stats': spk_stats, 'truncated': qm['truncated'],
+              'minV': qm['minV'], 'maxV': qm['maxV'], 'SNR': qm['SNR'],
+              'wf_sample': wf_sample}
+
+    return wf_res
@@ -5,6 +5,7 @@ Functions related to receptive field cleanness and coverage.
 @author: David Samu
 """
 
+import os
 import warnings
 
 import numpy as np
@@ -23,8 +24,31 @@ fRF = pd.Series([fbase + subj + '_RF_all_sessions.xlsx' for subj in subjects],
                 index=subjects)
 
 
+# Columns of RF mapping tables used.
+RF_cols = ['recording', 'RF_rec_name', 'channel', 'ntrials', 'cntr_x',
+           'cntr_y', 'FWHM', 'R2']
+
+# RF mapping tables read, by file name (set by read_RF_table).
+_RF_tables = {}
+
+
 # %% Misc functions.
 
+def read_RF_table(fname):
+    """
+    Return RF mapping table of file, parsed only once (or when file has
+    changed since).
+    """
+
+    mtime = os.path.getmtime(fname)
+    if fname not in _RF_tables or _RF_tables[fname][0] != mtime:
+        RFtab = pd.read_excel(fname)[RF_cols]
+        _RF_tables[fname] = (mtime, RFtab)
+
+    RFtab = _RF_tables[fname][1]
+    return RFtab
+
+
 def get_RF_mapping_results(recs, fRF_res=None, best_rec=True):
     """Return RF mapping results for given set of recordings."""
 
@@ -32,33 +56,37 @@ def get_RF_mapping_results(recs, fRF_res=None, best_rec=True):
     if fRF_res is None:
         fRF_res = fRF
 
-    allRFres = {subj: pd.read_excel(fname)
-                for subj, fname in fRF_res.iteritems()}
+    allRFres = {subj: read_RF_table(fname) for subj, fname in fRF_res.items()}
     allRFres = pd.concat(allRFres)
 
+    # Number of trials of each RF recording of each recording (in order of
+    # appearance).
+    rec_ntrs = allRFres.groupby(['recording', 'RF_rec_name'],
+                                sort=False).ntrials.mean()
+
     # Select best RF mapping for each recording.
     RFrecs = []
     for rec in recs:
 
         if isinstance(rec, tuple):
             rec = '{}_{}'.format(rec[0], rec[1])
-        RF_rec_names = allRFres.RF_rec_name[allRFres.recording == rec].unique()
 
         # If no RF mapping results are available.
-        if not len(RF_rec_names):
+        if rec not in rec_ntrs.index.get_level_values(0):
             warnings.warn('Could not find RF mapping results for '+rec)
             continue
 
+        ntrs = rec_ntrs.loc[rec]
+        RF_rec_names = list(ntrs.index)
+
         # Select single best RF recording.
         if best_rec:
             # Remove the ones containing the string 'Ipsi' or 'ipsi'.
-            RF_rec_names = [fRF_rec for fRF_rec in RF_rec_names
-                            if 'ipsi' not in fRF_rec.lower()]
+            ntrs = ntrs[['ipsi' not in fRF_rec.lower()
+                         for fRF_rec in ntrs.index]]
 
             # Select the RF recording with highest number of trials.
-            ntrs = [allRFres.ntrials[allRFres.RF_rec_name == fRF].mean()
-                    for fRF in RF_rec_names]
-            RF_rec_names = [RF_rec_names[np.argmax(ntrs)]]
+            RF_rec_names = [ntrs.idxmax()] if len(ntrs) else []
 
         RFrecs.extend(RF_rec_names)
 
@@ -71,13 +99,28 @@ def get_RF_mapping_results(recs, fRF_res=None, best_rec=True):
 def get_unit_results(u, RFres):
     """Return RF mapping results of given unit."""
 
-    subj, date, elec, ch, ux, task = u.get_utid()
-    rec = subj + '_' + date
-    uidx = (RFres.recording == rec) & (RFres.channel == ch)
-    rfres = RFres.loc[uidx].squeeze()
+    uRFres = get_units_results([u], RFres).iloc[0]
+    return uRFres
 
-    uRFres = rfres[['cntr_x', 'cntr_y', 'FWHM', 'R2']]
-    uRFres.name = (rec, ch, ux, task)
+
+def get_units_results(ulist, RFres):
+    """
+    Return RF mapping results of given units (NaN for units without RF
+    mapping result).
+    """
+
+    # Index of units by recording and channel.
+    utids = [u.get_utid() for u in ulist]
+    recs = [subj + '_' + date for subj, date, elec, ch, ux, task in utids]
+    rec_chs = [(rec, utid[3]) for rec, utid in zip(recs, utids)]
+    names = [(rec, ch, ux, task)
+             for rec, (subj, date, elec, ch, ux, task) in zip(recs, utids)]
+
+    RFtab = RFres.drop_duplicates(['recording', 'channel'])
+    RFtab = RFtab.set_index(['recording', 'channel'])
+    uRFres = RFtab.reindex(pd.MultiIndex.from_tuples(rec_chs))
+    uRFres = uRFres[['cntr_x', 'cntr_y', 'FWHM', 'R2']].astype(float)
+    uRFres.index = pd.MultiIndex.from_tuples(names)
 
     return uRFres
 
@@ -85,26 +128,47 @@ def get_unit_results(u, RFres):
 def intersect_area(d, r1, r2):
     """
     Return the area of intersection of two circles with given distance from
-    each other (d) and radii (r1 and r2).
+    each other (d) and radii (r1 and r2). Arguments can be arrays.
     """
 
-    if d <= abs(r1-r2):
-        # One circle is entirely enclosed in the other.
-        overlap = np.pi * min(r1, r2)**2
-    elif d >= r1 + r2:
-        # The circles don't overlap at all.
-        overlap = 0
-    else:
-        # There's some non-complete overlap.
-        r12, r22, d2 = r1**2, r2**2, d**2
-        alpha = np.arccos((d2 + r12 - r22) / (2*d*r1))
-        beta = np.arccos((d2 + r22 - r12) / (2*d*r2))
-        gamma = (r12 * np.sin(2*alpha) + r22 * np.sin(2*beta))
-        overlap = r12 * alpha + r22 * beta - 0.5 * gamma
+    d, r1, r2 = [np.asarray(v, dtype=float) for v in (d, r1, r2)]
+    r12, r22, d2 = r1**2, r2**2, d**2
+
+    # There's some non-complete overlap.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.arccos(np.clip((d2 + r12 - r22) / (2*d*r1), -1, 1))
+        beta = np.arccos(np.clip((d2 + r22 - r12) / (2*d*r2), -1, 1))
+    gamma = (r12 * np.sin(2*alpha) + r22 * np.sin(2*beta))
+    overlap = r12 * alpha + r22 * beta - 0.5 * gamma
+
+    # One circle is entirely enclosed in the other.
+    is_encl = d <= np.abs(r1-r2)
+    overlap = np.where(is_encl, np.pi * np.minimum(r1, r2)**2, overlap)
+
+    # The circles don't overlap at all.
+    overlap = np.where(d >= r1 + r2, 0, overlap)
+
+    # Keep missing values missing.
+    overlap = np.where(np.isnan(d + r1 + r2), np.nan, overlap)
+
+    if not overlap.ndim:
+        overlap = float(overlap)
 
     return overlap
 
 
+def get_stim_radius(u, stim):
+    """Return radius of stimulus (the one with most trials)."""
+
+    stim_sizes = u.TrData[(stim, 'Size')].value_counts()
+    if len(stim_sizes) > 1:
+        warnings.warn(('More than one simulus sizes found in unit: ' +
+                       u.Name + ', using the one with most trials.'))
+    stim_rad = stim_sizes.index[0] / 2  # diameter --> radius
+
+    return stim_rad
+
+
 def RF_coverage_analysis(UA, stims, fRF_res=None):
     """Relate unit activity to RF coverage."""
 
@@ -117,51 +181,54 @@ def RF_coverage_analysis(UA, stims, fRF_res=None):
     # Test DS in case it hasn't been tested yet.
     ua_query.test_DS(UA)
 
-    # Prepare RF mapping and DS results.
-    RF_res = []
-    for u in UA.iter_thru(excl=True):
-        print(u.Name)
-        # Get RF mapping results.
-        uRF_res = get_unit_results(u, RFres)
-        x, y, FWHM = uRF_res[['cntr_x', 'cntr_y', 'FWHM']]
-        RF_rad = FWHM / 2  # approximate circular RF radius by half of FWHM.
-        for stim in stims:
-            # Get DS.
-            uRF_res[stim+'_mDSI'] = u.DS.DSI.mDS[stim]
-            # Get stim size.
-            stim_sizes = u.TrData[(stim, 'Size')].value_counts()
-            if len(stim_sizes) > 1:
-                warnings.warn(('More than one simulus sizes found in unit: ' +
-                               u.Name + ', using the one with most trials.'))
-            stim_rad = stim_sizes.index[0] / 2  # diameter --> radius
-            uRF_res[stim+'_rad'] = stim_rad
-            # Calculate distance and overlap between RF and each stimulus.
-            stim_locs = list(u.TrData[(stim, 'Loc')].unique())
-            for i, stimloc in enumerate(stim_locs):
-                # Set names.
-                postfix = '_'+str(i+1) if i > 0 else ''
-                dname, cname, oname = ['{}_{}{}'.format(stim, nm, postfix)
-                                       for nm in ('dist', 'cover',
-                                                  'RF_cntr_cov')]
-                # Calc distance.
-                dist = sp.spatial.distance.euclidean([x, y], stimloc)
-                uRF_res[dname] = dist
-                # Calc coverage.
-                isa = intersect_area(dist, RF_rad, stim_rad)
-                RF_area = np.pi * RF_rad**2
-                uRF_res[cname] = isa/RF_area
-                # Check whether stimulus overlaps with RF center.
-                uRF_res[oname] = dist <= stim_rad
-            # Get average rate during each stimulus.
-            stim_rates = u.get_prd_rates(stim, add_latency=True)
-            # Mean across trials.
-            uRF_res[stim+'_mean_rate'] = float(stim_rates.mean())
-            # Mean to best direction.
-            dir_trs = u.trials_by_param((stim, 'Dir'))
-            max_rate = max([float(stim_rates[trs].mean()) for trs in dir_trs])
-            uRF_res[stim+'_max_rate'] = max_rate
-        RF_res.append(uRF_res)
-    RF_res = pd.concat(RF_res, axis=1).T
+    # Get RF mapping results of all units.
+    ulist = list(UA.iter_thru(excl=True))
+    RF_res = get_units_results(ulist, RFres)
+    x, y = np.array(RF_res.cntr_x), np.array(RF_res.cntr_y)
+    RF_rad = np.array(RF_res.FWHM) / 2  # approximate RF radius by half FWHM
+    RF_area = np.pi * RF_rad**2
+
+    for stim in stims:
+
+        # Get DS and stim size.
+        RF_res[stim+'_mDSI'] = [u.DS.DSI.mDS[stim] for u in ulist]
+        stim_rad = np.array([get_stim_radius(u, stim) for u in ulist],
+                            dtype=float)
+        RF_res[stim+'_rad'] = stim_rad
+
+        # Calculate distance and overlap between RF and each stimulus
+        # location of all units at once.
+        stim_locs = [list(u.TrData[(stim, 'Loc')].unique()) for u in ulist]
+        nlocs = max([len(locs) for locs in stim_locs] + [0])
+        for i in range(nlocs):
+            # Set names.
+            postfix = '_'+str(i+1) if i > 0 else ''
+            dname, cname, oname = ['{}_{}{}'.format(stim, nm, postfix)
+                                   for nm in ('dist', 'cover', 'RF_cntr_cov')]
+            # Calc distance.
+            locs = np.array([locs[i] if len(locs) > i else (np.nan, np.nan)
+                             for locs in stim_locs], dtype=float)
+            dist = np.sqrt((locs[:, 0] - x)**2 + (locs[:, 1] - y)**2)
+            RF_res[dname] = dist
+            # Calc coverage.
+            isa = intersect_area(dist, RF_rad, stim_rad)
+            RF_res[cname] = isa / RF_area
+            # Check whether stimulus overlaps with RF center.
+            RF_res[oname] = np.where(np.isnan(dist), np.nan,
+                                     dist <= stim_rad)
+
+        # Get average rate during each stimulus of all units at once.
+        stim_rates = ua_query.get_prd_rates_units(ulist, stim,
+                                                  add_latency=True)
+        # Mean across trials.
+        RF_res[stim+'_mean_rate'] = [r.mean() for r in stim_rates]
+        # Mean to best direction.
+        max_rates = []
+        for u, r in zip(ulist, stim_rates):
+            tr_dirs = u.TrData[(stim, 'Dir')][r.index]
+            max_rates.append(r.groupby(tr_dirs).mean().max())
+        RF_res[stim+'_max_rate'] = max_rates
+
     RF_res = RF_res.astype(float)
 
     # Add to UA for later access.
@@ -230,33 +297,43 @@ def exclude_uncovered_units(UA, RF_res=None, exc_unmapped=True, cov_th=0.33,
                             exclude_uncovered=True):
     """Exclude units from UnitArray with low RF coverage."""
 
-    nstart = len(UA.utids())
-    nnoRF = 0
-    for u in UA.iter_thru():
-
-        # Get results of unit.
-        utid = tuple(u.get_utid())
-
-        # TODO: this should be updated and removed, starting with MT mapping!
-        old_utid = ('{}_{}'.format(utid[0], utid[1]),) + utid[3:]
-
+    ulist = list(UA.iter_thru())
+    nstart = len(ulist)
+
+    # Get results of all units.
+    # TODO: this should be updated and removed, starting with MT mapping!
+    utids = [tuple(u.get_utid()) for u in ulist]
+    old_utids = [('{}_{}'.format(utid[0], utid[1]),) + utid[3:]
+                 for utid in utids]
+    if RF_res is None:
+        RF_res = pd.DataFrame(columns=['S1_cover', 'S2_cover',
+                                       'S1_RF_cntr_cov', 'S2_RF_cntr_cov'])
+    is_mapped = np.array([utid in RF_res.index for utid in old_utids],
+                         dtype=bool)
+    uRFres = RF_res.reindex(pd.MultiIndex.from_tuples(old_utids))
+    uRFres = uRFres[['S1_cover', 'S2_cover', 'S1_RF_cntr_cov',
+                     'S2_RF_cntr_cov']].astype(float)
+
+    # Exclude unit if coverage with RF is low for both stimuli.
+    low_cov = np.array((uRFres.S1_cover < cov_th) &
+                       (uRFres.S2_cover < cov_th))
+
+    # Exclude unit if neither stimulus overlaps with RF center.
+    no_cntr_cov = np.array((uRFres.S1_RF_cntr_cov == 0) &
+                           (uRFres.S2_RF_cntr_cov == 0))
+
+    for u, mapped, low, no_cntr in zip(ulist, is_mapped, low_cov,
+                                       no_cntr_cov):
         # No RF mapping result for recording or for unit.
-        if RF_res is None or old_utid not in RF_res.index:
+        if not mapped:
             u.set_excluded(exc_unmapped)
-            nnoRF += 1
-            continue
-
-        # Exclude unit if coverage with RF is low for both stimuli.
-        uRFres = RF_res.loc[old_utid]
-
-        if uRFres['S1_cover'] < cov_th and uRFres['S1_cover'] < cov_th:
-            u.set_excluded(True)
-
-        if (not uRFres['S1_RF_cntr_cov'] and
-            not uRFres['S2_RF_cntr_cov']):
+        elif no_cntr:
             u.set_excluded(exclude_uncovered)
+        elif low:
+            u.set_excluded(True)
 
     # Report some stats on unit exclusion.
+    nnoRF = int((~is_mapped).sum())
     nexc = nstart - len(UA.utids())
     pexc = int(100*nexc/nstart)
     print('Excluded {}/{} ({}%) of all units.'.format(nexc, nstart, pexc))
@@ -7,15 +7,19 @@ Functions to calculate quality metrics of units  after spike sorting
 @author: David Samu
 """
 
+import time
+import collections
 
 import numpy as np
 import scipy as sp
 import pandas as pd
 from quantities import s, ms
 
-import elephant
+from scipy.spatial import cKDTree
+from sklearn.decomposition import PCA
 
 from seal.analysis import stats
+from seal.quality import isi_qm
 from seal.util import util, constants
 
 
@@ -32,6 +36,14 @@ ISI_TH = 1.0*ms      # ISI violation threshold
 NTR_STEPS = 5        # number of trials to step by when detecting signal drift
 NTR_WINDOW = 20      # number of trials to average when detecting signal drift
 
+# Constants related to cluster isolation metrics.
+N_PCS = 3                # number of waveform principal components
+MAX_PCA_SPIKES = 10000   # max. number of spikes to fit PCA on
+WF_CHUNK_SIZE = 100000   # number of waveforms to project at once
+MAX_NN_SPIKES = 10000    # max. number of unit's spikes to test neighbours of
+N_NEIGHBORS = 4          # number of nearest neighbours of each spike
+seed = 8257              # random seed of spike subsampling and PCA
+
 # Quality control thresholds per brain region.
 # Minimum window length and firing rate of task related activity.
 QC_THs = pd.DataFrame.from_items([('MT', [200*ms, 10]),
@@ -44,6 +56,11 @@ min_SNR = 0.5           # min. SNR
 max_ISIvr = 2.5         # max. ISI violation ratio (%)
 min_n_trs = 50          # min. number of trials (in case subject quit)
 min_inc_trs_ratio = 50  # min. ratio of included trials out of all (%)
+min_NN_hit_rate = 0.5   # min. nearest neighbour hit rate
+
+# Isolation thresholds of single units.
+min_iso_dist = 20       # min. isolation distance
+max_L_ratio = 0.05      # max. L-ratio
 
 
 # %% Core methods.
@@ -65,22 +82,74 @@ def has_signal_difted(r1, r2):
     rlow, dlow = 0.1, 1000   # at 0.5 sp/s: 500%
     rhigh, dhigh = 50, 125   # at 50 sp/s: 150%
     # With exponential decay between them.
-    mr = np.min([np.max([np.mean([r1, r2]), rlow]), rhigh])
+    mr = min(max((r1 + r2) / 2, rlow), rhigh)
     rr = (np.log(mr)-np.log(rlow)) / (np.log(rhigh)-np.log(rlow))
     max_ratio = (dlow-dhigh) * (1-rr)**1.5 + dhigh
 
-    rmin, rmax = np.min([r1, r2]), np.max([r1, r2])
-    has_drifted = (rmax/np.max([rmin,rlow])) > (max_ratio/100)
+    rmin, rmax = min(r1, r2), max(r1, r2)
+    has_drifted = (rmax/max(rmin, rlow)) > (max_ratio/100)
 
     return has_drifted
 
 
-def calc_waveform_stats(waveforms):
-    """Calculate waveform duration and amplitude."""
+def spline_interp_matrix(xv, xfit, k=3, smoothing_fac=0):
+    """
+    Return matrix (len(xfit) x len(xv)) evaluating spline fitted to values
+    at xv on xfit, as linear combination of the values.
+    """
+
+    # Spline fit is linear in fitted values: fit each unit vector.
+    M = np.zeros((len(xfit), len(xv)))
+    for i, yv in enumerate(np.eye(len(xv))):
+        tck = sp.interpolate.splrep(xv, yv, s=smoothing_fac, k=k)
+        M[:, i] = sp.interpolate.splev(xfit, tck)
+
+    return M
+
+
+def first_trough_peak(Y):
+    """
+    Return index of first local minimum and of first following local maximum
+    of each row of array. If no local min/max is found, then index of global
+    min/max is returned.
+    """
+
+    icol = np.arange(Y.shape[1])
+
+    # Interior local minima and maxima (as scipy's argrelextrema).
+    is_min, is_max = [np.zeros(Y.shape, dtype=bool) for i in range(2)]
+    is_min[:, 1:-1] = (Y[:, 1:-1] < Y[:, :-2]) & (Y[:, 1:-1] < Y[:, 2:])
+    is_max[:, 1:-1] = (Y[:, 1:-1] > Y[:, :-2]) & (Y[:, 1:-1] > Y[:, 2:])
+
+    # First local minimum, or global minimum.
+    imin = np.where(is_min.any(1), is_min.argmax(1), Y.argmin(1))
+
+    # First local maximum after minimum, or global maximum after minimum.
+    is_max &= icol > imin[:, None]
+    Yafter = np.where(icol >= imin[:, None], Y, -np.inf)
+    imax = np.where(is_max.any(1), is_max.argmax(1), Yafter.argmax(1))
+
+    return imin, imax
+
+
+def calc_waveform_stats(waveforms, max_size=1e7, minV=None, maxV=None):
+    """
+    Calculate waveform duration and amplitude.
+
+    Waveforms with the same set of truncated samples are interpolated
+    together, by multiplying them with the matrix of the spline fit to
+    their valid samples, in blocks of at most max_size interpolated values.
+
+    minV, maxV: truncation voltages, if waveforms are only a part of those
+                of unit (default: minimum and maximum of waveforms).
+    """
 
     # Init.
-    wfs = np.array(waveforms)
-    minV, maxV = wfs.min(), wfs.max()
+    wfs = np.array(waveforms, dtype=float)
+    if minV is None:
+        minV = wfs.min()
+    if maxV is None:
+        maxV = wfs.max()
 
     # Spline fit and interpolation parameters.
     step = 1  # interpolation step in microseconds
@@ -92,80 +161,120 @@ def calc_waveform_stats(waveforms):
 
     # Init waveform data and time vector.
     x = np.array(waveforms.columns)
+    nspk = wfs.shape[0]
+    dur, amp = [np.full(nspk, np.nan) for i in range(2)]
+
+    # Remove truncated data points, and count remaining ones.
+    ivalid = (wfs != minV) & (wfs != maxV)
+    nvalid = ivalid.sum(1)
+    truncated = nvalid != len(x)
+
+    # Check that enough data points remaining for fitting.
+    to_fit = (nvalid > k) & (ivalid[:, WF_T_START:].sum(1) >= 2)
+    truncated[~to_fit] = True
+
+    # Go through each set of valid samples.
+    ifit = np.where(to_fit)[0]
+    masks, imask = np.unique(ivalid[ifit], axis=0, return_inverse=True)
+    imask = np.asarray(imask).ravel()
+    for im, mask in enumerate(masks):
+
+        # Interpolation matrix of cubic spline.
+        xv = x[mask]
+        xfit = np.arange(x[WF_T_START-2], xv[-1], step)
+        M = spline_interp_matrix(xv, xfit, k, smoothing_fac)
+
+        # Interpolate waveforms in blocks.
+        ispks = ifit[imask == im]
+        nblock = max(int(max_size / len(xfit)), 1)
+        for i in range(0, len(ispks), nblock):
+            iblock = ispks[i:i+nblock]
+            yfit = wfs[iblock][:, mask].dot(M.T)
+            imin, imax = first_trough_peak(yfit)
+            irows = np.arange(len(iblock))
+
+            # Calculate waveform duration and amplitude.
+            valid = imin < imax
+            dur[iblock[valid]] = (xfit[imax] - xfit[imin])[valid]
+            amp[iblock[valid]] = (yfit[irows, imax] - yfit[irows, imin])[valid]
+
+    wfstats = pd.DataFrame({'duration': dur, 'amplitude': amp,
+                            'truncated': truncated, 'nvalid': nvalid},
+                           columns=['duration', 'amplitude',
+                                    'truncated', 'nvalid'])
 
-    def calc_wf_stats(x, y):
+    return wfstats, is_truncated, minV, maxV
 
-        # Remove truncated data points.
-        ivalid = (y != minV) & (y != maxV)
-        xv, yv = x[ivalid], y[ivalid]
 
-        # Check that enough data points remaining for fitting.
-        if len(xv) <= k or sum(ivalid[WF_T_START:]) < 2:
-            return np.nan, np.nan, True, len(xv)
+def isi_stats_units(spk_times_list):
+    """
+    Return ISI statistics (percent of ISI violations and of spikes estimated
+    to originate from single unit), ISI histograms and autocorrelograms of
+    units (list of sorted spike times in s), calculated on all units at once.
+    """
 
-        # Fit cubic spline and get fitted y values.
-        tck = sp.interpolate.splrep(xv, yv, s=smoothing_fac, k=k)
-        xfit = np.arange(x[WF_T_START-2], xv[-1], step)
-        yfit = sp.interpolate.splev(xfit, tck)
+    spk_times, offsets = isi_qm.spike_csr(spk_times_list)
+    isi_th = float(ISI_TH.rescale(ms))
+    N, n_ISI_vr, T = isi_qm.isi_counts(spk_times, offsets, isi_th)
 
-        # Index of first local minimum and the first following local maximum.
-        # If no local min/max is found, then get global min/max.
-        imins = sp.signal.argrelextrema(yfit, np.less)[0]
-        imin = imins[0] if len(imins) else np.argmin(yfit)
-        imaxs = sp.signal.argrelextrema(yfit[imin:], np.greater)[0]
-        imax = (imaxs[0] if len(imaxs) else np.argmax(yfit[imin:])) + imin
+    # Percent of spikes violating ISI treshold.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_ISI_vr = 100 * n_ISI_vr / (N - 1)
 
-        # Calculate waveform duration, amplitude and # of valid samples.
-        dur = xfit[imax] - xfit[imin] if imin < imax else np.nan
-        amp = yfit[imax] - yfit[imin] if imin < imax else np.nan
-        truncated = (len(x) != len(xv))
-        nvalid = len(xv)
+    # Percent of spikes estimated to originate from the sorted single unit.
+    true_spikes = hill_true_spikes(n_ISI_vr, N, T)
 
-        return dur, amp, truncated, nvalid
+    # No spike: ISI v.r. and TrueSpikes no calculable.
+    # Only one spike: ISI v.r. is 0%, TrueSpikes is 100%.
+    percent_ISI_vr[N == 0], true_spikes[N == 0] = np.nan, np.nan
+    percent_ISI_vr[N == 1], true_spikes[N == 1] = 0, 100
 
-    # Calculate duration, amplitude and number of valid samples."""
-    res = [calc_wf_stats(x, wfs[i, :]) for i in range(wfs.shape[0])]
-    wfstats = pd.DataFrame(res, columns=['duration', 'amplitude',
-                                         'truncated', 'nvalid'])
+    isi_res = pd.DataFrame({'ISIvr': percent_ISI_vr,
+                            'TrueSpikes': true_spikes},
+                           columns=['ISIvr', 'TrueSpikes'])
 
-    for i in range(wfs.shape[0]):
-        calc_wf_stats(x, wfs[i, :])
+    # ISI histograms and autocorrelograms.
+    isi_hists = pd.DataFrame(isi_qm.isi_histograms(spk_times, offsets),
+                             columns=isi_qm.bin_centers(isi_qm.isi_bins))
+    acgs = pd.DataFrame(isi_qm.autocorrelograms(spk_times, offsets),
+                        columns=isi_qm.bin_centers(isi_qm.acg_bins))
 
-    return wfstats, is_truncated, minV, maxV
+    return isi_res, isi_hists, acgs
 
 
 def isi_stats(spk_times):
     """Returns ISIs and some related statistics."""
 
-    # No spike: ISI v.r. and TrueSpikes no calculable.
-    if not spk_times.size:
-        return np.nan, np.nan
+    spk_times = np.array(spk_times.rescale(s))
+    isi_res = isi_stats_units([spk_times])[0].iloc[0]
+    percent_ISI_vr, true_spikes = isi_res['ISIvr'], isi_res['TrueSpikes']
 
-    # Only one spike: ISI v.r. is 0%, TrueSpikes is 100%.
-    if spk_times.size == 1:
-        return 0, 100
+    return percent_ISI_vr, true_spikes
 
-    isi = elephant.statistics.isi(spk_times).rescale(ms)
 
-    # Percent of spikes violating ISI treshold.
-    n_ISI_vr = sum(isi < ISI_TH)
-    percent_ISI_vr = 100 * n_ISI_vr / isi.size
+def hill_true_spikes(n_ISI_vr, nspikes, T):
+    """
+    Return percent of spikes estimated to originate from the sorted single
+    unit, based on number of refractory period violations during recording
+    of length T (ms). Arguments can be arrays (e.g. of units).
 
-    # Percent of spikes estimated to originate from the sorted single unit.
-    # Based on refractory period violations.
-    # See Hill et al., 2011: Quality Metrics to Accompany Spike Sorting of
-    # Extracellular Signals
-    N = spk_times.size
-    T = (spk_times.max() - spk_times.min()).rescale(ms)
-    r = n_ISI_vr
+    See Hill et al., 2011: Quality Metrics to Accompany Spike Sorting of
+    Extracellular Signals
+    """
+
+    r, N = np.asarray(n_ISI_vr, dtype=float), np.asarray(nspikes, dtype=float)
     tmax = ISI_TH
     tmin = CENSORED_PRD_LEN
-    tdif = tmax - tmin
+    tdif = float((tmax - tmin).rescale(ms))
 
-    det = 1/4 - float(r*T / (2*tdif*N**2))  # determinant
-    true_spikes = 100*(1/2 + np.sqrt(det)) if det >= 0 else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = 1/4 - r*T / (2*tdif*N**2)  # determinant
+        true_spikes = np.where(det >= 0, 100*(1/2 + np.sqrt(np.abs(det))),
+                               np.nan)
+    if not true_spikes.ndim:
+        true_spikes = float(true_spikes)
 
-    return percent_ISI_vr, true_spikes
+    return true_spikes
 
 
 def calc_snr(waveforms):
@@ -187,84 +296,297 @@ def calc_snr(waveforms):
     return snr
 
 
-def test_drift(u):
-    """Test drift (gradual or abrupt) in baseline activity of unit."""
+def drift_windows(ntrs):
+    """
+    Return index of first and last (inclusive) trial of each window of
+    trials to average baseline rate over when detecting drift.
+    """
 
-    # Baseline rate averaged over every n consecutive trials.
-    trs = list(u.TrData.index)
-    tr_len = float(constants.fixed_tr_len.rescale(s))
-    bs_rate = u.get_prd_rates('fixation', trs=trs, add_latency=False,
-                              tr_time_idx=True)
-
-    # Get trial indices to average over.
-    itrs = []
-    for i in range(int(len(bs_rate) / NTR_STEPS)):
-        cntr = i * NTR_STEPS
-        hl = int(NTR_WINDOW / 2)
-        idxs = list(range(cntr-hl, cntr+hl))
-        if min(idxs) >= 0 and max(idxs) <= max(trs):
-            itrs.append(idxs)
-    if not len(itrs):  # in case there's not enough trials for a single window
-        itrs = [list(range(len(bs_rate)))]
+    # Windows of NTR_WINDOW trials centered at every NTR_STEPS trials, fully
+    # within session.
+    hl = int(NTR_WINDOW / 2)
+    cntrs = NTR_STEPS * np.arange(int(ntrs / NTR_STEPS))
+    cntrs = cntrs[(cntrs - hl >= 0) & (cntrs + hl <= ntrs)]
+    itr1, itr2 = cntrs - hl, cntrs + hl - 1
+
+    if not len(itr1):  # in case there's not enough trials for a single window
+        itr1, itr2 = np.array([0]), np.array([ntrs-1])
     else:
-        itrs[-1] = list(range(itrs[-1][0], trs[-1]+1))  # add modulo trials
+        itr2[-1] = ntrs - 1  # add modulo trials
 
-    # Get baseline activity stats in each window.
-    bs_stats = pd.DataFrame()
-    bs_stats['trials'] = itrs
-    bs_stats['tstart'] = [bs_rate.index[idx[0]] for idx in itrs]
-    bs_stats['tmean'] = [np.mean(bs_rate.index[idx]) for idx in itrs]
-    bs_stats['tstop'] = [bs_rate.index[idx[-1]]+tr_len for idx in itrs]
-    bs_stats['rate'] = [np.mean(bs_rate.iloc[idx]) for idx in itrs]
+    return itr1, itr2
 
-    # Adjust start and end times of session.
-    spk_times = u.SpikeParams['time']
-    t_start, t_stop = get_start_stop_times(spk_times, bs_rate.index,
-                                           bs_rate.index+tr_len)
-    bs_stats.loc[0,'tstart'] = t_start
-    bs_stats.loc[bs_stats.index[-1],'tstop'] = t_stop
 
-    # Find period within acceptable drift range for each bin.
-    res = []
-    for i in bs_stats.index:
-        rmin = rmax = bs_stats.loc[i, 'rate']
-        for j in bs_stats.index[i:]:
-            r = bs_stats.loc[j, 'rate']
-            # Update extreme values.
-            rmin = min(rmin, r)
-            rmax = max(rmax, r)
-            # If difference becomes unacceptable, terminate period.
+def window_means(X, itr1, itr2):
+    """
+    Return mean of values of array within windows of indices (inclusive) along
+    last axis, using cumulative sums.
+    """
+
+    csum = np.zeros(X.shape[:-1] + (X.shape[-1]+1,))
+    csum[..., 1:] = np.cumsum(X, axis=-1)
+    wmeans = (csum[..., itr2+1] - csum[..., itr1]) / (itr2 - itr1 + 1)
+
+    return wmeans
+
+
+def stable_prd_ends(rates):
+    """
+    Return index of last window of longest stretch of windows within
+    acceptable drift range starting at each window.
+
+    Two-pointer scan, with running minimum and maximum rate of current
+    stretch kept in monotonic deques of window indices. Stretch ends are
+    non-decreasing, as stretch containing an unacceptable drift is assumed to
+    be also unacceptable.
+    """
+
+    nwnd = len(rates)
+    iends = np.zeros(nwnd, dtype=int)
+    qmin, qmax = collections.deque(), collections.deque()
+    j = 0  # next window to add to stretch
+    for i in range(nwnd):
+
+        # Remove window before start of stretch.
+        if qmin and qmin[0] < i:
+            qmin.popleft()
+        if qmax and qmax[0] < i:
+            qmax.popleft()
+        j = max(j, i)
+
+        # Extend stretch until difference becomes unacceptable.
+        while j < nwnd:
+            r = rates[j]
+            rmin = min(rates[qmin[0]], r) if qmin else r
+            rmax = max(rates[qmax[0]], r) if qmax else r
             if has_signal_difted(rmin, rmax):
-                j -= 1
                 break
-        # Collect results.
-        tstart = bs_stats.loc[i, 'tstart']
-        tstop = bs_stats.loc[j, 'tstop']
-        first_tr = bs_stats.loc[i, 'trials'][0]
-        last_tr = bs_stats.loc[j, 'trials'][-1]
-        ntrs = last_tr - first_tr + 1
-        res.append([i, j, tstart, tstop, first_tr, last_tr, ntrs])
-    cols = ['istart', 'istop', 'tstart', 'tstop',
-            'first_tr', 'last_tr', 'ntrs']
-    prd_res = pd.DataFrame.from_records(res, columns=cols)
-
-    # Get params of longest stable period.
-    stab_prd_res = prd_res.loc[prd_res.ntrs.argmax()]
-
-    # Return included trials and spikes.
-    prd_inc = util.indices_in_window(bs_stats.index, stab_prd_res.istart,
-                                     stab_prd_res.istop)
-    tstart, tstop = stab_prd_res[['tstart', 'tstop']]
-    tr_inc = ((bs_rate.index >= tstart) & (bs_rate.index <= tstop))
-    spk_inc = util.indices_in_window(spk_times, tstart, tstop)
-
-    return bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc
-
-
-def is_isolated(snr, true_spikes):
-    """Classify unit as single or multi-unit."""
-
-    if true_spikes >= 90 and snr >= 2.0:
+            while qmin and rates[qmin[-1]] >= r:
+                qmin.pop()
+            qmin.append(j)
+            while qmax and rates[qmax[-1]] <= r:
+                qmax.pop()
+            qmax.append(j)
+            j += 1
+
+        iends[i] = j - 1
+
+    return iends
+
+
+def test_drift_units(ulist):
+    """
+    Test drift (gradual or abrupt) in baseline activity of units recorded
+    during the same trials (e.g. all units of recording in a task), with
+    baseline statistics calculated at once across units. Return list of
+    results of each unit (see test_drift).
+    """
+
+    # Baseline rate of each unit in each trial.
+    trs = list(ulist[0].TrData.index)
+    tr_len = float(constants.fixed_tr_len.rescale(s))
+    bs_rates = [u.get_prd_rates('fixation', trs=trs, add_latency=False,
+                                tr_time_idx=True) for u in ulist]
+    rates = np.array([util.remove_dim_from_array(np.array(bs_rate))
+                      for bs_rate in bs_rates], dtype=float)
+    tr_starts = np.array(bs_rates[0].index, dtype=float)
+
+    # Baseline rate averaged over every n consecutive trials.
+    itr1, itr2 = drift_windows(len(trs))
+    wnd_rates = window_means(rates, itr1, itr2)
+    itrs = [list(range(i1, i2+1)) for i1, i2 in zip(itr1, itr2)]
+    tstart = tr_starts[itr1]
+    tmean = window_means(tr_starts, itr1, itr2)
+    tstop = tr_starts[itr2] + tr_len
+
+    res = []
+    for u, bs_rate, wnd_rate in zip(ulist, bs_rates, wnd_rates):
+
+        # Get baseline activity stats in each window.
+        bs_stats = pd.DataFrame()
+        bs_stats['trials'] = itrs
+        bs_stats['tstart'] = tstart
+        bs_stats['tmean'] = tmean
+        bs_stats['tstop'] = tstop
+        bs_stats['rate'] = wnd_rate
+
+        # Adjust start and end times of session.
+        spk_times = u.SpikeParams['time']
+        t_start, t_stop = get_start_stop_times(spk_times, bs_rate.index,
+                                               bs_rate.index+tr_len)
+        bs_stats.loc[0, 'tstart'] = t_start
+        bs_stats.loc[bs_stats.index[-1], 'tstop'] = t_stop
+
+        # Find period within acceptable drift range for each bin.
+        istart = np.arange(len(wnd_rate))
+        istop = stable_prd_ends(wnd_rate)
+        first_tr, last_tr = itr1[istart], itr2[istop]
+        prd_res = pd.DataFrame({'istart': istart, 'istop': istop,
+                                'tstart': np.array(bs_stats.tstart[istart]),
+                                'tstop': np.array(bs_stats.tstop[istop]),
+                                'first_tr': first_tr, 'last_tr': last_tr,
+                                'ntrs': last_tr - first_tr + 1},
+                               columns=['istart', 'istop', 'tstart', 'tstop',
+                                        'first_tr', 'last_tr', 'ntrs'])
+
+        # Get params of longest stable period.
+        stab_prd_res = prd_res.loc[np.argmax(np.array(prd_res.ntrs))]
+
+        # Return included trials and spikes.
+        prd_inc = util.indices_in_window(bs_stats.index, stab_prd_res.istart,
+                                         stab_prd_res.istop)
+        tstart_inc, tstop_inc = stab_prd_res[['tstart', 'tstop']]
+        tr_inc = ((bs_rate.index >= tstart_inc) &
+                  (bs_rate.index <= tstop_inc))
+        spk_inc = util.indices_in_window(spk_times, tstart_inc, tstop_inc)
+
+        res.append((bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc))
+
+    return res
+
+
+def test_drift(u):
+    """Test drift (gradual or abrupt) in baseline activity of unit."""
+
+    res = test_drift_units([u])[0]
+    return res
+
+
+def waveform_pcs(wf_list, n_pcs=N_PCS, max_spikes=MAX_PCA_SPIKES,
+                 seed=seed):
+    """
+    Return principal components of waveforms of units (list of spikes x
+    samples arrays, e.g. memory mapped from spike stores), with PCA
+    (randomized SVD) fitted on random subset of all spikes. Waveforms are
+    read chunk by chunk.
+    """
+
+    # Random subset of spikes across units.
+    rng = np.random.RandomState(seed)
+    nspks = [len(wfs) for wfs in wf_list]
+    nspk, nsmpl = sum(nspks), max([wfs.shape[1] for wfs in wf_list])
+    ifit = (np.sort(rng.choice(nspk, max_spikes, replace=False))
+            if nspk > max_spikes else np.arange(nspk))
+    offsets = np.cumsum([0] + nspks)
+    X = np.concatenate([np.array(wfs[ifit[(ifit >= o1) & (ifit < o2)] - o1],
+                                 dtype=float)
+                        for wfs, o1, o2 in zip(wf_list, offsets[:-1],
+                                               offsets[1:]) if o2 > o1])
+
+    # Fit PCA on subset.
+    pca = PCA(n_components=min(n_pcs, nsmpl, len(ifit)),
+              svd_solver='randomized', random_state=seed)
+    pca.fit(X)
+
+    # Project all spikes.
+    pcs = np.concatenate([pca.transform(np.array(wfs[i:i+WF_CHUNK_SIZE],
+                                                 dtype=float))
+                          for wfs in wf_list
+                          for i in range(0, len(wfs), WF_CHUNK_SIZE)])
+
+    return pcs
+
+
+def isolation_distance_L_ratio(pcs, is_unit):
+    """
+    Return isolation distance (Harris et al, 2001) and L-ratio
+    (Schmitzer-Torbert et al, 2005) of unit's spikes among all spikes
+    recorded on channel, in PC space.
+    """
+
+    X, Y = pcs[is_unit], pcs[~is_unit]
+    n, nfeat = X.shape
+
+    # Not enough spikes of unit to estimate covariance, or no other spikes.
+    if n <= nfeat or not len(Y):
+        return np.nan, np.nan
+
+    # Squared Mahalanobis distance of other spikes from unit's cluster.
+    icov = np.linalg.pinv(np.cov(X, rowvar=False))
+    D = Y - X.mean(0)
+    d2 = (D.dot(icov) * D).sum(1)
+
+    # Isolation distance: distance of n-th closest other spike.
+    iso_dist = np.partition(d2, n-1)[n-1] if len(Y) >= n else np.nan
+
+    # L-ratio: sum of probabilities of other spikes to belong to unit.
+    L_ratio = sp.stats.chi2.sf(d2, nfeat).sum() / n
+
+    return iso_dist, L_ratio
+
+
+def nn_hit_rate(pcs, is_unit, k=N_NEIGHBORS, max_spikes=MAX_NN_SPIKES,
+                seed=seed):
+    """
+    Return nearest neighbour hit rate of unit (Chung et al, 2017): fraction
+    of k nearest neighbours of unit's spikes in PC space that belong to unit,
+    on spikes subsampled at same ratio from unit and other spikes.
+    """
+
+    n = is_unit.sum()
+
+    # No spike of unit, or no other spike.
+    if not n or n == len(pcs):
+        return np.nan
+
+    # Subsample spikes of unit and other spikes.
+    rng = np.random.RandomState(seed)
+    ratio = min(1, max_spikes / n)
+    idxs = [np.where(grp)[0] for grp in (is_unit, ~is_unit)]
+    idxs = [rng.choice(idx, int(np.ceil(ratio * len(idx))), replace=False)
+            for idx in idxs]
+    X = pcs[np.concatenate(idxs)]
+    lbl = np.arange(len(X)) < len(idxs[0])
+
+    # Find nearest neighbours of unit's spikes (first one being spike itself).
+    k = min(k, len(X)-1)
+    _, inn = cKDTree(X).query(X[lbl], k+1)
+    hit_rate = lbl[inn[:, 1:]].mean()
+
+    return hit_rate
+
+
+def isolation_metrics_units(ulist):
+    """
+    Calculate cluster isolation metrics of each unit among all units in list
+    (units recorded on same channel during same task), in principal
+    component space of their waveforms (memory mapped from spike store of
+    units with waveforms not kept in memory).
+    """
+
+    names = ['IsoDist', 'Lratio', 'NNHitRate']
+
+    # Single unit on channel: isolation not measurable.
+    if len(ulist) < 2:
+        return [pd.Series(np.nan, index=names) for u in ulist]
+
+    wf_list = [u.waveform_array() for u in ulist]
+    nspks = [len(wfs) for wfs in wf_list]
+    if sum(nspks) <= N_PCS:
+        return [pd.Series(np.nan, index=names) for u in ulist]
+
+    # Project waveforms of all units into common PC space.
+    pcs = waveform_pcs(wf_list)
+    iunit = np.repeat(np.arange(len(ulist)), nspks)
+
+    res = []
+    for i in range(len(ulist)):
+        is_unit = iunit == i
+        iso_dist, L_ratio = isolation_distance_L_ratio(pcs, is_unit)
+        hit_rate = nn_hit_rate(pcs, is_unit)
+        res.append(pd.Series([iso_dist, L_ratio, hit_rate], index=names))
+
+    return res
+
+
+def is_isolated(snr, true_spikes, iso_dist=np.nan, L_ratio=np.nan):
+    """
+    Classify unit as single or multi-unit. Cluster isolation metrics are
+    only tested if available (other units recorded on channel).
+    """
+
+    if (true_spikes >= 90 and snr >= 2.0 and not iso_dist < min_iso_dist and
+            not L_ratio > max_L_ratio):
         isolation = 'single unit'
     else:
         isolation = 'multi unit'
@@ -279,12 +601,74 @@ def calc_baseline_rate(u):
     return base_rate
 
 
-def test_task_relatedness(u, p_th=0.05):
-    """Test if unit has any task related activity."""
+def test_rates_vs_baseline(rates, tvec, bs_rates, grps, wndw_len,
+                           at_max_rate=False):
+    """
+    Test rates within window of period against baseline rates in each group
+    of trials at once.
+
+    rates:    rates during period (trials x time, NaN: not sampled).
+    tvec:     time vector of rates (ms).
+    bs_rates: baseline rate of each trial.
+    grps:     membership of trials in each group (groups x trials).
+    wndw_len: length of window to test (ms), at end of period or around time
+              of maximum mean rate (at_max_rate=True).
+
+    Returns p-value and mean rate of each group, and whether there are any
+    rates available in group.
+    """
+
+    # Number of sampled trials and mean rate at each time point of each
+    # group, keeping time points with at least 2 sampled trials.
+    is_smpl = ~np.isnan(rates)
+    rates0 = np.where(is_smpl, rates, 0)
+    G = np.array(grps, dtype=float)
+    ntrs = G.dot(is_smpl)
+    is_kept = ntrs >= 2
+    has_rates = is_kept.any(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mrates = G.dot(rates0) / ntrs
+        mean_rate = (np.where(is_kept, mrates, 0).sum(1) / is_kept.sum(1))
+
+    # Window to test within kept time points of each group.
+    ntime = len(tvec)
+    tmin = tvec[is_kept.argmax(1)]
+    tmax = tvec[ntime - 1 - is_kept[:, ::-1].argmax(1)]
+    tcntr = (tvec[np.where(is_kept, mrates, -np.inf).argmax(1)]
+             if at_max_rate else tmax)
+    tstart, tend = stats.prds_in_windows(tcntr, tmin, tmax, wndw_len)
+    in_wnd = (is_kept & (tvec >= tstart[:, None]) &
+              (tvec <= tend[:, None])).astype(float)
+
+    # Mean rate of each trial within window of each group.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wnd_rates = rates0.dot(in_wnd.T) / is_smpl.dot(in_wnd.T)
+
+    # Test difference from baseline rate.
+    is_in_grp = np.array(grps, dtype=bool).T
+    X = np.where(is_in_grp, wnd_rates, np.nan)
+    Y = np.where(is_in_grp, np.array(bs_rates, dtype=float)[:, None], np.nan)
+    pval = stats.mann_whitney_u_tests(X, Y)[1]
+
+    return pval, mean_rate, has_rates
+
+
+def test_task_relatedness(u, p_th=0.05, at_max_rate=False):
+    """
+    Test if unit has any task related activity.
+
+    Rates of each period are extracted for all trials at once, and rates of
+    trials with each value of trial parameters are tested against baseline
+    together (see test_rates_vs_baseline).
+
+    at_max_rate: test window around time of maximum rate, instead of window
+                 at end of period.
+    """
 
     # Init.
     nrate = u.init_nrate()
     wndw_len, minFR = QC_THs.loc[u.get_region()]
+    wndw_len = float(wndw_len.rescale(ms))
     if not len(u.inc_trials()):
         return False
 
@@ -298,41 +682,37 @@ def test_task_relatedness(u, p_th=0.05):
     prds_trs = pd.DataFrame.from_items(prds_trs, orient='index',
                                        columns=['prds', 'trpars'])
 
-    # Go through each stimulus, period and trial parameter to be tested.
+    # Go through each stimulus and period.
     pval = []
     mean_rate = []
     for stim, (prds, trpars) in prds_trs.iterrows():
 
-        for prd in prds:
-            t1s, t2s = u.pr_times(prd, add_latency=False, concat=False)
-
-            for par in trpars:
-                ptrs = u.trials_by_param((stim, par))
-
-                for vpar, trs in ptrs.iteritems():
-
-                    # Get rates during period on trials with given param value.
-                    rates = u._Rates[nrate].get_rates(trs, t1s, t2s)
-                    bs_rates = baseline[trs]
-
-                    # No rates available.
-                    if rates.empty:
-                        continue
+        # Trials with each value of each trial parameter to be tested.
+        par_trs = [((par, vpar), np.array(trs))
+                   for par in trpars
+                   for vpar, trs in u.trials_by_param((stim, par)).items()
+                   if len(trs)]
+        if not len(par_trs):
+            continue
+        trs = np.unique(np.concatenate([ptrs for _, ptrs in par_trs]))
+        grps = np.array([np.isin(trs, ptrs) for _, ptrs in par_trs])
+        bs_rates = baseline[trs]
 
-                    # Get sub-period around time with maximal rate.
-                    tmax = rates.mean().argmax()
-                    tmin, tmax = rates.columns.min(), rates.columns.max()
-                    tstart, tend = stats.prd_in_window(tmax, tmin, tmax,
-                                                       wndw_len, ms)
-                    tidx = (rates.columns >= tstart) & (rates.columns <= tend)
+        for prd in prds:
 
-                    # Test difference from baseline rate.
-                    wnd_rates = rates.loc[:, tidx].mean(1)
-                    stat, p = stats.mann_whithney_u_test(wnd_rates, bs_rates)
+            # Get rates during period on all trials.
+            t1s, t2s = u.pr_times(prd, add_latency=False, concat=False)
+            rate = u._Rates[nrate]
+            smpl_idxs, col_idxs, tvec = rate.get_sample_idxs(trs, t1s, t2s)
+            rates = rate.get_rates_array(trs, smpl_idxs, col_idxs, len(tvec),
+                                         dtype=float)
+
+            # Test each parameter value, skipping those without rates.
+            res = test_rates_vs_baseline(rates, tvec, bs_rates, grps,
+                                         wndw_len, at_max_rate)
+            for ((par, vpar), _), p, mrate, has_rates in zip(par_trs, *res):
+                if has_rates:
                     pval.append(((stim, prd, par, str(vpar)), p))
-
-                    # Mean rate.
-                    mrate = rates.mean().mean()
                     mean_rate.append(((stim, prd, par, str(vpar)), mrate))
 
     # Format results.
@@ -358,7 +738,21 @@ def test_task_relatedness(u, p_th=0.05):
 
 # %% Calculate quality metrics, and find trials and units to be excluded.
 
-def test_qm(u, include=None, first_tr=None, last_tr=None):
+def add_timing(timings, stage, t0):
+    """
+    Add time elapsed since t0 to time of stage in timings (if not None), and
+    return current time.
+    """
+
+    t = time.time()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + t - t0
+
+    return t
+
+
+def test_qm(u, include=None, first_tr=None, last_tr=None, timings=None,
+            drift_res=None, isol_res=None, isi_res=None, wf_res=None):
     """
     Test ISI, SNR and stationarity of FR and spike waveforms.
     Find trials with unacceptable drift.
@@ -369,17 +763,37 @@ def test_qm(u, include=None, first_tr=None, last_tr=None):
 
     Optionally, user can provide trials to be selected and whether to include
     unit.
+
+    timings: dict to add time taken by each stage of test to (in seconds).
+    drift_res: results of drift test of unit, if already tested (e.g. by
+               test_drift_units).
+    isol_res: cluster isolation metrics of unit, if already calculated (e.g.
+              by isolation_metrics_units among units of channel).
+    isi_res: ISI statistics, ISI histogram and autocorrelogram of included
+             spikes of unit, if already calculated (e.g. by isi_stats_units).
+    wf_res: waveform statistics, truncation, voltage range, SNR and random
+            sample of waveforms of unit, if calculated on waveforms streamed
+            from its spike store (see stream_qm.stream_unit_qm). Otherwise,
+            they are calculated on waveforms in memory (loaded from spike
+            store, if not kept in memory).
     """
 
     if u.is_empty():
         return
 
+    t = time.time()
+
     # Init values.
-    waveforms = u.Waveforms
     spk_times = u.SpikeParams['time']
 
     # Calculate waveform statistics of each spike.
-    wf_stats, is_truncated, minV, maxV = calc_waveform_stats(waveforms)
+    if wf_res is None:
+        waveforms = u.get_waveforms()
+        wf_stats, is_truncated, minV, maxV = calc_waveform_stats(waveforms)
+    else:
+        wf_stats, is_truncated, minV, maxV = [wf_res[k] for k in
+                                              ('wf_stats', 'truncated',
+                                               'minV', 'maxV')]
     u.SpikeParams['duration'] = wf_stats['duration']
     u.SpikeParams['amplitude'] = wf_stats['amplitude']
     u.SpikeParams['truncated'] = wf_stats['truncated']
@@ -387,6 +801,7 @@ def test_qm(u, include=None, first_tr=None, last_tr=None):
     u.UnitParams['truncated'] = is_truncated
     u.SessParams['minV'] = min(minV, VMIN)
     u.SessParams['maxV'] = max(maxV, VMAX)
+    t = add_timing(timings, 'waveform', t)
 
     # Trial exclusion.
     # TODO: implement manual trial selection.
@@ -396,25 +811,42 @@ def test_qm(u, include=None, first_tr=None, last_tr=None):
     # else:  # Automatic trial selection.
 
     # Test drifts and reject trials if necessary.
-    bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc = test_drift(u)
+    if drift_res is None:
+        drift_res = test_drift(u)
+    bs_stats, stab_prd_res, prd_inc, tr_inc, spk_inc = drift_res
 
     u.update_included_trials(tr_inc)
+    t = add_timing(timings, 'drift', t)
 
     # SNR.
-    snr = calc_snr(waveforms[spk_inc])
+    snr = calc_snr(waveforms[spk_inc]) if wf_res is None else wf_res['SNR']
 
     # ISI statistics.
-    ISIvr, true_spikes = isi_stats(np.array(spk_times[spk_inc])*s)
-    isolation = is_isolated(snr, true_spikes)
+    if isi_res is None:
+        isi_res = [res.iloc[0] for res in
+                   isi_stats_units([np.array(spk_times[spk_inc])])]
+    isi_stat, isi_hist, acg = isi_res
+    ISIvr, true_spikes = isi_stat['ISIvr'], isi_stat['TrueSpikes']
+    t = add_timing(timings, 'SNR_ISI', t)
+
+    # Cluster isolation metrics.
+    if isol_res is None:
+        isol_res = isolation_metrics_units([u])[0]
+    isolation = is_isolated(snr, true_spikes, isol_res['IsoDist'],
+                            isol_res['Lratio'])
 
     # Minimum firing rate and task-related activity.
     has_min_rate, is_task_related = test_task_relatedness(u)
+    t = add_timing(timings, 'task_related', t)
 
     # Add quality metrics to unit.
     u.QualityMetrics['SNR'] = snr
     u.QualityMetrics['mWfDur'] = u.SpikeParams.duration[spk_inc].mean()
     u.QualityMetrics['ISIvr'] = ISIvr
     u.QualityMetrics['TrueSpikes'] = true_spikes
+    u.QualityMetrics['IsoDist'] = isol_res['IsoDist']
+    u.QualityMetrics['Lratio'] = isol_res['Lratio']
+    u.QualityMetrics['NNHitRate'] = isol_res['NNHitRate']
     u.QualityMetrics['isolation'] = isolation
     u.QualityMetrics['baseline'] = calc_baseline_rate(u)
     u.QualityMetrics['has_min_rate'] = has_min_rate
@@ -425,11 +857,14 @@ def test_qm(u, include=None, first_tr=None, last_tr=None):
     if include is None:
         include = QC_tests['include']
     u.set_excluded(not include)
+    add_timing(timings, 'rejection', t)
 
     # Return all results (for plotting).
     res = {'bs_stats': bs_stats, 'stab_prd_res': stab_prd_res,
            'prd_inc': prd_inc, 'tr_inc': tr_inc, 'spk_inc': spk_inc,
-           'QC_tests': QC_tests}
+           'isi_hist': isi_hist, 'acg': acg, 'QC_tests': QC_tests}
+    if wf_res is not None:
+        res['wf_sample'] = wf_res['wf_sample']
 
     return res
 
@@ -449,6 +884,9 @@ def test_rejection(u):
     # Extremely high ISI violation ratio (ISIvr).
     QC_tests['ISI'] = qm['ISIvr'] < max_ISIvr
 
+    # Extremely poor cluster isolation (if other units on channel).
+    QC_tests['NNHitRate'] = not qm['NNHitRate'] < min_NN_hit_rate
+
     # Insufficient total number of trials (subject quit).
     QC_tests['NTotalTrs'] = qm['NTrialsTotal'] > min_n_trs
 
@@ -13,7 +13,7 @@ import pandas as pd
 
 from quantities import deg, s
 
-from seal.util import util
+from seal.util import util, ua_query
 from seal.plot import putil, pplot
 from seal.analysis import direction
 
@@ -23,17 +23,47 @@ MAX_PD_DIFF = 45 * deg
 MAX_BASERATE_DIFF = 10 * 1/s  # maximum baseline rate difference
 
 
+# %% Per-trial rates of units.
+
+def prd_rate_matrix(ulist, prd):
+    """
+    Return rates of units (of same task) during period in each of their
+    included trials (units x trial start times), with spikes of all units
+    and trials counted at once.
+    """
+
+    rates = ua_query.get_prd_rates_units(ulist, prd)
+    tstart_list = [np.array(util.remove_dim_from_series(
+                            u.TrData.TrialStart[r.index]), dtype=float)
+                   for u, r in zip(ulist, rates)]
+
+    # Put rates into units x trials matrix.
+    tstarts = np.concatenate(tstart_list)
+    tr_times = np.unique(tstarts)
+    irow = np.repeat(np.arange(len(ulist)), [len(ts) for ts in tstart_list])
+    icol = np.searchsorted(tr_times, tstarts)
+    rate_mat = np.full((len(ulist), len(tr_times)), np.nan)
+    rate_mat[irow, icol] = np.concatenate([np.array(r) for r in rates])
+    rate_mat = pd.DataFrame(rate_mat, index=[u.Name for u in ulist],
+                            columns=tr_times)
+
+    return rate_mat
+
+
+# %% Stability across tasks.
+
 def get_cross_task_stability_data(UA):
     """Collect unit params for testing stability across tasks."""
 
-    # Collect and save params of interest.
+    # Collect params of interest of each unit in each task.
     stim = 'S2'  # testing S2, because S1 location can change btw tasks
     rnames = ('base_rate', 'pref_dir', 'stim_loc')
     tasks = tuple(UA.tasks())
-    col = pd.MultiIndex.from_product([tasks, rnames], names=['task', 'res'])
-    stab_test = pd.DataFrame(index=UA.uids(), columns=col)
-    for uid in UA.uids():
-        for task in tasks:
+    uids = UA.uids()
+    res = {(task, rname): len(uids) * [np.nan]
+           for task in tasks for rname in rnames}
+    for task in tasks:
+        for iu, uid in enumerate(uids):
             u = UA.get_unit(uid, task)
 
             if u.is_empty() or u.is_excluded():
@@ -43,52 +73,127 @@ def get_cross_task_stability_data(UA):
                 u.test_DS()
 
             # Get unit params of interest.
-            base_rate = u.get_baseline()
-            pref_dir = u.pref_dir(stim, 'max')
             locs = u.TrData[(stim, 'Loc')].unique()
 
             # Check that only one location has been presented.
             if len(locs) > 1:
                 warnings.warn('More than one unique location found' +
                               'for preferred direction for ' + u.Name)
-            stab_test.loc[uid, task] = [base_rate, pref_dir, locs]
+
+            res[(task, 'base_rate')][iu] = u.get_baseline()
+            res[(task, 'pref_dir')][iu] = u.pref_dir(stim, 'max')
+            res[(task, 'stim_loc')][iu] = locs
+
+    # Create table at once.
+    col = pd.MultiIndex.from_product([tasks, rnames], names=['task', 'res'])
+    stab_test = pd.DataFrame([[res[c][iu] for c in col]
+                              for iu in range(len(uids))],
+                             index=uids, columns=col)
 
     UA.StabilityTest = stab_test
 
 
-def test_cross_task_stability(UA, uid, task1, task2):
-    """Test unit stability across tasks."""
+def cross_task_stability(UA, task1, task2):
+    """
+    Test stability of all units between two tasks. Returns table of
+    baseline rate stability, preferred direction stability, stimulus location
+    match and overall stability of each unit.
+    """
 
     if UA.StabilityTest.empty:
         get_cross_task_stability_data(UA)
+    stab_data = UA.StabilityTest
 
     # Test baseline rate change.
-    brate1, brate2 = UA.StabilityTest.loc[uid, [(task1, 'base_rate'),
-                                                (task2, 'base_rate')]]
-    brate_same = abs(brate1 - brate2) < MAX_BASERATE_DIFF
+    brate1, brate2 = [util.float_vals(stab_data[(task, 'base_rate')], 1/s)
+                      for task in (task1, task2)]
+    brate_same = np.abs(brate1 - brate2) < float(MAX_BASERATE_DIFF)
 
     # Test DS change.
-    pdir1, pdir2 = UA.StabilityTest.loc[uid, [(task1, 'pref_dir'),
-                                              (task2, 'pref_dir')]]
-    pd_same = direction.deg_diff(pdir1, pdir2) < MAX_PD_DIFF
+    pdir1, pdir2 = [util.float_vals(stab_data[(task, 'pref_dir')], deg)
+                    for task in (task1, task2)]
+    pd_diff = direction.deg_diff_arr(pdir1, pdir2)
+    pd_same = pd_diff < float(MAX_PD_DIFF)
 
-    locs1, locs2 = UA.StabilityTest.loc[uid, [(task1, 'stim_loc'),
-                                              (task2, 'stim_loc')]]
-    loc_same = np.array_equal(locs1, locs2)
+    # Test stimulus location match.
+    loc_same = np.array([np.array_equal(locs1, locs2) for locs1, locs2
+                         in zip(stab_data[(task1, 'stim_loc')],
+                                stab_data[(task2, 'stim_loc')])])
 
     # Is unit stable between two tasks?
-    is_stable = brate_same and (pd_same or not loc_same)
+    is_stable = brate_same & (pd_same | ~loc_same)
 
-    return is_stable
+    stab_res = pd.DataFrame({'base_rate': brate_same, 'pref_dir': pd_same,
+                             'stim_loc': loc_same, 'stable': is_stable},
+                            index=stab_data.index,
+                            columns=['base_rate', 'pref_dir', 'stim_loc',
+                                     'stable'])
 
+    return stab_res
 
-def rec_stability_test(UA, fname=None, periods=None):
-    """Check stability of recording session across tasks."""
+
+def cross_task_stability_matrix(UA):
+    """Return stability of each unit between each pair of tasks."""
+
+    tasks = UA.tasks()
+    task_pairs = [(t1, t2) for i, t1 in enumerate(tasks)
+                  for t2 in tasks[i+1:]]
+    stab_mat = pd.concat([cross_task_stability(UA, t1, t2)['stable']
+                          for t1, t2 in task_pairs], axis=1,
+                         keys=task_pairs)
+
+    return stab_mat
+
+
+def test_cross_task_stability(UA, uid, task1, task2):
+    """Test unit stability across tasks."""
+
+    is_stable = cross_task_stability(UA, task1, task2).loc[[uid], 'stable']
+    return is_stable.iloc[0]
+
+
+# %% Recording stability across session.
+
+def rec_stability_data(UA, periods=None):
+    """
+    Calculate rates of all units in each trial during each period, and
+    statistics of rates across session in each task.
+    """
 
     # Init.
     if periods is None:
         periods = ['whole trial', 'fixation']
 
+    stab_data = {}
+    for prd in periods:
+        stab_data[prd] = {}
+        for task in UA.tasks():
+
+            # Get activity of all units in task.
+            ulist = list(UA.iter_thru([task]))
+
+            # Not (non-empty and included) unit during task.
+            if not len(ulist):
+                continue
+
+            tr_rates = prd_rate_matrix(ulist, prd)
+
+            # Mean and std of rates, and linear trend to test gradual drift.
+            tr_times = tr_rates.columns
+            mean_rate, std_rate = tr_rates.mean(), tr_rates.std()
+            slope, _, _, p_value, _ = sp.stats.linregress(tr_times, mean_rate)
+            stab_data[prd][task] = {'rates': tr_rates, 'mean': mean_rate,
+                                    'std': std_rate, 'slope': slope,
+                                    'pval': p_value}
+
+    return stab_data
+
+
+def plot_rec_stability(stab_data, title=None, fname=None):
+    """Plot stability of recording session across tasks."""
+
+    periods = list(stab_data.keys())
+
     # Init figure.
     fig, gsp, axs = putil.get_gs_subplots(nrow=len(periods), ncol=1,
                                           subw=10, subh=2.5, create_axes=True,
@@ -96,36 +201,25 @@ def rec_stability_test(UA, fname=None, periods=None):
 
     for prd, ax in zip(periods, axs):
 
-        # Calculate and plot firing rate during given period in each trial
-        # across session for all units.
+        # Plot firing rate during given period in each trial across session
+        # for all units.
         colors = putil.get_colors()
         task_stats = pd.DataFrame(columns=['t_start', 't_stops', 'label'])
-        for task, color in zip(UA.tasks(), colors):
-
-            # Get activity of all units in task.
-            tr_rates = []
-            for u in UA.iter_thru([task]):
-                rates = u.get_prd_rates(prd, tr_time_idx=True)
-                tr_rates.append(util.remove_dim_from_series(rates))
-            tr_rates = pd.DataFrame(tr_rates)
-
-            # Not (non-empty and included) unit during task.
-            if not len(tr_rates.index):
-                continue
+        for (task, tres), color in zip(stab_data[prd].items(), colors):
 
             # Plot each rate in task.
+            tr_rates = tres['rates']
             tr_times = tr_rates.columns
             pplot.lines(tr_times, tr_rates.T, zorder=1, alpha=0.5,
                         color=color, ax=ax)
 
             # Plot mean +- sem rate.
-            tr_time = tr_rates.columns
-            mean_rate, sem_rate = tr_rates.mean(), tr_rates.std()
+            mean_rate, sem_rate = tres['mean'], tres['std']
             lower, upper = mean_rate-sem_rate, mean_rate+sem_rate
             lower[lower < 0] = 0  # remove negative values
-            ax.fill_between(tr_time, lower, upper, zorder=2, alpha=.5,
+            ax.fill_between(tr_times, lower, upper, zorder=2, alpha=.5,
                             facecolor='grey', edgecolor='grey')
-            pplot.lines(tr_time, mean_rate, lw=2, color='k', ax=ax)
+            pplot.lines(tr_times, mean_rate, lw=2, color='k', ax=ax)
 
             # Add task stats.
             task_lbl = '{}, {} units'.format(task, len(tr_rates.index))
@@ -133,10 +227,9 @@ def rec_stability_test(UA, fname=None, periods=None):
             # Add grand mean FR.
             task_lbl += '\nFR: {:.1f} sp/s'.format(tr_rates.mean().mean())
 
-            # Calculate linear trend to test gradual drift.
-            slope, _, _, p_value, _ = sp.stats.linregress(tr_times, mean_rate)
-            slope = 3600*slope  # convert to change in spike per hour
-            pval = util.format_pvalue(p_value, max_digit=3)
+            # Add linear trend to test gradual drift.
+            slope = 3600*tres['slope']  # convert to change in spike per hour
+            pval = util.format_pvalue(tres['pval'], max_digit=3)
             task_lbl += '\n$\delta$FR: {:.1f} sp/s/h'.format(slope)
             task_lbl += '\n{}'.format(pval)
 
@@ -156,5 +249,12 @@ def rec_stability_test(UA, fname=None, periods=None):
         putil.set_spines(ax, left=False)
 
     # Save figure.
-    title = 'Recording stability of ' + UA.Name
     putil.save_fig(fname, fig, title)
+
+
+def rec_stability_test(UA, fname=None, periods=None):
+    """Check stability of recording session across tasks."""
+
+    stab_data = rec_stability_data(UA, periods)
+    title = 'Recording stability of ' + UA.Name
+    plot_rec_stability(stab_data, title, fname)
@@ -8,20 +8,34 @@ for different sets of trials or trial periods.
 """
 
 import os
+import time
 import warnings
+import multiprocessing as mp
 
 import numpy as np
 import pandas as pd
 
 from seal.io import export
-from seal.util import util
+from seal.util import util, constants
 from seal.object import unitarray
-from seal.quality import test_sorting, test_stability
+from seal.quality import test_sorting, test_stability, stream_qm
 from seal.plot import putil, pquality
 
 # Figure size constants
 subw = 7
 
+# Unit fields set by quality test (see test_sorting.test_qm), to be
+# transferred from worker processes.
+qm_fields = {'SpikeParams': ['duration', 'amplitude', 'truncated', 'nvalid',
+                             'included'],
+             'UnitParams': ['truncated', 'excluded'],
+             'SessParams': ['minV', 'maxV'],
+             'TrData': ['included']}
+
+# UnitArray and unit selection table shared with worker processes (set by
+# init_shared_UA).
+_shared = {}
+
 
 # %% Quality tests across tasks.
 
@@ -72,69 +86,342 @@ def get_selection_params(u, UnTrSel=None):
     return include, first_tr, last_tr
 
 
-def quality_test(UA, ftempl=None, plot_qm=False, fselection=None):
-    """Test and plot quality metrics of recording and spike sorting """
+def plot_unit_qm(uid, ures, ftempl=None):
+    """
+    Plot quality test results of unit across tasks (list of (Unit, test
+    results) pairs, see test_sorting.test_qm).
+    """
+
+    # Init figure.
+    fig, gsp, _ = putil.get_gs_subplots(nrow=1, ncol=len(ures),
+                                        subw=subw, subh=2.1*subw)
+    wf_axs, amp_axs, dur_axs, amp_dur_axs, rate_axs = [], [], [], [], []
+    isi_axs, acg_axs = [], []
+
+    for i, (u, res) in enumerate(ures):
+
+        if res is not None:
+            ax_res = pquality.plot_qm(u, fig=fig, sps=gsp[i], **res)
 
-    # Init plotting theme.
-    putil.set_style('notebook', 'ticks')
+            # Collect axes.
+            (ax_wfs, ax_wf_amp, ax_wf_dur, ax_amp_dur, ax_rate,
+             ax_isi, ax_acg) = ax_res
+            wf_axs.extend(ax_wfs)
+            amp_axs.append(ax_wf_amp)
+            dur_axs.append(ax_wf_dur)
+            amp_dur_axs.append(ax_amp_dur)
+            rate_axs.append(ax_rate)
+            isi_axs.append(ax_isi)
+            acg_axs.append(ax_acg)
 
-    # Import unit&trial selection file.
-    UnTrSel = pd.read_excel(fselection) if (fselection is not None) else None
+        else:
+            putil.add_mock_axes(fig, gsp[i])
 
-    # For each unit over all tasks.
-    d_QC_tests = {}
-    for uid in UA.uids():
+    # Match axis scales across tasks.
+    putil.sync_axes(wf_axs, sync_x=True, sync_y=True)
+    putil.sync_axes(amp_axs, sync_y=True)
+    putil.sync_axes(dur_axs, sync_y=True)
+    putil.sync_axes(amp_dur_axs, sync_x=True, sync_y=True)
+    putil.sync_axes(rate_axs, sync_y=True)
+    putil.sync_axes(isi_axs, sync_y=True)
+    putil.sync_axes(acg_axs, sync_y=True)
+    [putil.move_event_lbls(ax, y_lbl=0.92) for ax in rate_axs]
 
-        # Init figure.
-        if plot_qm:
-            fig, gsp, _ = putil.get_gs_subplots(nrow=1, ncol=len(UA.tasks()),
-                                                subw=subw, subh=1.6*subw)
-            wf_axs, amp_axs, dur_axs, amp_dur_axs, rate_axs = ([], [], [],
-                                                               [], [])
+    # Save figure.
+    if ftempl is not None:
+        uid_str = util.format_uid(uid)
+        title = uid_str.replace('_', ' ')
+        ffig = ftempl.format(uid_str)
+        putil.save_fig(ffig, fig, title, w_pad=15)
 
-        for i, task in enumerate(UA.tasks()):
 
-            # Do quality test.
-            u = UA.get_unit(uid, task)
-            include, first_tr, last_tr = get_selection_params(u, UnTrSel)
-            res = test_sorting.test_qm(u, include, first_tr, last_tr)
+def init_plot_worker(UA):
+    """Init worker process rendering quality test figures of units of UA."""
 
-            if res is not None:
-                d_QC_tests[uid + (task,)] = res.pop('QC_tests')
+    putil.use_agg_backend()
+    init_shared_UA(UA, None)
+
+
+def plot_shared_unit_qm(uid, tres, ftempl=None):
+    """
+    Plot quality test results of unit of shared UnitArray across tasks (list
+    of (task, record of results, test results) triples, see test_qm_units),
+    setting results on unit first (see apply_qm_record).
+    """
+
+    ures = []
+    for task, rec, res in tres:
+        u = _shared['UA'].get_unit(uid, task)
+        if rec is not None:
+            apply_qm_record(u, rec)
+        ures.append((u, res))
+
+    plot_unit_qm(uid, ures, ftempl)
+
+
+def rec_of_uid(uid):
+    """Return recording [(subj, date) pair] of unit."""
+
+    rec = tuple(uid[:len(constants.rec_levels)])
+    return rec
+
+
+def qm_chunks(utids, chunk_size=4):
+    """
+    Split units (list of (uid, task) pairs) into chunks to be tested
+    together, of at least chunk_size units, keeping units of each channel
+    together (for isolation metrics) and units of different recordings
+    apart (for batched drift test).
+    """
+
+    chunks, chunk = [], []
+    for i, (uid, task) in enumerate(utids):
+        chunk.append((uid, task))
+        is_last = i == len(utids)-1
+        next_uid = utids[i+1][0] if not is_last else None
+        new_ch = is_last or next_uid[:-1] != uid[:-1]
+        new_rec = is_last or rec_of_uid(next_uid) != rec_of_uid(uid)
+        if new_rec or (new_ch and len(chunk) >= chunk_size):
+            chunks.append(chunk)
+            chunk = []
+
+    return chunks
+
+
+def drift_batches(utids):
+    """
+    Group units (list of (uid, task) pairs) into batches recorded during the
+    same trials (same recording and task), to test drift of at once.
+    """
+
+    batches = {}
+    for uid, task in utids:
+        batches.setdefault(rec_of_uid(uid) + (task,), []).append((uid, task))
+
+    return batches
 
-            # Plot QC results.
-            if plot_qm:
 
-                if res is not None:
-                    ax_res = pquality.plot_qm(u, fig=fig, sps=gsp[i], **res)
+def init_shared_UA(UA, UnTrSel):
+    """Set UnitArray and unit selection table for worker processes."""
+
+    _shared['UA'] = UA
+    _shared['UnTrSel'] = UnTrSel
+
 
-                    # Collect axes.
-                    ax_wfs, ax_wf_amp, ax_wf_dur, ax_amp_dur, ax_rate = ax_res
-                    wf_axs.extend(ax_wfs)
-                    amp_axs.append(ax_wf_amp)
-                    dur_axs.append(ax_wf_dur)
-                    amp_dur_axs.append(ax_amp_dur)
-                    rate_axs.append(ax_rate)
+def qm_record(u):
+    """Return results of quality test set on unit (see qm_fields)."""
 
-                else:
-                    putil.add_mock_axes(fig, gsp[i])
+    fields = {attr: getattr(u, attr)[cols].copy()
+              for attr, cols in qm_fields.items()}
+    rec = {'fields': fields, 'QualityMetrics': u.QualityMetrics.copy()}
 
-        if plot_qm:
+    # Results of task-relatedness test, with test parameters (not kept by
+    # pickling of DataFrame).
+    if hasattr(u, 'PrdParTests'):
+        rec['PrdParTests'] = u.PrdParTests.copy()
+        rec['prd_par_test'] = {'test': u.PrdParTests.test,
+                               'p_th': u.PrdParTests.p_th}
 
-            # Match axis scales across tasks.
-            putil.sync_axes(wf_axs, sync_x=True, sync_y=True)
-            putil.sync_axes(amp_axs, sync_y=True)
-            putil.sync_axes(dur_axs, sync_y=True)
-            putil.sync_axes(amp_dur_axs, sync_x=True, sync_y=True)
-            putil.sync_axes(rate_axs, sync_y=True)
-            [putil.move_event_lbls(ax, y_lbl=0.92) for ax in rate_axs]
+    return rec
+
+
+def apply_qm_record(u, rec):
+    """Set results of quality test on unit (see qm_record)."""
+
+    # Columns of tables (DataFrames) or items of parameters (Series).
+    for attr, vals in rec['fields'].items():
+        obj = getattr(u, attr)
+        for k in vals.keys():
+            obj[k] = vals[k]
+
+    u.QualityMetrics = rec['QualityMetrics']
+
+    if 'PrdParTests' in rec:
+        u.PrdParTests = rec['PrdParTests']
+        u.PrdParTests.test = rec['prd_par_test']['test']
+        u.PrdParTests.p_th = rec['prd_par_test']['p_th']
+
+
+def test_qm_units(utids):
+    """
+    Run quality test on units (list of (uid, task) pairs, including all units
+    of each channel) of shared UnitArray. Return record of results (see
+    qm_record), results for plotting and timing of test stages of each unit.
+
+    Waveforms of units not kept in memory are streamed from their spike
+    store (see stream_qm.stream_unit_qm), or memory mapped from it (for
+    isolation metrics), without loading them into memory.
+    """
+
+    UA, UnTrSel = _shared['UA'], _shared['UnTrSel']
+    streamed = [(uid, task) for uid, task in utids
+                if not UA.get_unit(uid, task).is_empty() and
+                not UA.get_unit(uid, task).waveforms_in_memory()]
+
+    # Test drift of non-empty units of each recording and task at once.
+    drift_res = {}
+    for rtutids in drift_batches(utids).values():
+        tutids = [(uid, t) for uid, t in rtutids
+                  if not UA.get_unit(uid, t).is_empty()]
+        if not len(tutids):
+            continue
+        ulist = [UA.get_unit(uid, t) for uid, t in tutids]
+        t0 = time.time()
+        tres = test_sorting.test_drift_units(ulist)
+        tdrift = (time.time() - t0) / len(ulist)
+        drift_res.update({utid: (r, tdrift) for utid, r in zip(tutids, tres)})
+
+    # Test isolation of non-empty units of each channel in each task at once.
+    ch_utids = {}
+    for uid, task in utids:
+        if not UA.get_unit(uid, task).is_empty():
+            ch_utids.setdefault((uid[:-1], task), []).append((uid, task))
+    isol_res = {}
+    for tutids in ch_utids.values():
+        ulist = [UA.get_unit(uid, t) for uid, t in tutids]
+        t0 = time.time()
+        tres = test_sorting.isolation_metrics_units(ulist)
+        tisol = (time.time() - t0) / len(ulist)
+        isol_res.update({utid: (r, tisol) for utid, r in zip(tutids, tres)})
+
+    # ISI statistics of included spikes of all non-empty units at once.
+    tutids = list(drift_res.keys())
+    spk_times_list = []
+    for uid, task in tutids:
+        spk_inc = drift_res[(uid, task)][0][4]
+        spk_times = UA.get_unit(uid, task).SpikeParams['time'][spk_inc]
+        spk_times_list.append(np.array(spk_times))
+    t0 = time.time()
+    isi_stats, isi_hists, acgs = test_sorting.isi_stats_units(spk_times_list)
+    tisi = (time.time() - t0) / max(len(tutids), 1)
+    isi_res = {utid: ((isi_stats.iloc[i], isi_hists.iloc[i], acgs.iloc[i]),
+                      tisi) for i, utid in enumerate(tutids)}
+
+    # Waveform statistics of units streamed from spike store.
+    wf_res = {}
+    for uid, task in streamed:
+        u = UA.get_unit(uid, task)
+        stab_prd_res = drift_res[(uid, task)][0][1]
+        t0 = time.time()
+        wres = stream_qm.stream_unit_qm(u, stab_prd_res)
+        wf_res[(uid, task)] = (wres, time.time() - t0)
+
+    res_list = []
+    for uid, task in utids:
+        u = UA.get_unit(uid, task)
+        include, first_tr, last_tr = get_selection_params(u, UnTrSel)
+        dres, tdrift = drift_res.get((uid, task), (None, 0))
+        ires, tisol = isol_res.get((uid, task), (None, 0))
+        sres, tisi = isi_res.get((uid, task), (None, 0))
+        wres, twf = wf_res.get((uid, task), (None, 0))
+        timings = {'waveform': twf, 'drift': tdrift, 'isolation': tisol,
+                   'ISI': tisi}
+        res = test_sorting.test_qm(u, include, first_tr, last_tr, timings,
+                                   dres, ires, sres, wres)
+        rec = qm_record(u) if res is not None else None
+        res_list.append((uid, task, rec, res, timings))
+
+    return res_list
+
+
+def report_qc_progress(event):
+    """Print progress event of quality test (see quality_test)."""
+
+    uname = util.format_uid(event['uid']) + ' ' + event['task']
+    timings = ', '.join(['{} {:.1f}s'.format(stage, t)
+                         for stage, t in event['timings'].items()])
+    print('    {}/{} {}  [{:.0f}s]  {}'.format(event['n_done'],
+                                             event['n_total'], uname,
+                                             event['elapsed'], timings))
+
+
+def quality_test(UA, ftempl=None, plot_qm=False, fselection=None,
+                 chunk_size=4, progress=None, nCPU=None, nCPU_plot=None):
+    """
+    Test and plot quality metrics of recording and spike sorting.
+
+    Units are tested in chunks (of at least chunk_size units, keeping units
+    of each channel together and recordings apart, see qm_chunks) in pool,
+    with workers returning only the results of the test (see qm_record),
+    which are then set on units of UA. Figures are rendered in a separate
+    pool (of nCPU_plot processes, out of nCPU in total), as soon as unit has
+    been tested in all tasks, with workers receiving only the results of
+    unit (units are taken from copy of UA shared with them). Waveforms of
+    units with spike store are not loaded into memory (see test_qm_units).
+
+    progress: function called with progress event (dict of uid, task,
+              number of units done and in total, time elapsed and timing of
+              each stage of test) of each unit, e.g. report_qc_progress.
+    """
+
+    # Init plotting theme.
+    putil.set_style('notebook', 'ticks')
+
+    # Import unit&trial selection file.
+    UnTrSel = pd.read_excel(fselection) if (fselection is not None) else None
+
+    # Init chunks of units over all tasks, with all units of each channel
+    # in same chunk.
+    tasks = UA.tasks()
+    utids = [(uid, task) for uid in UA.uids() for task in tasks]
+    params = [(chunk,) for chunk in qm_chunks(utids, chunk_size)]
+
+    # Init pool to render figures, sharing cores with testing.
+    if nCPU is None:
+        nCPU = max(util.get_n_cores() - 1, 1)
+    nCPU_test, plot_pool = nCPU, None
+    if plot_qm and nCPU > 1:
+        if nCPU_plot is None:
+            nCPU_plot = max(int(nCPU / 2), 1)
+        nCPU_plot = min(nCPU_plot, nCPU - 1)
+        nCPU_test = nCPU - nCPU_plot
+        plot_pool = mp.Pool(nCPU_plot, init_plot_worker, (UA,))
+    plot_jobs = []
+
+    # Test units in pool, collecting results as each chunk finishes.
+    d_QC_tests = {}
+    uid_res = {}
+    ndone = 0
+    t0 = time.time()
+    for res_list in util.imap_in_pool(test_qm_units, params, nCPU_test,
+                                      initializer=init_shared_UA,
+                                      initargs=(UA, UnTrSel)):
+        for uid, task, rec, res, timings in res_list:
+
+            # Set results on unit.
+            u = UA.get_unit(uid, task)
+            if rec is not None:
+                apply_qm_record(u, rec)
+                d_QC_tests[uid + (task,)] = res.pop('QC_tests')
 
-            # Save figure.
-            if ftempl is not None:
-                uid_str = util.format_uid(uid)
-                title = uid_str.replace('_', ' ')
-                ffig = ftempl.format(uid_str)
-                putil.save_fig(ffig, fig, title, w_pad=15)
+            # Report progress.
+            ndone += 1
+            if progress is not None:
+                progress({'uid': uid, 'task': task, 'n_done': ndone,
+                          'n_total': len(utids),
+                          'elapsed': time.time() - t0, 'timings': timings})
+
+            # Plot QC results, once unit has been tested in all tasks.
+            if not plot_qm:
+                continue
+            uid_res.setdefault(uid, []).append((task, rec, res))
+            if len(uid_res[uid]) < len(tasks):
+                continue
+            tres = uid_res.pop(uid)
+            if plot_pool is None:
+                ures = [(UA.get_unit(uid, t), r) for t, rc, r in tres]
+                plot_unit_qm(uid, ures, ftempl)
+            else:
+                plot_params = (uid, tres, ftempl)
+                plot_jobs.append(plot_pool.apply_async(plot_shared_unit_qm,
+                                                       plot_params))
+    _shared.clear()
+
+    # Wait for figures to finish.
+    if plot_pool is not None:
+        [job.get() for job in plot_jobs]
+        plot_pool.close()
+        plot_pool.join()
 
     # Collect QC test results.
     QC_tests = pd.DataFrame(d_QC_tests).T
@@ -162,7 +449,7 @@ def report_unit_exclusion_stats(UA, fname):
 
 
 def quality_control(data_dir, proj_name, task_order, plot_qm=True,
-                    plot_stab=True, fselection=None):
+                    plot_stab=True, fselection=None, nCPU=None):
     """Run quality control (SNR, rate drift, ISI, etc) on each recording."""
 
     # Data directory with all recordings to be processed in subfolders.
@@ -193,7 +480,8 @@ def quality_control(data_dir, proj_name, task_order, plot_qm=True,
         # Test unit quality, save result figures, add stats to units and
         # exclude low quality trials and units.
         ftempl = util.join([qc_dir, 'QC_plots', '{}.png'])
-        quality_test(UA, ftempl, plot_qm, fselection)
+        quality_test(UA, ftempl, plot_qm, fselection,
+                     progress=report_qc_progress, nCPU=nCPU)
 
         # Report unit exclusion stats.
         report_unit_exclusion_stats(UA)
@@ -6,6 +6,9 @@ Functions for performing and processing ROC analyses.
 @author: David Samu
 """
 
+import warnings
+import multiprocessing as mp
+
 import numpy as np
 import pandas as pd
 
@@ -15,6 +18,7 @@ from sklearn.model_selection import StratifiedKFold
 from sklearn.model_selection import permutation_test_score
 
 from seal.util import util
+from seal.analysis import stats
 from seal.roc import rocutil, rocpost
 
 
@@ -23,6 +27,15 @@ min_sample_size = 10
 n_folds = 5
 n_jobs = 1  # or util.get_n_cores() - 1
 
+# For reproducable (deterministic) permutation results.
+seed = 8257  # just a random number
+
+# Rate data shared with worker processes (set by init_shared_rates).
+_shared = {}
+
+# Result fields of ROC analysis over time (see unit_ROC_tests).
+aroc_fields = ['aroc', 'pval', 'ci_lo', 'ci_hi', 'cpval']
+
 
 # DataFrame containing analysis params per feature to analyze.
 feat_pars = {'DS': ('pref_anti_dirs', 'pref and anti dirs', None, None),
@@ -61,6 +74,174 @@ def calc_auc(clf, x, y):
     return auc
 
 
+def rank_by_class(X, y):
+    """
+    Return tie-corrected ranks of valid (non-NaN) values within each column
+    of X (zero for invalid values), and masks of valid class 1 and class 0
+    values.
+    """
+
+    # Init data.
+    X = np.array(X, dtype=float)
+    X = X.reshape((X.shape[0], -1))
+    y = np.array(y, dtype=float)
+
+    # Rank valid values, putting NaN values to the end of each column.
+    is1, is0 = [(y == v)[:, None] & ~np.isnan(X) for v in (1, 0)]
+    is_val = is1 | is0
+    ranks = stats.tied_ranks(np.where(is_val, X, np.inf))
+    ranks[~is_val] = 0
+
+    return ranks, is1, is0
+
+
+def auc_from_rank_sum(R1, n1, n0):
+    """
+    Return AUC from rank sum and number of class 1 samples and number of
+    class 0 samples (NaN for insufficient sample sizes).
+    """
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        auc = (R1 - n1 * (n1+1) / 2) / (n1 * n0)
+
+    # Insufficient sample size or not exactly two values to classify.
+    auc[(n1 + n0 < min_sample_size) | (n1 == 0) | (n0 == 0)] = np.nan
+
+    return auc
+
+
+def calc_rank_auc(X, y):
+    """
+    Calculate area under the curve of ROC analysis at each column (e.g. time
+    point) of X at once, as Mann-Whitney U statistic on tie-corrected ranks.
+
+    For a single predictor, this is the same AUC as of calc_auc(): the
+    probability of a class 1 sample being larger than a class 0 sample (ties
+    counting half). NaN values are ignored. AUC is NaN at columns with
+    insufficient sample size or not both classes present.
+
+    y values have to be 0 and 1!
+    """
+
+    ranks, is1, is0 = rank_by_class(X, y)
+    R1 = np.where(is1, ranks, 0).sum(0)
+    auc = auc_from_rank_sum(R1, is1.sum(0), is0.sum(0))
+
+    return auc
+
+
+def perm_test_rank_auc(X, y, n_perm, seed=seed, return_perm=False):
+    """
+    Calculate AUC at each column of X (see calc_rank_auc) with label
+    permutation test.
+
+    The same (n_perm x trials) matrix of permuted labels is used at all
+    columns, and AUCs of permutations are calculated by matrix products of
+    permuted labels with ranks. P-value is the fraction of permutations
+    with AUC at least as far from 0.5 as the AUC of the true labels.
+
+    return_perm: also return (n_perm x columns) AUC matrix of permutations.
+    """
+
+    ranks, is1, is0 = rank_by_class(X, y)
+    is_val = is1 | is0
+    nval = is_val.sum(0)
+
+    # AUC of true labels.
+    n1 = is1.sum(0)
+    auc = auc_from_rank_sum(np.where(is1, ranks, 0).sum(0), n1, nval - n1)
+
+    # Draw permuted labels.
+    y = np.array(y, dtype=float)
+    rng = np.random.RandomState(seed)
+    iperm = np.argsort(rng.rand(n_perm, len(y)), axis=1)
+    yperm = (y[iperm] == 1).astype(float)
+
+    # AUC of permuted labels.
+    pR1 = yperm.dot(ranks)
+    pn1 = yperm.dot(is_val.astype(float))
+    perm_auc = auc_from_rank_sum(pR1, pn1, nval - pn1)
+
+    # Two-sided permutation p-value.
+    pval = stats.perm_pval(np.abs(auc - 0.5), np.abs(perm_auc - 0.5))
+    pval[np.isnan(auc)] = np.nan
+
+    if return_perm:
+        return auc, pval, perm_auc
+
+    return auc, pval
+
+
+def boot_ci_rank_auc(X, y, n_boot, ci=95, seed=seed, max_size=2e6):
+    """
+    Calculate bootstrap confidence interval (lower and upper limit) of AUC
+    at each column of X (see calc_rank_auc), resampling trials within each
+    class.
+
+    Resamples are represented as (n_boot x trials) matrix of trial counts,
+    and AUCs of all (bootstrap x column) cells are calculated at once from
+    the sorting order of the original values of each column, by cumulating
+    class 0 counts below each class 1 value (ties counting half). Columns are
+    processed in blocks of at most max_size (bootstrap x trial x column)
+    cells to limit memory use.
+    """
+
+    # Init data.
+    X = np.array(X, dtype=float)
+    X = X.reshape((X.shape[0], -1))
+    y = np.array(y, dtype=float)
+    ntrs, ntimes = X.shape
+
+    # Draw trial counts of resamples within each class.
+    rng = np.random.RandomState(seed)
+    w = np.zeros((n_boot, ntrs))
+    for v in (1, 0):
+        itrs = np.where(y == v)[0]
+        if len(itrs):
+            pvals = np.ones(len(itrs)) / len(itrs)
+            w[:, itrs] = rng.multinomial(len(itrs), pvals, size=n_boot)
+
+    # Sort each column, putting invalid (NaN) values to the end.
+    is_val = ~np.isnan(X) & ((y == 1) | (y == 0))[:, None]
+    Xv = np.where(is_val, X, np.inf)
+    isort = np.argsort(Xv, axis=0, kind='mergesort')
+    ifirst, ilast = stats.tie_bounds(np.take_along_axis(Xv, isort, 0))
+    is1s, is0s = [np.take_along_axis(is_val & (y == v)[:, None], isort, 0)
+                  for v in (1, 0)]
+
+    # Calculate AUC of resamples by blocks of columns.
+    boot_auc = np.full((n_boot, ntimes), np.nan)
+    nblock = max(int(max_size // max(n_boot * ntrs, 1)), 1)
+    for it1 in range(0, ntimes, nblock):
+        itb = np.arange(it1, min(it1+nblock, ntimes))
+        cols = np.arange(len(itb))[None, :]
+
+        # Counts of class 1 and class 0 trials in sorted order.
+        W = w[:, isort[:, itb]]
+        W1, W0 = W * is1s[:, itb], W * is0s[:, itb]
+
+        # Class 0 counts below and tied with each value.
+        cum0 = np.cumsum(W0, axis=1)
+        n0_below = (cum0 - W0)[:, ifirst[:, itb], cols]
+        n0_tied = cum0[:, ilast[:, itb], cols] - n0_below
+
+        # Mann-Whitney U statistic normalized by number of pairs.
+        U = (W1 * (n0_below + 0.5 * n0_tied)).sum(1)
+        n1, n0 = W1.sum(1), W0.sum(1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            auc = U / (n1 * n0)
+        auc[(n1 + n0 < min_sample_size) | (n1 == 0) | (n0 == 0)] = np.nan
+        boot_auc[:, itb] = auc
+
+    # Percentile confidence interval.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN columns
+        plims = [(100 - ci) / 2, (100 + ci) / 2]
+        ci_lo, ci_hi = np.nanpercentile(boot_auc, plims, axis=0)
+
+    return ci_lo, ci_hi
+
+
 def ROC(x, y, n_perm=None, clf=None):
     """
     Perform ROC analysis with optional permutation test.
@@ -105,106 +286,313 @@ def ROC(x, y, n_perm=None, clf=None):
 
 # %% Higher level functions to run AROC on a unit and group of units over time.
 
-def run_ROC_over_time(rates1, rates2, n_perm=None, clf=None):
-    """Run ROC analysis between two rate frames (trials by time)."""
+def run_ROC_over_time(rates1, rates2, n_perm=None, n_boot=None):
+    """
+    Run ROC analysis between two rate frames (trials by time).
+
+    n_boot: number of bootstrap resamples for confidence interval of AUC
+            (columns ci_lo and ci_hi), 0 or None: no bootstrapping.
+    """
 
     # Merge rates and create and target vector.
     rates = pd.concat([rates1, rates2])
     target_vec = pd.Series(len(rates.index)*[1], index=rates.index)
     target_vec[rates2.index] = 0  # all y values have to be 0/1 for ROC
 
-    # Default classifier.
-    if clf is None:
-        clf = LogisticRegression()
+    # Calculate AUC at all time points at once, with permutation test.
+    if n_perm is not None and n_perm > 0:
+        auc, pval = perm_test_rank_auc(rates, target_vec, n_perm)
+    else:
+        auc = calc_rank_auc(rates, target_vec)
+        pval = len(rates.columns) * [None]
 
-    # Run ROC across time.
-    roc_res = pd.DataFrame([ROC(rates[t], target_vec, n_perm, clf)
-                            for t in rates],
-                           index=rates.columns, columns=['auc', 'pval'])
+    roc_res = pd.DataFrame({'auc': auc, 'pval': pval}, index=rates.columns,
+                           columns=['auc', 'pval'])
 
-    return roc_res
+    # Bootstrap confidence interval of AUC.
+    if n_boot is not None and n_boot > 0:
+        ci_lo, ci_hi = boot_ci_rank_auc(rates, target_vec, n_boot)
+        roc_res['ci_lo'], roc_res['ci_hi'] = ci_lo, ci_hi
 
+    return roc_res
 
-def run_unit_ROC_over_time(u, prd, ref_ev, trs_list, nrate, tstep, n_perm,
-                           zscore_by, verbose):
-    """Run ROC analysis of unit over time. Suitable for parallelization."""
 
-    # Report progress.
-    if verbose:
-        print(u.Name)
+def unit_rates_array(u, prd, ref_ev, trs_list, nrate, tstep, zscore_by):
+    """
+    Return rates of unit in two sets of trials in (trials x time) array,
+    target vector of trials (1: first set, 0: second set) and time vector.
+    """
 
     # Set up params: trials, time period and rates.
     t1s, t2s = u.pr_times(prd, concat=False)
     ref_ts = u.ev_times(ref_ev)
+    trs1, trs2 = [np.array(trs) for trs in trs_list]
+    trs = np.concatenate([trs1, trs2])
+    y = np.concatenate([np.ones(len(trs1)), np.zeros(len(trs2))])
 
     # Prepare rates.
-    rates1, rates2 = [u._Rates[nrate].get_rates(trs, t1s, t2s, ref_ts, tstep)
-                      for trs in trs_list]
+    rate = u._Rates[nrate]
+    smpl_idxs, col_idxs, tvec = rate.get_sample_idxs(trs, t1s, t2s, ref_ts,
+                                                     tstep)
+    rates = rate.get_rates_array(trs, smpl_idxs, col_idxs, len(tvec))
 
     # Z-score rates by some trial parameter.
-    rates = pd.concat([rates1, rates2])
     if zscore_by is not None:
         ztrs = u.trials_by_param(zscore_by)
-        for par, trs in ztrs.items():
-            itrs = rates.index.intersection(trs)
-            if len(itrs):
-                irates = rates.loc[itrs]
-                mean = irates.mean()
-                std = irates.std(ddof=0)
-                rates.loc[itrs, :] = (irates - mean)/std
-    rates1, rates2 = [rates.loc[r.index] for r in (rates1, rates2)]
+        zgrps = np.full(len(trs), np.nan)
+        for i, itrs in enumerate(ztrs):
+            zgrps[np.isin(trs, itrs)] = i
+        rates = util.zscore_by_group(rates, zgrps, axis=0)
+
+    return rates, y, tvec
 
-    # Calculate AROC on rates.
-    aroc_res = run_ROC_over_time(rates1, rates2, n_perm)
 
-    return aroc_res
+def init_shared_rates(rates_buf, y_buf, shape):
+    """Init rates and targets in shared memory for worker process."""
+
+    _shared['rates'] = np.frombuffer(rates_buf, np.float32).reshape(shape)
+    _shared['y'] = np.frombuffer(y_buf, np.float32).reshape(shape[:2])
+
+
+def shared_rates_array(urates):
+    """
+    Put (trials x time) rate arrays of units, given with their time vectors,
+    into (units x trials x time) array on common time vector in shared memory.
+    Targets in shared memory are left NaN.
+    """
+
+    # Common time vector of units.
+    tvec = np.unique(np.concatenate([tv for r, tv in urates]))
+    ntrs = np.array([len(r) for r, tv in urates])
+    shape = (len(urates), max(int(ntrs.max()), 1), len(tvec))
+
+    # Put rates into shared memory.
+    rates_buf = mp.RawArray('f', int(np.prod(shape)))
+    y_buf = mp.RawArray('f', int(shape[0] * shape[1]))
+    init_shared_rates(rates_buf, y_buf, shape)
+    rates, y = _shared['rates'], _shared['y']
+    rates[:], y[:] = np.nan, np.nan
+    for iu, (r, tv) in enumerate(urates):
+        rates[iu, :len(r)][:, np.searchsorted(tvec, tv)] = r
+
+    return rates_buf, y_buf, shape, tvec, ntrs
+
+
+def unit_ROC_tests(X, y, n_perm=None, n_boot=None, clust_pth=None):
+    """
+    Run ROC analysis over time (columns of X) with optional permutation test,
+    bootstrap confidence interval and cluster-mass correction of permutation
+    test (clusters formed by pointwise p-value < clust_pth, see
+    stats.cluster_perm_test).
+
+    Returns AROC, p-value, lower and upper confidence limit and cluster
+    p-value (NaN if not calculated).
+    """
+
+    res = np.full((5, X.shape[1]), np.nan)
+    if n_perm is not None and n_perm > 0:
+        res[0], res[1], perm_auc = perm_test_rank_auc(X, y, n_perm,
+                                                      return_perm=True)
+        if clust_pth is not None:
+            res[4] = stats.cluster_perm_test(np.abs(res[0] - 0.5),
+                                             np.abs(perm_auc - 0.5),
+                                             clust_pth)[0]
+            res[4, np.isnan(res[0])] = np.nan
+    else:
+        res[0] = calc_rank_auc(X, y)
+    if n_boot is not None and n_boot > 0:
+        res[2], res[3] = boot_ci_rank_auc(X, y, n_boot)
+
+    return res
+
+
+def run_units_ROC_over_time(iu1, iu2, ntrs, n_perm, n_boot=None,
+                            clust_pth=None):
+    """
+    Run ROC analysis over time of range of units of shared rate array,
+    with optional permutation test, bootstrap confidence interval and
+    cluster correction (see unit_ROC_tests). Suitable for parallelization.
+    """
+
+    rates, y = _shared['rates'], _shared['y']
+    ntimes = rates.shape[2]
+
+    res = np.full((5, iu2-iu1, ntimes), np.nan)
+    for i, iu in enumerate(range(iu1, iu2)):
+        urates, uy = rates[iu, :ntrs[i]], y[iu, :ntrs[i]]
+        res[:, i] = unit_ROC_tests(urates, uy, n_perm, n_boot, clust_pth)
+
+    return res
 
 
 def run_group_ROC_over_time(ulist, trs_list, prd, ref_ev, n_perm=None,
                             nrate=None, tstep=None, zscore_by=None,
-                            verbose=True):
-    """Run ROC over list of units over time."""
+                            verbose=True, nCPU=None, n_boot=None,
+                            clust_pth=None, store=None):
+    """
+    Run ROC over list of units over time.
+
+    Rates of units are extracted first into (units x trials x time) array in
+    shared memory, that worker processes then run the analysis on by ranges
+    of units, instead of passing Unit objects to them.
 
-    # Run unit-wise AROC test in pool.
-    params = [(u, prd, ref_ev, trs_list[i], nrate, tstep,
-               n_perm, zscore_by, verbose) for i, u in enumerate(ulist)]
-    aroc_res = util.run_in_pool(run_unit_ROC_over_time, params)
+    store: (folder, dataset name) of store to append results (and number of
+           sampled trials, 'ntrs') of each range of units to as soon as they
+           finish (see rocutil.append_to_store).
+
+    Returns AROC, p-value, lower and upper bootstrap confidence limit and
+    cluster corrected p-value DataFrames (see unit_ROC_tests, all NaN if not
+    calculated).
+    """
 
-    # Separate AUC and p-values.
-    aroc_dict = {u.Name: aroc.auc for u, aroc in zip(ulist, aroc_res)}
-    pval_dict = {u.Name: aroc.pval for u, aroc in zip(ulist, aroc_res)}
+    # Extract rates and targets of each unit.
+    urates = []
+    for i, u in enumerate(ulist):
+        if verbose:
+            print(u.Name)
+        urates.append(unit_rates_array(u, prd, ref_ev, trs_list[i], nrate,
+                                       tstep, zscore_by))
+
+    # Put rates and targets into shared memory.
+    rates_buf, y_buf, shape, tvec, ntrs = shared_rates_array(
+        [(r, tv) for r, uy, tv in urates])
+    rates, y = _shared['rates'], _shared['y']
+    for iu, (r, uy, tv) in enumerate(urates):
+        y[iu, :len(uy)] = uy
+    del urates
+
+    # Run AROC test on ranges of units in pool.
+    if nCPU is None:
+        nCPU = max(util.get_n_cores() - 1, 1)
+    iu_rngs = np.array_split(np.arange(len(ulist)), 4*nCPU)
+    params = [(iu[0], iu[-1]+1, ntrs[iu], n_perm, n_boot, clust_pth)
+              for iu in iu_rngs if len(iu)]
+    unames = [u.Name for u in ulist]
+
+    # Init store, with position of each of its time points in results.
+    if store is not None:
+        sdir, name = store
+        stvec = rocutil.init_store(sdir, name, tvec)
+        ipos = np.clip(np.searchsorted(tvec, stvec), 0, max(len(tvec)-1, 0))
+        in_res = (tvec[ipos] == stvec) if len(tvec) else np.zeros(0, bool)
+        fields = [(0, 'aroc'), (5, 'ntrs')]
+        if n_perm is not None and n_perm > 0:
+            fields.append((1, 'pval'))
+        if n_boot is not None and n_boot > 0:
+            fields.extend([(2, 'ci_lo'), (3, 'ci_hi')])
+        if clust_pth is not None and n_perm is not None and n_perm > 0:
+            fields.append((4, 'cpval'))
+
+    # Run AROC test on ranges of units in pool.
+    res = []
+    for prms, r in zip(params,
+                       util.imap_in_pool(run_units_ROC_over_time, params,
+                                         nCPU, initializer=init_shared_rates,
+                                         initargs=(rates_buf, y_buf, shape))):
+        res.append(r)
+
+        # Append results to store.
+        if store is not None:
+            iu1, iu2 = prms[:2]
+            ntrs_smpl = (~np.isnan(rates[iu1:iu2])).sum(1)
+            ures = np.concatenate([r, ntrs_smpl[None]])
+            smat = np.full(ures.shape[:2] + (len(stvec),), np.nan)
+            smat[:, :, in_res] = ures[:, :, ipos[in_res]]
+            rocutil.append_to_store(sdir, name, unames[iu1:iu2],
+                                    {f: smat[i] for i, f in fields})
+    _shared.clear()
 
     # Concat into DF.
-    aroc_res = pd.concat(aroc_dict, axis=1).T
-    pval_res = pd.concat(pval_dict, axis=1).T
+    res = [pd.DataFrame(np.concatenate([r[i] for r in res]), index=unames,
+                        columns=tvec) for i in range(5)]
 
-    return aroc_res, pval_res
+    # Remove time points with less then 2 sampled trials in all units.
+    n_non_nan_trs = (~np.isnan(rates)).sum(1).max(0)
+    res = [df.loc[:, n_non_nan_trs >= 2] for df in res]
+
+    return res
 
 
 def calc_AROC(ulist, trs_list, prd_pars, n_perm, nrate, tstep, fres,
-              verbose=True, rem_all_nan_units=True, rem_any_nan_times=True):
-    """Calculate and plot AROC over time between specified sets of trials."""
+              verbose=True, rem_all_nan_units=True, rem_any_nan_times=True,
+              n_boot=None, clust_pth=None, resume=False):
+    """
+    Calculate and plot AROC over time between specified sets of trials.
+
+    Results of each unit are appended to the store of the result file as
+    they finish, so that an interrupted run can be continued by resume=True,
+    running only units without results.
+
+    n_boot: number of bootstrap resamples for confidence interval of AROC,
+            saved as 'ci_lo' and 'ci_hi' into results (0 or None: no
+            bootstrapping).
+    clust_pth: pointwise p-value threshold of cluster-mass correction of
+               permutation test, cluster p-values are saved as 'cpval'
+               (None: no correction).
+    """
 
-    stims = prd_pars.index
-    aroc_list, pval_list = [], []
-    for stim in stims:
+    stim_res = []
+    for stim in prd_pars.index:
         print('    ' + stim)
 
         # Extract period params.
         pars = ['prd', 'ref_ev', 'feat', 'cond_by', 'zscore_by']
         prd, ref_ev, sfeat, sep_by, zscore_by = prd_pars.loc[stim, pars]
 
-        # Calculate AROC DF.
-        aroc, pval = run_group_ROC_over_time(ulist, trs_list[stim], prd,
-                                             ref_ev, n_perm, nrate, tstep,
-                                             zscore_by, verbose)
-        aroc_list.append(aroc)
-        pval_list.append(pval)
+        # Without result file, calculate AROC DF in memory.
+        if fres is None:
+            res = run_group_ROC_over_time(ulist, trs_list[stim], prd, ref_ev,
+                                          n_perm, nrate, tstep, zscore_by,
+                                          verbose, n_boot=n_boot,
+                                          clust_pth=clust_pth)
+            stim_res.append(res)
+            continue
+
+        # Calculate AROC of units not in store yet, appending them to it.
+        sdir = rocutil.aroc_store_dir(fres)
+        if not resume:
+            rocutil.reset_store(sdir, stim)
+        done = rocutil.stored_units(sdir, stim)
+        itodo = [i for i, u in enumerate(ulist) if u.Name not in done]
+        if len(itodo):
+            run_group_ROC_over_time([ulist[i] for i in itodo],
+                                    [trs_list[stim][i] for i in itodo], prd,
+                                    ref_ev, n_perm, nrate, tstep, zscore_by,
+                                    verbose, n_boot=n_boot,
+                                    clust_pth=clust_pth, store=(sdir, stim))
+
+        # Load results of all units, removing time points with less then 2
+        # sampled trials in all units.
+        unames = [u.Name for u in ulist]
+        sres = rocutil.load_from_store(sdir, stim, aroc_fields + ['ntrs'],
+                                       unames)
+        to_keep = sres['ntrs'].max() >= 2
+        res = [sres[f].loc[unames, to_keep] for f in aroc_fields]
+        stim_res.append(res)
+
+    # Concatenate and save stimulus-specific results.
+    aroc, pval = save_AROC(stim_res, prd_pars, n_perm, nrate, tstep, fres,
+                           rem_all_nan_units, rem_any_nan_times, n_boot,
+                           clust_pth)
+
+    return aroc, pval
+
+
+def save_AROC(stim_res, prd_pars, n_perm, nrate, tstep, fres,
+              rem_all_nan_units=True, rem_any_nan_times=True, n_boot=None,
+              clust_pth=None):
+    """
+    Concatenate stimulus-specific AROC results (list of AROC, p-value,
+    lower and upper bootstrap confidence limit and cluster p-value
+    DataFrames per stimulus of prd_pars) and save them.
+    """
+
+    aroc_list, pval_list, cilo_list, cihi_list, cpval_list = zip(*stim_res)
 
     # Concatenate stimulus-specific results.
     tshifts = list(prd_pars.stim_start)
     truncate_prds = [list(prd_pars.loc[stim, ['prd_start', 'prd_stop']])
-                     for stim in stims]
+                     for stim in prd_pars.index]
 
     aroc = util.concat_stim_prd_res(aroc_list, tshifts, truncate_prds,
                                     rem_all_nan_units, rem_any_nan_times)
@@ -215,33 +603,264 @@ def calc_AROC(ulist, trs_list, prd_pars, n_perm, nrate, tstep, fres,
     if pval.empty:
         pval = pd.DataFrame(columns=pval.columns, index=aroc.index)
 
-    # Save results.
+    # Bootstrap confidence interval, aligned to AROC results.
+    if n_boot is not None and n_boot > 0:
+        ci_lo, ci_hi = [util.concat_stim_prd_res(ci_list, tshifts,
+                                                 truncate_prds, False, False)
+                        for ci_list in (cilo_list, cihi_list)]
+        ci_lo, ci_hi = [ci.reindex(index=aroc.index, columns=aroc.columns)
+                        for ci in (ci_lo, ci_hi)]
+
+    # Cluster corrected p-values, aligned to AROC results.
+    if clust_pth is not None:
+        cpval = util.concat_stim_prd_res(cpval_list, tshifts, truncate_prds,
+                                         False, False)
+        cpval = cpval.reindex(index=aroc.index, columns=aroc.columns)
+
+    # Save result matrices into store (to be loaded lazily by
+    # rocutil.load_aroc_file) and parameters into result file.
     if fres is not None:
-        aroc_res = {'aroc': aroc, 'pval': pval, 'nrate': nrate,
-                    'tstep': tstep, 'n_perm': n_perm}
+        aroc_res = {'nrate': nrate, 'tstep': tstep, 'n_perm': n_perm}
+        res = {'aroc': aroc, 'pval': pval}
+        if n_boot is not None and n_boot > 0:
+            res.update({'ci_lo': ci_lo, 'ci_hi': ci_hi})
+            aroc_res['n_boot'] = n_boot
+        if clust_pth is not None:
+            res['cpval'] = cpval
+            aroc_res['clust_pth'] = clust_pth
+
+        sdir = rocutil.aroc_store_dir(fres)
+        rocutil.reset_store(sdir, 'AROC')
+        rocutil.init_store(sdir, 'AROC', np.array(aroc.columns))
+        res = {name: np.array(df.reindex(index=aroc.index,
+                                         columns=aroc.columns), dtype=float)
+               for name, df in res.items()}
+        rocutil.append_to_store(sdir, 'AROC', list(aroc.index), res)
+        aroc_res['stored_fields'] = list(res.keys())
         util.write_objects(aroc_res, fres)
 
     return aroc, pval
 
 
+# %% Sweep of ROC analyses across features and parameters.
+
+def feat_trials(u, feat, stim, offsets):
+    """Return pair of trial sets of unit to run ROC between for feature."""
+
+    if feat == 'DS':
+        trs = u.dir_pref_anti_trials(stim, [stim], offsets)
+    elif feat == 'CE':
+        trs = u.S_D_trials('S2', offsets)
+    else:
+        print('Unknown feature to run ROC on: ', feat)
+        trs = None
+
+    return trs
+
+
+def unit_sweep_rates(u, prd, ref_ev, nrate, trs_sets, zscore_by):
+    """
+    Return rates of unit at full resolution of rate in (trials x time) array
+    across union of trials of all pairs of trial sets, with its time vector,
+    the masks of each trial set of each pair (pairs x 2 x trials), the time
+    of the first sample of each trial and the z-scoring group of each trial.
+    """
+
+    # Union of trials and masks of trial sets.
+    trs = np.unique(np.concatenate([np.array(t, dtype=int)
+                                    for trs_pair in trs_sets
+                                    for t in trs_pair]))
+    masks = np.array([[np.isin(trs, t) for t in trs_pair]
+                      for trs_pair in trs_sets])
+
+    # Extract rates at every sample.
+    t1s, t2s = u.pr_times(prd, concat=False)
+    ref_ts = u.ev_times(ref_ev)
+    rate = u._Rates[nrate]
+    smpl_idxs, col_idxs, tvec = rate.get_sample_idxs(trs, t1s, t2s, ref_ts)
+    rates = rate.get_rates_array(trs, smpl_idxs, col_idxs, len(tvec))
+
+    # Time of first sample of each trial.
+    tfirst = np.full(len(trs), np.nan)
+    if col_idxs.shape[1]:
+        is_smpl = col_idxs[:, 0] >= 0
+        tfirst[is_smpl] = tvec[col_idxs[is_smpl, 0]]
+
+    # Z-scoring group of each trial.
+    zgrps = np.full(len(trs), np.nan)
+    if zscore_by is not None:
+        for i, itrs in enumerate(u.trials_by_param(zscore_by)):
+            zgrps[np.isin(trs, itrs)] = i
+
+    return rates, tvec, masks, tfirst, zgrps
+
+
+def run_units_ROC_sweep(iu1, iu2, ntrs, masks, tfirst, zgrps, tvec, step,
+                        isteps, n_perm, n_boot=None, clust_pth=None):
+    """
+    Run ROC analysis over time of range of units of shared rate array, for
+    each pair of trial sets (given by masks) and time step (in number of rate
+    samples), with optional permutation test, bootstrap confidence interval
+    and cluster correction (see unit_ROC_tests). Suitable for
+    parallelization.
+
+    Returns (units x trial set pairs x time steps x 6 x time) array of AROC,
+    p-value, lower and upper confidence limit, cluster p-value and number of
+    sampled trials.
+    """
+
+    rates = _shared['rates']
+    npairs = masks.shape[1]
+
+    res = np.full((iu2-iu1, npairs, len(isteps), 6, len(tvec)), np.nan)
+    for i, iu in enumerate(range(iu1, iu2)):
+        urates = rates[iu, :ntrs[i]]
+
+        # Sample number of each time point relative to first sample of trial.
+        dt = tvec[None, :] - tfirst[i, :ntrs[i], None]
+        with np.errstate(invalid='ignore'):
+            ksmpl = np.round(dt / step)
+
+        for j in range(npairs):
+
+            # Rates and targets of trial set pair.
+            m1, m0 = masks[i, j, :, :ntrs[i]]
+            itrs = np.concatenate([np.where(m1)[0], np.where(m0)[0]])
+            y = np.concatenate([np.ones(m1.sum()), np.zeros(m0.sum())])
+
+            for k, istep in enumerate(isteps):
+
+                # Rates sampled by time step, z-scored within trial sets.
+                with np.errstate(invalid='ignore'):
+                    is_smpl = ksmpl[itrs] % istep == 0
+                cols = is_smpl.any(0)
+                X = np.where(is_smpl[:, cols], urates[itrs][:, cols], np.nan)
+                if not np.isnan(zgrps[i, itrs]).all():
+                    X = util.zscore_by_group(X, zgrps[i, itrs], axis=0)
+
+                # Run AROC test.
+                ures = res[i, j, k]
+                ures[:5, cols] = unit_ROC_tests(X, y, n_perm, n_boot,
+                                                clust_pth)
+                ures[5, cols] = (~np.isnan(X)).sum(0)
+
+    return res
+
+
+def run_ROC_sweep(ulist, feats, offsets_list, nrates, tsteps, prd_pars,
+                  n_perm, aroc_res_dir, nlist, n_boot=None, clust_pth=None,
+                  verbose=True, nCPU=None):
+    """
+    Run ROC over time on list of units for all combinations of features,
+    direction offsets, rates and time steps, and save results of each
+    configuration into its result file (as run_ROC does).
+
+    Rates of each unit are extracted only once per rate and stimulus period
+    (at full rate resolution), and the trial sets of all features and
+    offsets are taken as boolean masks over these trials. All
+    configurations are then run on each range of units in a single pass.
+    """
+
+    # Init.
+    if nCPU is None:
+        nCPU = max(util.get_n_cores() - 1, 1)
+    unknown = [feat for feat in feats if feat not in feat_pars.index]
+    if len(unknown):
+        raise ValueError('Unknown feature(s): ' + ', '.join(unknown))
+    pairs = [(feat, offsets) for feat in feats for offsets in offsets_list]
+    unames = [u.Name for u in ulist]
+
+    sweep_res = {}
+    for nrate in nrates:
+
+        # Time steps in number of rate samples.
+        rate_step = ulist[0]._Rates[nrate].step
+        step = float(rate_step.rescale('ms'))
+        isteps = [int(tstep/rate_step) if tstep is not None else 1
+                  for tstep in tsteps]
+
+        for stim in prd_pars.index:
+            if verbose:
+                print('    {}, {}'.format(nrate, stim))
+
+            # Extract period params.
+            pars = ['prd', 'ref_ev', 'zscore_by']
+            prd, ref_ev, zscore_by = prd_pars.loc[stim, pars]
+
+            # Extract rates and trial set masks of each unit.
+            urates = []
+            for u in ulist:
+                trs_sets = [feat_trials(u, feat, stim, offsets)
+                            for feat, offsets in pairs]
+                urates.append(unit_sweep_rates(u, prd, ref_ev, nrate,
+                                               trs_sets, zscore_by))
+
+            # Put rates into shared memory, and pad trial params by units.
+            rates_buf, y_buf, shape, tvec, ntrs = shared_rates_array(
+                [(ur[0], ur[1]) for ur in urates])
+            masks = np.zeros((len(ulist), len(pairs), 2, shape[1]), bool)
+            tfirst, zgrps = [np.full(shape[:2], np.nan) for i in range(2)]
+            for iu, (r, tv, umasks, utfirst, uzgrps) in enumerate(urates):
+                masks[iu, :, :, :len(r)] = umasks
+                tfirst[iu, :len(r)] = utfirst
+                zgrps[iu, :len(r)] = uzgrps
+            del urates
+
+            # Run all configurations on ranges of units in pool.
+            iu_rngs = np.array_split(np.arange(len(ulist)), 4*nCPU)
+            params = [(iu[0], iu[-1]+1, ntrs[iu], masks[iu], tfirst[iu],
+                       zgrps[iu], tvec, step, isteps, n_perm, n_boot,
+                       clust_pth)
+                      for iu in iu_rngs if len(iu)]
+            res = util.run_in_pool(run_units_ROC_sweep, params, nCPU,
+                                   initializer=init_shared_rates,
+                                   initargs=(rates_buf, y_buf, shape))
+            _shared.clear()
+            res = np.concatenate(res)
+
+            # Collect results into DFs, removing time points with less than
+            # 2 sampled trials in all units.
+            for j, k in [(j, k) for j in range(len(pairs))
+                         for k in range(len(tsteps))]:
+                to_keep = res[:, j, k, 5].max(0) >= 2
+                stim_res = [pd.DataFrame(res[:, j, k, i][:, to_keep],
+                                         index=unames, columns=tvec[to_keep])
+                            for i in range(5)]
+                sweep_res.setdefault((j, nrate, k), []).append(stim_res)
+
+    # Concatenate and save results of each configuration.
+    for (j, nrate, k), stim_res in sweep_res.items():
+        feat, offsets = pairs[j]
+        ares_dir = aroc_res_dir + '{}/{}/'.format(feat, nlist)
+        fres = rocutil.aroc_res_fname(ares_dir, nrate, tsteps[k], n_perm,
+                                      offsets)
+        save_AROC(stim_res, prd_pars, n_perm, nrate, tsteps[k], fres,
+                  n_boot=n_boot, clust_pth=clust_pth)
+
+
 # %% ROC misc functions.
 
 def run_ROC(ulist, trs_list, nrate, tstep, n_perm, offsets, prd_pars,
-            ares_dir):
+            ares_dir, n_boot=None, clust_pth=None):
 
     # Calculate and save AROC results.
     fres = rocutil.aroc_res_fname(ares_dir, nrate, tstep, n_perm, offsets)
-    calc_AROC(ulist, trs_list, prd_pars, n_perm, nrate, tstep, fres)
+    calc_AROC(ulist, trs_list, prd_pars, n_perm, nrate, tstep, fres,
+              n_boot=n_boot, clust_pth=clust_pth)
 
 
 def plot_ROC(nrate, task, sort_prds, prd_pars, tstep, n_perm, offsets, prefix,
              btw_str, pth, min_len, vth_hi, vth_lo, cmaps,  merge_hi_lo,
-             flip_aroc_vals, ares_dir, t1=None, t2=None):
+             flip_aroc_vals, ares_dir, t1=None, t2=None, clust_corr=False):
 
     # Plot AROC matrix sorted by different periods.
     res = rocutil.load_aroc_res(ares_dir, nrate, tstep, n_perm, offsets)
     aroc, pval = res['aroc'], res['pval']
 
+    # Use cluster corrected p-values, if requested and available.
+    if clust_corr and 'cpval' in res:
+        pval = res['cpval']
+
     # Plot results on heatmap.
     rocpost.plot_ROC_heatmap(aroc, pval, task, nrate, tstep, n_perm,
                              sort_prds, prd_pars, offsets, ares_dir,
@@ -262,15 +881,11 @@ def run_plot_feat_ROC(task, feat, feat_params, sort_prds, prd_pars, stims,
     if runroc:
 
         # Collect trials to use.
-        if feat == 'DS':
-            trs_list = {stim: [u.dir_pref_anti_trials(stim, [stim], offsets)
-                        for u in ulist] for stim in stims}
-        elif feat == 'CE':
-            trs_list = {stim: [u.S_D_trials('S2', offsets)
-                        for u in ulist] for stim in stims}
-        else:
+        if feat not in feat_pars.index:
             print('Unknown feature to run ROC on: ', feat)
             return
+        trs_list = {stim: [feat_trials(u, feat, stim, offsets)
+                           for u in ulist] for stim in stims}
 
         # Run ROC.
         run_ROC(ulist, trs_list, nrate, tstep, n_perm, offsets, prd_pars,
@@ -11,7 +11,7 @@ import pandas as pd
 from quantities import ms
 
 from seal.util import util, constants
-from seal.plot import pauc
+from seal.plot import putil, pauc
 from seal.roc import rocutil
 
 
@@ -29,43 +29,58 @@ def get_v_ths(vth_hi, vth_lo, n_perm):
     return vth_hi, vth_lo
 
 
-def first_period(vauc, pvec, min_len, pth=None, vth_hi=0.5, vth_lo=0.5):
+def first_periods(aroc, pval, min_len, pth=None, vth_hi=0.5, vth_lo=0.5):
     """
     Return effect direction and times of earliest period with given length
-    above or below value threshold and below p-value threshold (both optional).
+    above or below value threshold and below p-value threshold (both optional)
+    of each unit (row) of AROC matrix.
     """
 
-    # Indices with significant p-values.
-    sign_idx = pd.Series(True, index=vauc.index, name=vauc.name)
-    if (pth is not None) and (pvec is not None) and (not pvec.isnull().all()):
-        sign_idx = pvec < pth
+    vauc = np.array(aroc, dtype=float)
 
-    # Indices above and below value thresholds and with significant p values.
-    sig_hi = (vauc >= vth_hi) & sign_idx
-    sig_lo = (vauc <= vth_lo) & sign_idx
+    # Indices with significant p-values (units without p-values are all
+    # taken as significant).
+    sign_idx = np.ones(vauc.shape, dtype=bool)
+    if (pth is not None) and (pval is not None):
+        pvec = np.array(pval, dtype=float)
+        has_p = ~np.isnan(pvec).all(1)
+        sign_idx[has_p] = pvec[has_p] < pth
 
-    # Corresponding periods with minimum length.
-    hi_prds = util.long_periods(sig_hi, min_len)
-    lo_prds = util.long_periods(sig_lo, min_len)
+    # Indices above and below value thresholds and with significant p values.
+    with np.errstate(invalid='ignore'):
+        sig_hi = (vauc >= vth_hi) & sign_idx
+        sig_lo = (vauc <= vth_lo) & sign_idx
 
-    # Earliest periods of each.
-    first_hi_run = pd.Series(hi_prds.apply(min)).min()
-    first_lo_run = pd.Series(lo_prds.apply(min)).min()
+    # Earliest periods with minimum length of each.
+    first_hi_run = util.first_long_runs(sig_hi, aroc.columns, min_len)
+    first_lo_run = util.first_long_runs(sig_lo, aroc.columns, min_len)
 
     # Do different runs exist at all?
-    hi_run = not np.isnan(first_hi_run)
-    lo_run = not np.isnan(first_lo_run)
+    hi_run = ~np.isnan(first_hi_run)
+    lo_run = ~np.isnan(first_lo_run)
 
     # Select first significant period and effect direction, if any exists.
-    if hi_run and lo_run:
-        t = np.nanmin([first_hi_run, first_lo_run])
-        effect_dir = 'high' if first_hi_run < first_lo_run else 'low'
-    elif hi_run and not lo_run:
-        t, effect_dir = first_hi_run, 'high'
-    elif lo_run and not hi_run:
-        t, effect_dir = first_lo_run, 'low'
-    else:
-        t, effect_dir = np.nan, 'none'
+    is_hi = hi_run & (~lo_run | (first_hi_run < first_lo_run))
+    is_lo = lo_run & ~is_hi
+    t = np.where(is_hi, first_hi_run, first_lo_run)
+    effect_dir = np.where(is_hi, 'high', np.where(is_lo, 'low', 'none'))
+
+    effres = pd.DataFrame({'time': t, 'effect_dir': effect_dir},
+                          columns=['time', 'effect_dir'], index=aroc.index)
+
+    return effres
+
+
+def first_period(vauc, pvec, min_len, pth=None, vth_hi=0.5, vth_lo=0.5):
+    """
+    Return effect direction and times of earliest period with given length
+    above or below value threshold and below p-value threshold (both optional).
+    """
+
+    pval = pvec.to_frame().T if pvec is not None else None
+    effres = first_periods(vauc.to_frame().T, pval, min_len, pth, vth_hi,
+                           vth_lo)
+    t, effect_dir = effres.iloc[0]
 
     return t, effect_dir
 
@@ -78,10 +93,7 @@ def sort_by_time(aroc, pval, tmin, tmax, merge_hi_lo=False, fout=None,
     aroc_w, pval_w = [df.loc[:, float(tmin):float(tmax)] for df in (aroc, pval)]
 
     # Get timing of first significant run of each unit.
-    efftime = [first_period(aroc_w.loc[uid], pval_w.loc[uid], **kwargs)
-               for uid in aroc.index]
-    effres = pd.DataFrame(efftime, columns=['time', 'effect_dir'],
-                          index=aroc.index)
+    effres = first_periods(aroc_w, pval_w, **kwargs)
 
     # Sort by effect timing.
     effs_list = ([['high', 'low'], ['none']] if merge_hi_lo else
@@ -90,8 +102,9 @@ def sort_by_time(aroc, pval, tmin, tmax, merge_hi_lo=False, fout=None,
                   for effs in effs_list]
     sorted_res = pd.concat(sorted_dfs)
 
-    # Export table as Excel table
-    util.save_sheets([sorted_res], 'effect results', fout)
+    # Export table (format set by file extension).
+    if fout is not None:
+        util.export_table(sorted_res, fout, 'effect results')
 
     return sorted_res
 
@@ -113,7 +126,7 @@ def plot_AROC_heatmap(aroc, prd_pars, title, cmap='jet',
         # Skip stimuli without overlap with results.
         if aroc.columns.max() <= ton or aroc.columns.min() >= toff:
             continue
-        ion, ioff = [int(np.where(np.array(aroc.columns) == t)[0])
+        ion, ioff = [int(np.searchsorted(aroc.columns, t, 'right')) - 1
                      for t in (ton, toff)]
         events.loc[stim+' on'] = (ion, stim+' on')
         events.loc[stim+' off'] = (ioff, stim+' off')
@@ -128,43 +141,52 @@ def plot_ROC_heatmap(aroc, pval, task, nrate, tstep, n_perm, sort_prds,
                      prd_pars, offsets, res_dir, prefix, btw_str, pth=0.05,
                      min_len=30*ms, vth_hi=0.7, vth_lo=0.3, cmaps=['coolwarm'],
                      merge_hi_lo=False, flip_aroc_vals=False,
-                     t1=None, t2=None, title=None, fig=None):
-    """Plot heatmap sorted by timing of first significant period."""
+                     t1=None, t2=None, title=None, fig=None,
+                     table_fmts=('csv',), nCPU=None):
+    """
+    Plot heatmap sorted by timing of first significant period.
+
+    Units are sorted once by each period, with results tables exported in
+    each format of table_fmts (e.g. 'csv', 'parquet' and 'xlsx'), then all
+    (sorting x colormap) figures are rendered in pool (unless fig is given).
+    """
 
     # Init time period to be plotted.
     t1 = float(t1.rescale(ms)) if t1 is not None else aroc.columns.min()
     t2 = float(t2.rescale(ms)) if t2 is not None else aroc.columns.max()
 
-    # For each period.
+    # Flip values < 0.5 around 0.5 (all values v: 0.5 <= v <= 1).
+    aroc_plot = aroc.copy()
+    if flip_aroc_vals:
+        idx = aroc_plot < 0.5
+        aroc_plot[idx] = 1 - aroc_plot[idx]
+
+    # Truncate results to period requested.
+    aroc_plot = aroc_plot.loc[:, t1:t2]
+
+    # Sort units by each period.
+    fig_params = []
     for sort_prd in sort_prds:
         if sort_prd == 'unsorted':
-            aroc_sorted = aroc.copy()
-            pval_sorted = pval.copy()
+            aroc_sorted = aroc_plot
         else:
             tmin, tmax = constants.fixed_tr_prds.loc[sort_prd]
 
-            # Sorted by effect size and save into table.
-            ftable = rocutil.aroc_table_fname(res_dir, task, nrate, tstep,
-                                              n_perm, offsets, sort_prd,
-                                              min_len, pth, vth_hi, vth_lo)
+            # Sorted by effect size and save into tables.
             sres = sort_by_time(aroc, pval, tmin, tmax, min_len=min_len,
                                 pth=pth, vth_hi=vth_hi, vth_lo=vth_lo,
-                                merge_hi_lo=merge_hi_lo, fout=ftable)
+                                merge_hi_lo=merge_hi_lo)
+            for fmt in table_fmts:
+                ftable = rocutil.aroc_table_fname(res_dir, task, nrate, tstep,
+                                                  n_perm, offsets, sort_prd,
+                                                  min_len, pth, vth_hi,
+                                                  vth_lo, fmt)
+                util.export_table(sres, ftable, 'effect results')
 
             # Sort AROC matrix.
-            aroc_sorted = aroc.loc[sres.index]
-            pval_sorted = pval.loc[sres.index]
-
-        # Flip values < 0.5 around 0.5 (all values v: 0.5 <= v <= 1).
-        if flip_aroc_vals:
-            idx = aroc_sorted < 0.5
-            aroc_sorted[idx] = 1 - aroc_sorted[idx]
-
-        # Truncate results to period requested.
-        aroc_sorted = aroc_sorted.loc[:, t1:t2]
-        pval_sorted = pval_sorted.loc[:, t1:t2]
+            aroc_sorted = aroc_plot.loc[sres.index]
 
-        # Plot heatmap with sorted units.
+        # Collect params of heatmap with sorted units per colormap.
         nunits = len(aroc_sorted)
         ttl = rocutil.aroc_fig_title(btw_str, task, nunits, offsets,
                                      sort_prd) if title is None else title
@@ -172,4 +194,13 @@ def plot_ROC_heatmap(aroc, pval, task, nrate, tstep, n_perm, sort_prds,
         for cmap in cmaps:
             ffig = rocutil.aroc_fig_fname(res_dir, prefix, offsets,
                                           cmap, sort_prd)
-            plot_AROC_heatmap(aroc_sorted, prd_pars, ttl, cmap, ffig, fig)
+            fig_params.append((aroc_sorted, prd_pars, ttl, cmap, ffig, fig))
+
+    # Render figures, in worker processes with non-interactive backend.
+    if fig is not None:
+        nCPU = 1
+    elif nCPU is None:
+        nCPU = max(min(util.get_n_cores() - 1, len(fig_params)), 1)
+    initializer = putil.use_agg_backend if nCPU > 1 else None
+    util.run_in_pool(plot_AROC_heatmap, fig_params, nCPU, chunksize=1,
+                     initializer=initializer)
@@ -6,8 +6,18 @@ ROC analyses.
 @author: David Samu
 """
 
+import os
+
+import numpy as np
+import pandas as pd
+
 from seal.util import util
 
+# Data type (and file extension) of results in store, double precision to
+# keep small (e.g. permutation) p-values unrounded.
+store_dtype = np.dtype('<f8')
+store_ext = '.f64'
+
 
 # %% Utility functions to get file names, and import / export data.
 
@@ -45,8 +55,11 @@ def aroc_fig_title(between_str, task, nunits, offsets, sort_prd=None):
 
 
 def aroc_table_fname(res_dir, task, nrate, tstep, n_perm, offsets,
-                     sort_prd, min_len, pth, vth_hi, vth_lo):
-    """Return full path to AROC results table with given parameters."""
+                     sort_prd, min_len, pth, vth_hi, vth_lo, ext='csv'):
+    """
+    Return full path to AROC results table with given parameters and format
+    (file extension, e.g. 'xlsx', 'csv' or 'parquet').
+    """
 
     ostr = '_'.join([str(int(d)) for d in offsets])
     ftable = ('{}_{}_tstep{}ms_nperm{}_offs{}'.format(task, nrate, int(tstep),
@@ -54,14 +67,186 @@ def aroc_table_fname(res_dir, task, nrate, tstep, n_perm, offsets,
               '_prd{}_minlen{}_pth{}'.format(sort_prd, int(min_len), pth) +
               '_vthhi{}_vthlo{}'.format(vth_hi, vth_lo))
     ftable = util.join([res_dir+'tables',
-                        util.format_to_fname(ftable)+'.xlsx'])
+                        util.format_to_fname(ftable)+'.'+ext])
     return ftable
 
 
-def load_aroc_res(res_dir, nrate, tstep, n_perm, offsets):
-    """Load AROC results."""
+def load_aroc_res(res_dir, nrate, tstep, n_perm, offsets, units=None,
+                  t1=None, t2=None):
+    """Load AROC results, optionally of some units and time window only."""
 
     fres = aroc_res_fname(res_dir, nrate, tstep, n_perm, offsets)
+    aroc_res = load_aroc_file(fres, units, t1, t2)
+
+    return aroc_res
+
+
+def load_aroc_file(fres, units=None, t1=None, t2=None):
+    """
+    Load AROC results from file, optionally of some units and time window
+    only. Result matrices saved into store (see save_AROC in roccore) are
+    read lazily, only loading the rows and columns requested.
+    """
+
     aroc_res = util.read_objects(fres)
 
+    # Load result matrices from store.
+    if 'stored_fields' in aroc_res:
+        sdir = aroc_store_dir(fres)
+        res = load_from_store(sdir, 'AROC', aroc_res['stored_fields'], units,
+                              t1, t2)
+        aroc_res.update(res)
+
+    # Select units and time window of results saved in full.
+    else:
+        for name, res in aroc_res.items():
+            if not isinstance(res, pd.DataFrame):
+                continue
+            if units is not None:
+                res = res.loc[res.index.isin(units)]
+            tvec = np.array(res.columns, dtype=float)
+            tmin = t1 if t1 is not None else -np.inf
+            tmax = t2 if t2 is not None else np.inf
+            aroc_res[name] = res.loc[:, (tvec >= tmin) & (tvec <= tmax)]
+
     return aroc_res
+
+
+# %% Append-only store of AROC results of units.
+
+def aroc_store_dir(fres):
+    """Return folder of store of AROC result file."""
+
+    sdir = os.path.splitext(fres)[0] + '_store/'
+    return sdir
+
+
+def store_fname(sdir, name, field):
+    """Return name of file of field of dataset in store."""
+
+    fname = sdir + '{}.{}'.format(name, field)
+    return fname
+
+
+def stored_units(sdir, name):
+    """Return names of units with results in dataset of store."""
+
+    funits = store_fname(sdir, name, 'units')
+    if not os.path.isfile(funits):
+        return []
+
+    with open(funits) as f:
+        units = f.read().splitlines()
+
+    return units
+
+
+def reset_store(sdir, name):
+    """Remove dataset from store."""
+
+    if not os.path.isdir(sdir):
+        return
+
+    for f in os.listdir(sdir):
+        if f.startswith(name + '.'):
+            os.remove(sdir + f)
+
+
+def init_store(sdir, name, tvec):
+    """
+    Init dataset of store with time vector, or return time vector of
+    existing dataset (to resume appending results to it), dropping any rows
+    not completely written.
+    """
+
+    ftvec = store_fname(sdir, name, 'tvec.npy')
+
+    # Init new dataset.
+    if not os.path.isfile(ftvec):
+        util.create_dir(ftvec)
+        np.save(ftvec, np.array(tvec))
+        open(store_fname(sdir, name, 'units'), 'w').close()
+        return np.array(tvec)
+
+    # Truncate rows of existing dataset to those of committed units.
+    tvec = np.load(ftvec)
+    nbytes = len(stored_units(sdir, name)) * len(tvec) * store_dtype.itemsize
+    for f in os.listdir(sdir):
+        if (f.startswith(name + '.') and f.endswith(store_ext) and
+                os.path.getsize(sdir + f) > nbytes):
+            with open(sdir + f, 'r+b') as fd:
+                fd.truncate(nbytes)
+
+    return tvec
+
+
+def stored_rows(fname, ntimes):
+    """Return number of rows (units) in field file of store."""
+
+    if not os.path.isfile(fname) or not ntimes:
+        return 0
+
+    nrows = os.path.getsize(fname) // (ntimes * store_dtype.itemsize)
+    return nrows
+
+
+def append_to_store(sdir, name, units, res):
+    """
+    Append results of units (dict of field name and (units x time) array) to
+    dataset of store. Units are committed (listed as stored) only after all
+    their results have been written.
+
+    Fields missing for units already in store (e.g. p-values, when resuming
+    with permutation test switched on) are padded by NaN.
+    """
+
+    nstored = len(stored_units(sdir, name))
+    for field, mat in res.items():
+        fname = store_fname(sdir, name, field + store_ext)
+        mat = np.asarray(mat, dtype=store_dtype)
+        npad = nstored - stored_rows(fname, mat.shape[1])
+        with open(fname, 'ab') as f:
+            if npad > 0:
+                pad = np.full((npad, mat.shape[1]), np.nan, dtype=store_dtype)
+                f.write(pad.tobytes())
+            f.write(mat.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    with open(store_fname(sdir, name, 'units'), 'a') as f:
+        f.write(''.join([u + '\n' for u in units]))
+
+
+def load_from_store(sdir, name, fields, units=None, t1=None, t2=None):
+    """
+    Load fields of dataset of store into DataFrames (units x time), reading
+    only rows of given units and columns of given time window. Units without
+    results in field (missing from end of field file) are returned as NaN.
+    """
+
+    # Select rows and columns to read.
+    tvec = np.load(store_fname(sdir, name, 'tvec.npy'))
+    all_units = np.array(stored_units(sdir, name), dtype=object)
+    irows = (np.arange(len(all_units)) if units is None else
+             np.where(np.isin(all_units, list(units)))[0])
+    tmin = t1 if t1 is not None else -np.inf
+    tmax = t2 if t2 is not None else np.inf
+    icols = np.where((tvec >= tmin) & (tvec <= tmax))[0]
+    cols = slice(icols[0], icols[-1]+1) if len(icols) else slice(0, 0)
+
+    # Read selected part of each field by memory mapping.
+    res = {}
+    for field in fields:
+        fname = store_fname(sdir, name, field + store_ext)
+        nrows = min(stored_rows(fname, len(tvec)), len(all_units))
+        mat = np.full((len(irows), len(tvec[cols])), np.nan)
+        if nrows:
+            mm = np.memmap(fname, dtype=store_dtype, mode='r',
+                           shape=(nrows, len(tvec)))
+            in_file = irows < nrows
+            mat[in_file] = mm[irows[in_file], cols]
+            del mm
+        res[field] = pd.DataFrame(mat, index=all_units[irows],
+                                  columns=tvec[cols])
+
+    return res
@@ -0,0 +1,210 @@
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+
+from seal.object.unit import Unit
+from seal.quality import test_units, test_RF, test_sorting, stream_qm
+
+
+class MockUnit:
+    """Minimal unit with spike times, recorded in some recording."""
+
+    def __init__(self, uid, task, ntrs):
+        self.uid, self.task, self.ntrs = uid, task, ntrs
+        self.SpikeParams = pd.DataFrame({'time': np.arange(10.)})
+
+    def is_empty(self):
+        return False
+
+    def waveforms_in_memory(self):
+        return True
+
+
+class MockUnitArray:
+    """Minimal UnitArray of units of two recordings in two tasks."""
+
+    def __init__(self):
+        ntrs = {('subj1', 'date1'): 100, ('subj2', 'date2'): 60}
+        self._tasks = ['task0', 'task1']
+        self._uids = [(subj, date, 'elec', ch, ux)
+                      for (subj, date) in ntrs
+                      for ch in (1, 2) for ux in (1, 2)]
+        self.Units = {(uid, task): MockUnit(uid, task, ntrs[uid[:2]])
+                      for uid in self._uids for task in self._tasks}
+
+    def uids(self):
+        return self._uids
+
+    def tasks(self):
+        return self._tasks
+
+    def get_unit(self, uid, task):
+        return self.Units[(uid, task)]
+
+
+class TestQualityChunks(TestCase):
+
+    def setUp(self):
+        self.UA = MockUnitArray()
+        self.utids = [(uid, task) for uid in self.UA.uids()
+                      for task in self.UA.tasks()]
+
+    def test_chunks_keep_recordings_apart(self):
+        for chunk_size in (1, 4, 100):
+            chunks = test_units.qm_chunks(self.utids, chunk_size)
+            self.assertEqual(sum(chunks, []), self.utids)
+            for chunk in chunks:
+                recs = set([uid[:2] for uid, task in chunk])
+                self.assertEqual(len(recs), 1)
+
+    def test_chunks_keep_channels_together(self):
+        chunks = test_units.qm_chunks(self.utids, 1)
+        chs = [set([uid[:-1] for uid, task in chunk]) for chunk in chunks]
+        for i, ch1 in enumerate(chs):
+            for ch2 in chs[i+1:]:
+                self.assertFalse(ch1 & ch2)
+
+    def test_drift_batches_by_recording_and_task(self):
+        batches = test_units.drift_batches(self.utids)
+        self.assertEqual(len(batches), 4)
+        for (subj, date, task), butids in batches.items():
+            for uid, t in butids:
+                self.assertEqual((uid[:2], t), ((subj, date), task))
+
+    def test_qm_units_two_recordings(self):
+        """Drift of units of two recordings in one chunk tested apart."""
+
+        drift_ulists = []
+
+        def test_drift_units(ulist):
+            self.assertEqual(len(set([u.ntrs for u in ulist])), 1)
+            drift_ulists.append(ulist)
+            return [(None, None, None, None, np.ones(10, dtype=bool))
+                    for u in ulist]
+
+        def isi_stats_units(spk_times_list):
+            n = len(spk_times_list)
+            return (pd.DataFrame(np.zeros((n, 2))), pd.Series(n*[None]),
+                    pd.Series(n*[None]))
+
+        test_units.init_shared_UA(self.UA, None)
+        with mock.patch.multiple(
+                'seal.quality.test_sorting', test_drift_units=test_drift_units,
+                isi_stats_units=isi_stats_units,
+                isolation_metrics_units=lambda ulist: len(ulist)*[None],
+                test_qm=mock.Mock(return_value=None)):
+            res_list = test_units.test_qm_units(self.utids)
+        test_units._shared.clear()
+
+        self.assertEqual(len(res_list), len(self.utids))
+        self.assertEqual(len(drift_ulists), 4)
+
+
+class MockRFUnit:
+    """Minimal unit with exclusion flag."""
+
+    def __init__(self, utid):
+        self.utid, self.excluded = utid, False
+
+    def get_utid(self):
+        return self.utid
+
+    def set_excluded(self, to_excl):
+        self.excluded = to_excl
+
+
+class TestRFCoverage(TestCase):
+
+    def test_low_coverage_of_both_stimuli(self):
+        """Units are excluded only if both stimuli cover RF poorly."""
+
+        covers = [(0.1, 0.1), (0.1, 0.9), (0.9, 0.1), (0.9, 0.9)]
+        ulist = [MockRFUnit(('subj', 'date', 'elec', ch, 1, 'task'))
+                 for ch in range(len(covers))]
+        idx = pd.MultiIndex.from_tuples([('subj_date', ch, 1, 'task')
+                                         for ch in range(len(covers))])
+        RF_res = pd.DataFrame({'S1_cover': [c1 for c1, c2 in covers],
+                               'S2_cover': [c2 for c1, c2 in covers],
+                               'S1_RF_cntr_cov': True,
+                               'S2_RF_cntr_cov': True}, index=idx)
+        UA = mock.Mock()
+        UA.iter_thru.return_value = ulist
+        UA.utids.side_effect = lambda: [u for u in ulist if not u.excluded]
+
+        test_RF.exclude_uncovered_units(UA, RF_res, cov_th=0.33)
+        self.assertEqual([u.excluded for u in ulist],
+                         [True, False, False, False])
+
+
+def stored_unit(name, nspk, store_dir, seed=0):
+    """Return unit with random spikes, written into spike store."""
+
+    rng = np.random.RandomState(seed)
+    u = Unit()
+    u.Name = name
+    u.SessParams = pd.Series({'subj': 'subj'}, dtype=object)
+    u.SpikeParams = pd.DataFrame({'time': np.sort(rng.uniform(0, 100, nspk))})
+    wf_t = 25. * np.arange(20)
+    wf = -200 * np.exp(-((wf_t - 200) / 60)**2)
+    wfs = np.round(wf * rng.uniform(0.5, 2, (nspk, 1)) +
+                   rng.normal(0, 20, (nspk, len(wf_t))))
+    u.Waveforms = pd.DataFrame(wfs, columns=wf_t)
+    u.save_spike_store(store_dir)
+
+    return u, pd.DataFrame(wfs, columns=wf_t)
+
+
+class TestSpikeStore(TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_waveforms_read_lazily(self):
+        u, wfs = stored_unit('unit 1', 1000, self.store_dir)
+
+        self.assertFalse(u.waveforms_in_memory())
+        self.assertEqual(len(u.Waveforms.index), 0)
+        self.assertIsInstance(u.waveform_array(), np.memmap)
+        self.assertTrue(np.array_equal(u.waveform_array(), wfs))
+        self.assertTrue(u.get_waveforms().equals(wfs))
+
+        u.load_waveforms()
+        self.assertTrue(u.waveforms_in_memory())
+        u.drop_waveforms()
+        self.assertFalse(u.waveforms_in_memory())
+
+    def test_streamed_qm_match_in_memory(self):
+        u, wfs = stored_unit('unit 1', 5000, self.store_dir)
+        stab_prd_res = pd.Series({'tstart': 20., 'tstop': 80.})
+        wf_res = stream_qm.stream_unit_qm(u, stab_prd_res, csize=700)
+
+        wf_stats, is_truncated, minV, maxV = (
+            test_sorting.calc_waveform_stats(wfs))
+        spk_times = np.array(u.SpikeParams['time'])
+        spk_inc = (spk_times >= 20) & (spk_times <= 80)
+        snr = test_sorting.calc_snr(wfs[spk_inc])
+
+        self.assertTrue(np.allclose(np.array(wf_res['wf_stats'], float),
+                                    np.array(wf_stats, float),
+                                    equal_nan=True))
+        self.assertEqual((wf_res['minV'], wf_res['maxV']), (minV, maxV))
+        self.assertAlmostEqual(wf_res['SNR'], snr)
+        self.assertTrue(spk_inc[wf_res['wf_sample'].index].all())
+
+    def test_isolation_on_memory_mapped_waveforms(self):
+        ulist, wf_list = zip(*[stored_unit('unit {}'.format(i), 3000,
+                                           self.store_dir, seed=i)
+                               for i in range(2)])
+        res_mmap = test_sorting.isolation_metrics_units(ulist)
+        for u in ulist:
+            u.load_waveforms()
+        res_mem = test_sorting.isolation_metrics_units(ulist)
+
+        for r1, r2 in zip(res_mmap, res_mem):
+            self.assertTrue(np.allclose(r1, r2, equal_nan=True))
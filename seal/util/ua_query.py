@@ -9,6 +9,7 @@ import warnings
 
 import numpy as np
 import pandas as pd
+from quantities import s
 
 from seal.util import kernels, util, constants
 from seal.object import unit, unitarray
@@ -179,6 +180,48 @@ def get_rate_matrix(UA, rec, task, uids, prd, ref_ev, nrate, trs=None,
     return rates
 
 
+def get_rate_tensor(UA, rec, task, uids, prd, ref_ev, nrate, trs=None,
+                    tstep=None, levels=None, min_non_nan_trs=2,
+                    dtype=np.float32):
+    """
+    Return rates across units, trials and time points in contiguous array
+    (units x trials x time), and the labels of each axis in Series.
+    """
+
+    t1s, t2s, ref_ts = get_prd_times(UA, rec, task, prd, ref_ev, trs, levels)
+    ulist = list(UA.iter_thru([task], uids))
+    if trs is None:
+        trs = t1s.index
+
+    # Sample indices are shared by all units of recording (same trial
+    # events and rate sampling times).
+    rate0 = ulist[0]._Rates[nrate]
+    smpl_idxs, col_idxs, tvec = rate0.get_sample_idxs(trs, t1s, t2s, ref_ts,
+                                                      tstep)
+
+    # Fill rates of each unit into array.
+    rates = np.empty((len(ulist), len(trs), len(tvec)), dtype=dtype)
+    for i, u in enumerate(ulist):
+        u._Rates[nrate].get_rates_array(trs, smpl_idxs, col_idxs, len(tvec),
+                                        out=rates[i])
+
+    # Remove time points with less then minimum number of non-NaN rates
+    # in any unit (due to missing sampling time in some trials).
+    n_non_nan_trs = (~np.isnan(rates)).sum(1).min(0)
+    to_keep = n_non_nan_trs >= min_non_nan_trs
+    if not to_keep.all():
+        rates = np.ascontiguousarray(rates[:, :, to_keep])
+        tvec = tvec[to_keep]
+
+    # Axis labels.
+    axes = [('units', pd.Index([u.Name for u in ulist])),
+            ('trials', pd.Index(trs)),
+            ('times', pd.Index(tvec))]
+    axes = util.series_from_tuple_list(axes)
+
+    return rates, axes
+
+
 def get_spike_times(UA, rec, task, uids, prd, ref_ev, trs=None, levels=None):
     """Return spike times of units during given recording, task and trials."""
 
@@ -195,6 +238,47 @@ def get_spike_times(UA, rec, task, uids, prd, ref_ev, trs=None, levels=None):
     return Spikes
 
 
+def get_prd_rates_units(ulist, prd, add_latency=False):
+    """
+    Return rates of units during period in each of their included trials
+    (list of Series indexed by trial), with spikes of all units and trials
+    counted at once.
+    """
+
+    # Concatenate spikes of each included trial of each unit, with period
+    # limits of trial.
+    spk_list, nspk_list, t1_list, t2_list, trs_list = [], [], [], [], []
+    for u in ulist:
+        trs = u.inc_trials()
+        t1s, t2s = [util.float_vals(ts, s) for ts in
+                    u.pr_times(prd, trs, add_latency, concat=False)]
+        spk_times, offsets = u._Spikes.get_csr(trs, s)
+        spk_list.append(spk_times)
+        nspk_list.append(np.diff(offsets))
+        t1_list.append(t1s)
+        t2_list.append(t2s)
+        trs_list.append(np.array(trs))
+
+    if not len(ulist):
+        return []
+
+    # Count spikes within period of each trial of each unit.
+    nspks = np.concatenate(nspk_list)
+    offsets = np.zeros(len(nspks)+1, dtype=int)
+    offsets[1:] = np.cumsum(nspks)
+    t1s, t2s = np.concatenate(t1_list), np.concatenate(t2_list)
+    counts = util.count_in_windows(np.concatenate(spk_list), offsets,
+                                   t1s, t2s)
+    rates = counts / (t2s - t1s)
+
+    # Split rates by unit.
+    itr_ends = np.cumsum([len(trs) for trs in trs_list])[:-1]
+    rates = [pd.Series(r, index=trs)
+             for r, trs in zip(np.split(rates, itr_ends), trs_list)]
+
+    return rates
+
+
 def get_prd_mean_rates(UA, tasks, prd, ref_ev, nrate, tmax=None,
                        only_pd=None, stim=None, index='name'):
     """Return mean rates per unit at each time during period in DataFrame."""
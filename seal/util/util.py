@@ -106,6 +106,37 @@ def write_excel(df, sheet_name, fname, **kwargs):
     save_sheets([df], [sheet_name], fname, **kwargs)
 
 
+def export_table(df, fname, sheet_name='Sheet1', **kwargs):
+    """
+    Export DataFrame into table, with format set by file extension: CSV
+    (.csv), Parquet (.parquet) or Excel (any other).
+    """
+
+    ext = os.path.splitext(fname)[1]
+    if ext == '.csv':
+        create_dir(fname)
+        df.to_csv(fname, **kwargs)
+    elif ext == '.parquet':
+        create_dir(fname)
+        df.to_parquet(fname, **kwargs)
+    else:
+        write_excel(df, sheet_name, fname, **kwargs)
+
+
+def import_table(fname, **kwargs):
+    """Import table exported by export_table."""
+
+    ext = os.path.splitext(fname)[1]
+    if ext == '.csv':
+        df = pd.read_csv(fname, index_col=0, **kwargs)
+    elif ext == '.parquet':
+        df = pd.read_parquet(fname, **kwargs)
+    else:
+        df = pd.read_excel(fname, **kwargs)
+
+    return df
+
+
 def get_latest_file(dir_name, ext='.data'):
     """Return name of latest file from folder."""
 
@@ -251,18 +282,64 @@ def get_n_cores():
     return ncores
 
 
-def run_in_pool(f, params, nCPU=None):
-    """Run a function parallel with a list of parameters on local processor."""
+def run_in_pool(f, params, nCPU=None, chunksize=None, initializer=None,
+                initargs=()):
+    """
+    Run a function parallel with a list of parameters on local processor.
+
+    chunksize:   Number of parameter sets sent to a worker at once. Set it to 1
+                 and order params by decreasing cost for load balancing.
+    initializer: Function called once by each worker at start (with initargs),
+                 e.g. to set up large read-only data shared by all tasks.
+    """
 
     if nCPU is None:  # set number of cores
-        nCPU = get_n_cores() - 1
+        nCPU = max(get_n_cores() - 1, 1)
+
+    # Run serially in current process (e.g. from within a pool worker).
+    if nCPU == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        res = [f(*p) for p in params]
+        return res
 
-    with mp.Pool(nCPU) as p:
-        res = p.starmap(f, params)
+    with mp.Pool(nCPU, initializer, initargs) as p:
+        res = p.starmap(f, params, chunksize)
 
     return res
 
 
+def call_with_params(f_params):
+    """Call function with parameters, given as (function, params) pair."""
+
+    f, params = f_params
+    return f(*params)
+
+
+def imap_in_pool(f, params, nCPU=None, initializer=None, initargs=()):
+    """
+    Iterate through results of running function with a list of parameters
+    in pool (in order of parameters), yielding each as soon as it finishes
+    (see run_in_pool).
+    """
+
+    if nCPU is None:  # set number of cores
+        nCPU = max(get_n_cores() - 1, 1)
+
+    # Run serially in current process (e.g. from within a pool worker).
+    if nCPU == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for p in params:
+            yield f(*p)
+        return
+
+    with mp.Pool(nCPU, initializer, initargs) as p:
+        for res in p.imap(call_with_params, [(f, prms) for prms in params],
+                          chunksize=1):
+            yield res
+
+
 def create_dir(f):
     """Create directory if it does not already exist."""
 
@@ -386,6 +463,77 @@ def indices_in_window(v, vmin=None, vmax=None, l_inc=True, r_inc=True):
     return idxs
 
 
+def segment_idxs(offsets):
+    """
+    Return index of segment of each value of concatenated array, with index
+    of first value of each segment (and end of last one) in offsets.
+    """
+
+    iseg = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    return iseg
+
+
+def concat_segments(val_list):
+    """
+    Return list of arrays (segments) concatenated into single array, and
+    index of first value of each segment (and end of last one) in it.
+    """
+
+    offsets = np.zeros(len(val_list)+1, dtype=int)
+    offsets[1:] = np.cumsum([len(vals) for vals in val_list])
+    vals = np.concatenate(val_list) if len(val_list) else np.zeros(0)
+
+    return vals, offsets
+
+
+def segment_histograms(vals, iseg, nseg, bins):
+    """
+    Return histogram (number of values in each bin) of values of each
+    segment (with index of segment of each value) as segments x bins array.
+    """
+
+    nbins = len(bins) - 1
+    ibin = np.searchsorted(bins, vals, side='right') - 1
+    is_in = (ibin >= 0) & (ibin < nbins)
+    hists = np.bincount(iseg[is_in] * nbins + ibin[is_in],
+                        minlength=nseg * nbins).reshape(nseg, nbins)
+
+    return hists
+
+
+def segment_diff(vals, offsets):
+    """
+    Return differences between consecutive values within each segment of
+    concatenated array (see segment_idxs), and index of first difference of
+    each segment (and end of last one).
+    """
+
+    # Drop differences across segment boundaries.
+    nseg = len(offsets) - 1
+    is_last = np.zeros(len(vals), dtype=bool)
+    is_last[offsets[1:][np.diff(offsets) > 0] - 1] = True
+    diffs = np.diff(vals)[~is_last[:-1]] if len(vals) else np.zeros(0)
+
+    ndiff = np.maximum(np.diff(offsets) - 1, 0)
+    diff_offsets = np.zeros(nseg+1, dtype=int)
+    diff_offsets[1:] = np.cumsum(ndiff)
+
+    return diffs, diff_offsets
+
+
+def count_in_windows(vals, offsets, vmins, vmaxs):
+    """
+    Return number of values of each segment of concatenated array (see
+    segment_idxs) within window (inclusive) specific to segment.
+    """
+
+    iseg = segment_idxs(offsets)
+    in_wndw = (vals >= vmins[iseg]) & (vals <= vmaxs[iseg])
+    counts = np.bincount(iseg[in_wndw], minlength=len(offsets)-1)
+
+    return counts
+
+
 def values_in_window(v, vmin=None, vmax=None):
     """Return values between min and max values."""
 
@@ -563,6 +711,14 @@ def remove_dim_from_series(qser):
     return series
 
 
+def float_vals(vals, dim):
+    """Return values (Quantities or NaN) in dimension as float array."""
+
+    fvals = np.array([float(v.rescale(dim)) if is_quantity(v)
+                      else float(v) for v in vals], dtype=float)
+    return fvals
+
+
 def dim_series_to_array(qser):
     """Convert quantity Series to quantity array."""
 
@@ -753,6 +909,48 @@ def zscore_timeseries(timeseries, axis=0):
     return zscored_ts
 
 
+def zscore_by_group(X, groups, axis=0):
+    """
+    Z-score array by group labels along given axis (e.g. trials of
+    units x trials x time rate tensor), independently for every other index.
+
+    groups: Group label of each index along axis. Values with NaN label are
+            left unchanged.
+    Ignores NaN values (like pandas), uses ddof=0 and returns NaN where group
+    std is 0.
+    """
+
+    codes, uniques = pd.factorize(np.asarray(groups))
+    ngrps = len(uniques)
+
+    # Move grouping axis to front and select labelled values.
+    Xm = np.moveaxis(np.asarray(X, dtype=float), axis, 0)
+    has_grp = codes >= 0
+    cX, Xg = codes[has_grp], Xm[has_grp]
+    is_val = ~np.isnan(Xg)
+    X0 = np.where(is_val, Xg, 0)
+
+    # Group-wise counts, means and standard deviations.
+    shape = (ngrps,) + Xg.shape[1:]
+    n, sums, ssq = [np.zeros(shape) for i in range(3)]
+    np.add.at(n, cX, is_val)
+    np.add.at(sums, cX, X0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / n
+        dX = np.where(is_val, Xg - mean[cX], 0)
+        np.add.at(ssq, cX, dX**2)
+        std = np.sqrt(ssq / n)
+        std[std == 0] = np.nan
+        Zg = np.where(is_val, dX / std[cX], np.nan)
+
+    # Put z-scored values back in array of original shape and type.
+    Z = np.array(X, dtype=np.result_type(np.asarray(X), np.float32))
+    Zm = np.moveaxis(Z, axis, 0)
+    Zm[has_grp] = Zg
+
+    return Z
+
+
 def select_period_around_max(ts, twidth, t_start=None, t_stop=None):
     """Returns values in timeseries within given period around maximum."""
 
@@ -851,6 +1049,49 @@ def calc_stim_resp_stats(stim_resp, all_stim_vals=None):
     return resp_stats
 
 
+def run_bounds(on_mat):
+    """
+    Return row index, start and (inclusive) end column index of each run of
+    True values in each row of boolean (units x time) matrix, ordered by row
+    and start.
+    """
+
+    on_mat = np.array(on_mat, dtype=bool, ndmin=2)
+    nrow, ncol = on_mat.shape
+
+    # Starts (+1) and ends (-1) of runs from difference of padded rows.
+    padded = np.zeros((nrow, ncol+2), dtype=np.int8)
+    padded[:, 1:-1] = on_mat
+    dmat = np.diff(padded, axis=1)
+    irow, istart = np.nonzero(dmat == 1)
+    iend = np.nonzero(dmat == -1)[1] - 1
+
+    return irow, istart, iend
+
+
+def first_long_runs(on_mat, tvec, min_len):
+    """
+    Return start time of first run of True values longer than min_len
+    (end time - start time > min_len) in each row of boolean (units x time)
+    matrix, NaN for rows without any such run.
+    """
+
+    on_mat = np.array(on_mat, dtype=bool, ndmin=2)
+    tvec = np.array(tvec, dtype=float)
+
+    # Runs with at least minimum length.
+    irow, istart, iend = run_bounds(on_mat)
+    is_long = (tvec[iend] - tvec[istart]) > min_len
+    irow, istart = irow[is_long], istart[is_long]
+
+    # First long run of each row.
+    tfirst = np.full(on_mat.shape[0], np.nan)
+    rows, ifirst = np.unique(irow, return_index=True)
+    tfirst[rows] = tvec[istart[ifirst]]
+
+    return tfirst
+
+
 def long_periods(vec, min_len):
     """Return indices of periods with length at least as specified minimum."""
 
@@ -861,16 +1102,13 @@ def long_periods(vec, min_len):
     if not vec.any():
         return pd.Series(name='index', dtype=object)
 
-    # Chop vector into blocks of consequtive time points with same value.
-    blocks = (vec.shift(1) != vec).astype(int).cumsum()
-    df = pd.DataFrame.from_items([('vec', vec), ('blocks', blocks)])
-    prds = df.reset_index().groupby(['vec', 'blocks'])['index'].apply(np.array)
-
-    # Select only 'on' periods.
-    prds = prds[True]
+    # Find runs of 'on' periods.
+    idx = np.array(vec.index)
+    irow, istart, iend = run_bounds(vec)
 
     # Keep only ones having at least minimum length.
-    idxs = [(prd[-1] - prd[0]) > min_len for idx, prd in prds.iteritems()]
-    prds = prds[idxs]
+    prds = [idx[i1:i2+1] for i1, i2 in zip(istart, iend)
+            if (idx[i2] - idx[i1]) > min_len]
+    prds = pd.Series(prds, name='index', dtype=object)
 
     return prds